@@ -0,0 +1,682 @@
+"""ASGI entry point of the SPARQL OpenCitations web application.
+
+It exposes the same routes as the web.py application defined in sparql_oc.py,
+but contacts the SPARQL backends through an asyncio HTTP client. The handling
+of the queries is shared with sparql_oc.py through src/pipeline.py. Results are
+streamed to the client as they arrive (unless stream_results is off) and, if
+the client disconnects before the response is complete, the request to the
+backend is aborted, so that QLever and Virtuoso stop computing abandoned queries.
+
+Run it with:
+    uvicorn asgi:application --host 0.0.0.0 --port 8080
+or with gunicorn:
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+"""
+import json
+import time
+import asyncio
+import urllib.parse as urlparse
+import aiohttp
+from yarl import URL
+
+from sparql_oc import (env_config, active, render, update_checker, result_cache, static_assets, rendered_pages,
+                       release_watcher, admission, worker_locks, backends, deadlines, compression_levels,
+                       balancers, stored_queries, pipelines, log_request, readiness)
+from src.admission import client_ip, AdmissionRejected, ClientTokens
+from src.query_check import PooledUpdateChecker
+from src.single_flight import SingleFlight, AsyncFlight, FlightFailed
+from src import metrics
+from src.health import CircuitOpen
+from src.deadlines import DeadlineExceeded
+from src.compression import StreamCompressor, decompressor
+from src.batch import Batch, BatchError, result_line
+from src.pipeline import QueryRefused
+
+# Path -> (SPARQL endpoint, title, endpoint used by YASQE)
+sparql_endpoints = {
+    "/index": (env_config["sparql_endpoint_index"], "index", "/index"),
+    "/meta": (env_config["sparql_endpoint_meta"], "meta", "/meta")
+}
+
+# Path of the batches -> path of their endpoint
+batch_endpoints = {
+    "/index/batch": "/index",
+    "/meta/batch": "/meta"
+}
+
+# Path of the stored queries -> path of their endpoint
+stored_endpoints = {
+    "/index/q": "/index",
+    "/meta/q": "/meta"
+}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = {"Content-Type": "text/plain"}
+        self.headers.update(headers or {})
+
+
+# Identical concurrent queries of the worker, see sparql_oc.flights
+flights = SingleFlight(
+    AsyncFlight, env_config["single_flight"]["max_buffer"], env_config["single_flight"]["enabled"])
+
+# Upstream clients, one per endpoint and event loop
+_clients = {}
+
+
+def get_client(endpoint):
+    loop = asyncio.get_running_loop()
+    if endpoint not in _clients or _clients[endpoint][0] is not loop:
+        conf = env_config["upstream"]
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            keepalive_timeout=conf["idle_timeout"],
+            force_close=not conf["keep_alive"])
+        client = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+        _clients[endpoint] = (loop, client)
+    return _clients[endpoint][1]
+
+
+async def open_upstream(client, method, url, data, headers, timeouts):
+    """Send a request to a backend, resending it if a pooled connection was stale.
+
+    The body of the response is not decompressed, so that it can be
+    forwarded as it is when the client accepts its Content-Encoding.
+    """
+    retries = env_config["upstream"]["retries"]
+    connect, read = timeouts
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+    while True:
+        try:
+            return await client.request(
+                method, URL(url, encoded=True), data=data, headers=headers, timeout=timeout,
+                auto_decompress=False)
+        except aiohttp.ServerDisconnectedError:
+            if retries <= 0:
+                raise
+            retries -= 1
+
+
+async def send_response(send, status, body, headers):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def watch_disconnect(receive, task):
+    """Cancel task as soon as the client disconnects"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            task.cancel()
+            return
+
+
+class Request:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.current_subdomain = self.headers.get("host", "").split('.')[0].lower()
+        self.client_ip = client_ip(
+            self.headers.get(env_config["admission"]["client_header"].lower()),
+            (scope.get("client") or ("",))[0],
+            env_config["admission"]["trusted_proxies"])
+
+    @property
+    def query_string(self):
+        return self.scope["query_string"].decode("latin-1")
+
+    @property
+    def env(self):
+        """The WSGI environment of the request, as far as the web logger reads it"""
+        env = {"HTTP_" + name.upper().replace("-", "_"): value for name, value in self.headers.items()}
+        env["REMOTE_ADDR"] = (self.scope.get("client") or (None,))[0]
+        env["PATH_INFO"] = self.scope["path"]
+        env["QUERY_STRING"] = self.query_string
+        env["REQUEST_URI"] = self.scope["path"] + ("?" + self.query_string if self.query_string else "")
+        return env
+
+
+def start_message(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    }
+
+
+class Sparql:
+    def __init__(self, sparql_endpoint, sparql_endpoint_title, yasqe_sparql_endpoint):
+        self.sparql_endpoint = sparql_endpoint
+        self.sparql_endpoint_title = sparql_endpoint_title
+        self.yasqe_sparql_endpoint = yasqe_sparql_endpoint
+        self.collparam = ["query"]
+        self.balancer = balancers[sparql_endpoint_title]
+        self.pipeline = pipelines[sparql_endpoint_title]
+
+    async def handle(self, request):
+        method = request.scope["method"]
+        content_type = request.headers.get("content-type", "")
+
+        if method == "GET":
+            return await self.run_query_string(
+                request, self.sparql_endpoint_title, request.query_string, False, content_type)
+        elif method == "POST":
+            body = await read_body(request.receive)
+            if "application/x-www-form-urlencoded" in content_type:
+                return await self.run_query_string(
+                    request, active["sparql"], body.decode("utf-8"), True, content_type)
+            elif "application/sparql-query" in content_type:
+                query = body.decode("utf-8")
+                await self.check_update(query)
+                # The timeout of the query can be given in the URL
+                query = self.plan(self.pipeline.plan_query_body, query, request.query_string, content_type)
+                return await self.contact_tp(request, query, True)
+            else:
+                raise HTTPError(301, "", {"Location": "/"})
+        else:
+            raise HTTPError(405, "Method not allowed", {"Allow": "GET, POST"})
+
+    async def handle_stored(self, request, name=None):
+        """Run a stored query, or list them, as sparql_oc.Sparql.run_stored does"""
+        queries = stored_queries[self.sparql_endpoint_title]
+        if name is None:
+            log_request(request.env)
+            body = json.dumps({name: stored.describe() for name, stored in queries.items()}, indent=2)
+            return await send_response(
+                request.send, 200, body, {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"})
+        stored = queries.get(name)
+        if stored is None:
+            raise HTTPError(404, "not found")
+        if request.scope["method"] != "GET":
+            raise HTTPError(405, "Method not allowed", {"Allow": "GET"})
+        query = self.plan(self.pipeline.plan_stored, stored, request.query_string)
+        return await self.contact_tp(request, query, True)
+
+    async def handle_batch(self, request):
+        """Run the queries of a batch, as sparql_oc.Sparql.run_batch does"""
+        if not env_config["batch"]["enabled"]:
+            raise HTTPError(404, "not found")
+        if request.scope["method"] != "POST":
+            raise HTTPError(405, "Method not allowed", {"Allow": "POST"})
+        try:
+            batch = Batch(await read_body(request.receive), env_config["batch"]["max_queries"])
+            deadlines[self.sparql_endpoint_title].budget(batch.timeout)
+        except BatchError as e:
+            raise HTTPError(e.status, str(e))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        for query in batch.checked:
+            await self.check_update(query)
+        # Each query not answered from the cache takes a token from the
+        # client, the first one before the response starts
+        self.check_client(request)
+        tokens = ClientTokens(admission, request.client_ip, prepaid=1)
+        metrics.batches.labels(self.sparql_endpoint_title).inc()
+
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Credentials": "true",
+            "Content-Type": "application/x-ndjson",
+            "Vary": "Accept-Encoding"
+        }
+        compressor = None
+        encoding = self.pipeline.encoding(request.headers.get("accept-encoding"))
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            compressor = StreamCompressor(encoding, compression_levels, 0)
+
+        lines = asyncio.Queue()
+        items = iter(enumerate(batch.items))
+        env = request.env
+
+        async def work():
+            for index, (item_id, query) in items:
+                try:
+                    line = await self.batch_query(index, item_id, query, batch, tokens, env)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    line = result_line(index, item_id, 500, body=str(e).encode("utf-8"))
+                lines.put_nowait(line)
+
+        workers = [asyncio.ensure_future(work())
+                   for _ in range(min(env_config["batch"]["concurrency"], len(batch.items)))]
+        watcher = asyncio.ensure_future(watch_disconnect(request.receive, asyncio.current_task()))
+        stream = env_config["stream_results"]
+        try:
+            if stream:
+                await request.send(start_message(200, headers))
+            chunks = []
+            for _ in batch.items:
+                line = await lines.get()
+                if compressor is not None:
+                    line = compressor.feed(line)
+                if line and stream:
+                    await request.send({"type": "http.response.body", "body": line, "more_body": True})
+                elif line:
+                    chunks.append(line)
+            tail = compressor.close() if compressor is not None else b""
+            if stream:
+                await request.send({"type": "http.response.body", "body": tail})
+            else:
+                await send_response(request.send, 200, b"".join(chunks) + tail, headers)
+        except asyncio.CancelledError:
+            if not watcher.done():
+                raise
+            metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+        finally:
+            watcher.cancel()
+            # Queries still running are abandoned
+            for worker in workers:
+                worker.cancel()
+
+    async def batch_query(self, index, item_id, query, batch, tokens, env):
+        """Run a query of batch and return its result line"""
+        query = self.pipeline.plan_batch_query(query, batch.timeout)
+        key = self.pipeline.key(batch.accept, query.cache_params)
+        fields = self.pipeline.log_fields(key, batch=index)
+
+        cache_key = key if result_cache is not None else None
+        cached = self.pipeline.cached(key)
+        if cached is not None:
+            res_content_type, body, _ = cached
+            metrics.observe_request(self.sparql_endpoint_title, 200, len(body))
+            log_request(env, status=200, bytes=len(body), cache="HIT", **fields)
+            return result_line(index, item_id, 200, res_content_type, body, "HIT")
+
+        try:
+            tokens.take()
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
+            log_request(env, status=e.status, bytes=0, **fields)
+            return result_line(index, item_id, e.status, body=str(e).encode("utf-8"))
+
+        flight, subscriber, leader = flights.join(key)
+        if leader:
+            pump = asyncio.ensure_future(self.pump(flight, key, query, True, batch.accept, cache_key, None))
+            flight.on_abandon = pump.cancel
+        else:
+            metrics.coalesced.labels(self.sparql_endpoint_title).inc()
+        fields["coalesced"] = not leader
+
+        body = flight.follow(subscriber)
+        try:
+            try:
+                status, res_headers = await flight.wait_response(subscriber)
+                content = b"".join([chunk async for chunk in body])
+            except FlightFailed as e:
+                status, message = self.pipeline.gateway_error(flight, e)
+                content = message.encode("utf-8")
+                res_headers = {}
+        finally:
+            await body.aclose()
+            flight.unsubscribe(subscriber)
+
+        metrics.observe_request(self.sparql_endpoint_title, status, len(content))
+        if cache_key is not None and status == 200:
+            fields["cache"] = "MISS"
+        log_request(env, status=status, bytes=len(content), upstream_ms=flight.latency, **fields)
+        return result_line(index, item_id, status, res_headers.get("Content-Type"), content, fields.get("cache"))
+
+    @staticmethod
+    def plan(step, *args):
+        """Return the Query planned by step of the pipeline"""
+        try:
+            return step(*args)
+        except QueryRefused as e:
+            raise HTTPError(e.status, str(e), e.headers)
+
+    async def check_update(self, query):
+        if isinstance(update_checker, PooledUpdateChecker):
+            # Waiting for the pool would block the event loop
+            await asyncio.to_thread(self.plan, self.pipeline.check_update, query)
+        else:
+            self.plan(self.pipeline.check_update, query)
+
+    async def run_query_string(self, request, active, query_string, is_post, content_type):
+        if query_string.strip() == "":
+            log_request(request.env)
+            return await serve_page(
+                request, self.sparql_endpoint_title, active,
+                sp_title=self.sparql_endpoint_title,
+                sparql_endpoint=self.yasqe_sparql_endpoint)
+
+        parsed_query = urlparse.parse_qs(query_string)
+        for k in self.collparam:
+            if k in parsed_query:
+                await self.check_update(parsed_query[k][0])
+                query = self.plan(self.pipeline.plan_query_string, query_string, parsed_query, k, content_type)
+                return await self.contact_tp(request, query, is_post)
+
+        raise HTTPError(408, "Not a valid request")
+
+    async def contact_tp(self, request, query, is_post):
+        """Answer a request for query, from the result cache or from the backend"""
+        accept = self.pipeline.accept(request.headers.get("accept"))
+        encoding = self.pipeline.encoding(request.headers.get("accept-encoding"))
+        key = self.pipeline.key(accept, query.cache_params, encoding)
+        cache_key = key if result_cache is not None else None
+        env = request.env
+        cached = self.pipeline.cached(key)
+        if cached is not None:
+            body = cached[1]
+            metrics.observe_request(self.sparql_endpoint_title, 200, len(body))
+            log_request(env, status=200, bytes=len(body), **self.pipeline.log_fields(key, cache="HIT"))
+            return await send_response(request.send, 200, body, self.pipeline.response_headers(
+                self.pipeline.cached_headers(cached), query.cost, "HIT"))
+
+        self.check_client(request)
+        # Identical queries running at the same time share one upstream request
+        flight, subscriber, leader = flights.join(key)
+        if leader:
+            pump = asyncio.ensure_future(self.pump(flight, key, query, is_post, accept, cache_key, encoding))
+            # If all the clients go away, the query is aborted
+            flight.on_abandon = pump.cancel
+        else:
+            metrics.coalesced.labels(self.sparql_endpoint_title).inc()
+
+        fields = self.pipeline.log_fields(key, leader)
+        # The body has already been consumed, so from now on the only
+        # message we can receive is the disconnection of the client
+        watcher = asyncio.ensure_future(watch_disconnect(request.receive, asyncio.current_task()))
+        body = flight.follow(subscriber)
+        status, size = None, 0
+        try:
+            try:
+                status, res_headers = await flight.wait_response(subscriber)
+                fields["upstream_ms"] = flight.latency
+                if status != 200:
+                    # The flight can still fail while the error is read
+                    error = b"".join([chunk async for chunk in body])
+            except FlightFailed as e:
+                status, message = self.pipeline.gateway_error(flight, e)
+                return await send_response(request.send, status, message, {"Content-Type": "text/plain"})
+            if status != 200:
+                size = len(error)
+                return await send_response(request.send, status, error, res_headers)
+
+            if cache_key is not None:
+                fields["cache"] = "MISS"
+            headers = self.pipeline.response_headers(res_headers, query.cost, fields.get("cache"))
+            if env_config["stream_results"]:
+                await request.send(start_message(200, headers))
+                async for chunk in body:
+                    await request.send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    size += len(chunk)
+                await request.send({"type": "http.response.body", "body": b""})
+            else:
+                content = b"".join([chunk async for chunk in body])
+                size = len(content)
+                await send_response(request.send, 200, content, headers)
+        except asyncio.CancelledError:
+            if not watcher.done():
+                raise
+            metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+            if status is None:
+                status = 499
+        finally:
+            if status is not None:
+                metrics.observe_request(self.sparql_endpoint_title, status, size)
+                log_request(env, status=status, bytes=size, **fields)
+            watcher.cancel()
+            await body.aclose()
+            # In case the body was never read
+            flight.unsubscribe(subscriber)
+
+    def check_client(self, request):
+        if admission is None:
+            return
+        try:
+            admission.check_client(request.client_ip)
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
+            raise HTTPError(e.status, str(e), {"Retry-After": str(e.retry_after)})
+
+    async def pump(self, flight, key, query, is_post, accept, cache_key, encoding):
+        """Send query to a replica of the backend and publish its response to flight.
+
+        It runs in a task of its own, cancelled when all the requests
+        following the flight are gone or when it is still running after the
+        budget of the query: in that case the connection to the backend is
+        closed instead of being returned to the pool, so that the backend
+        stops computing the query. The response is decompressed, converted,
+        compressed and collected for the result cache by a
+        pipeline.ResultStream, as in sparql_oc.Sparql.__pump.
+        """
+        res = ticket = lock = started = timer = replica = ttfb = None
+        failed = False
+        in_flight = metrics.upstream_in_flight.labels(self.sparql_endpoint_title)
+        expired = False
+        # A deadline shortened by the client says nothing about the backend
+        hinted = query.budget < deadlines[query.lane].total
+        task = asyncio.current_task()
+
+        def failure():
+            nonlocal failed
+            failed = True
+            backends.breaker(self.sparql_endpoint_title).failure()
+
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        try:
+            if worker_locks is not None and cache_key is not None:
+                lock, waited = await worker_locks.acquire_async(key)
+                cached = result_cache.get(cache_key) if waited else None
+                if cached is not None:
+                    await flight.start(200, self.pipeline.cached_headers(cached), cached[1])
+                    return
+
+            backends.check(self.sparql_endpoint_title)
+            if admission is not None:
+                ticket = await admission.acquire_async(query.lane)
+            replica = self.balancer.acquire(query.query)
+            metrics.replica_requests.labels(self.sparql_endpoint_title, replica.url).inc()
+            url = replica.url if query.url_query is None else "%s?%s" % (replica.url, query.url_query)
+            client = get_client(replica.url)
+            req_headers, conversion = self.pipeline.upstream_headers(
+                accept, query.query, query.content_type, encoding)
+            if is_post:
+                method, data = "POST", query.data.encode("utf-8")
+            else:
+                method, url, data = "GET", "%s?%s" % (url, query.data), None
+            in_flight.inc()
+            started = time.monotonic()
+            timer = asyncio.get_running_loop().call_later(query.budget, expire)
+            res = await open_upstream(
+                client, method, url, data, req_headers, deadlines[query.lane].timeouts(query.budget))
+            ttfb = time.monotonic() - started
+            flight.latency = round(ttfb * 1000, 1)
+            metrics.upstream_ttfb.labels(self.sparql_endpoint_title).observe(ttfb)
+
+            breaker = backends.breaker(self.sparql_endpoint_title)
+            if res.status >= 500:
+                if not hinted:
+                    failure()
+            else:
+                breaker.success()
+            if res.status != 200:
+                error = decompressor(res.headers.get("content-encoding")).decompress(await res.read())
+                await flight.start(res.status, {"Content-Type": res.headers.get("content-type", "text/plain")}, error)
+                return
+            # aiohttp does not decode the body, see open_upstream
+            stream = self.pipeline.result_stream(
+                res.headers["content-type"], res.headers.get("content-encoding"), conversion, encoding, cache_key,
+                decode=True)
+
+            responded = False
+
+            async def publish(chunk):
+                nonlocal responded
+                if not responded:
+                    responded = True
+                    await flight.start(200, stream.response_headers())
+                return await flight.feed(chunk) if chunk else True
+
+            if stream.ready:
+                await publish(b"")
+            received = metrics.upstream_bytes.labels(self.sparql_endpoint_title)
+            async for chunk in res.content.iter_chunked(env_config["stream_chunk_size"]):
+                received.inc(len(chunk))
+                chunk = stream.feed(chunk)
+                if chunk and not await publish(chunk):
+                    return
+            if not await publish(stream.close()):
+                return
+            metrics.upstream_duration.labels(self.sparql_endpoint_title).observe(time.monotonic() - started)
+            self.pipeline.store(cache_key, stream)
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
+            await flight.start(
+                e.status, {"Content-Type": "text/plain", "Retry-After": str(e.retry_after)}, str(e).encode("utf-8"))
+        except CircuitOpen as e:
+            metrics.circuit_rejections.labels(self.sparql_endpoint_title).inc()
+            await flight.start(
+                503, {"Content-Type": "text/plain", "Retry-After": str(e.retry_after)}, str(e).encode("utf-8"))
+        except asyncio.CancelledError:
+            if res is not None:
+                res.close()
+            if expired:
+                metrics.upstream_timeouts.labels(self.sparql_endpoint_title, "total").inc()
+                if not hinted:
+                    failure()
+                await flight.finish(DeadlineExceeded(self.sparql_endpoint_title, "total"))
+            elif started is not None:
+                metrics.upstream_aborts.labels(self.sparql_endpoint_title).inc()
+        except Exception as e:
+            if isinstance(e, aiohttp.ServerTimeoutError):
+                phase = "connect" if isinstance(e, aiohttp.ConnectionTimeoutError) else "read"
+                metrics.upstream_timeouts.labels(self.sparql_endpoint_title, phase).inc()
+                e = DeadlineExceeded(self.sparql_endpoint_title, phase)
+                if not hinted:
+                    failure()
+            elif isinstance(e, aiohttp.ClientError):
+                failure()
+            else:
+                # Errors converting or compressing the result say nothing
+                # about the health of the backend
+                print(f"ERROR: Processing the result of {self.sparql_endpoint_title} failed: {e!r}")
+            await flight.finish(e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            flights.forget(key, flight)
+            await flight.finish()
+            if started is not None:
+                in_flight.dec()
+            if res is not None:
+                res.release()
+            if replica is not None and self.balancer.release(replica, failed, ttfb):
+                metrics.replica_ejections.labels(self.sparql_endpoint_title, replica.url).inc()
+            if ticket is not None:
+                ticket.release()
+            if lock is not None:
+                worker_locks.release(lock)
+
+
+async def serve_page(request, template, active, **kwargs):
+    release_watcher.check()
+    status, headers, body = rendered_pages.respond(
+        (template, active, request.current_subdomain),
+        lambda: getattr(render, template)(
+            active=active, current_subdomain=request.current_subdomain, render=render, **kwargs),
+        request.headers.get("if-none-match"),
+        request.headers.get("if-modified-since"),
+        request.headers.get("accept-encoding"))
+    await send_response(request.send, status, body, headers)
+
+
+async def serve_static(request, name):
+    release_watcher.check()
+    status, headers, body = static_assets.respond(
+        name,
+        request.headers.get("if-none-match"),
+        request.headers.get("if-modified-since"),
+        request.headers.get("accept-encoding"))
+    await send_response(request.send, status, body, headers)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            backends.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            clients = [client for _, client in _clients.values()]
+            _clients.clear()
+            await asyncio.gather(*(client.close() for client in clients))
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    request = Request(scope, receive, send)
+    path = scope["path"]
+    try:
+        if path == "/":
+            log_request(request.env)
+            await serve_page(request, "sparql", "", sp_title="", sparql_endpoint="")
+        elif path == "/ready":
+            ready, body = readiness()
+            await send_response(send, 200 if ready else 503, body, {"Content-Type": "application/json"})
+        elif path == "/metrics":
+            body, content_type = metrics.collect()
+            await send_response(send, 200, body, {"Content-Type": content_type})
+        elif path == "/health":
+            await send_response(send, 200, '{"status": "ok"}', {"Content-Type": "application/json"})
+        elif path == "/favicon.ico":
+            is_https = request.headers.get("x-forwarded-proto") == "https" or scope.get("scheme") == "https"
+            protocol = 'https' if is_https else 'http'
+            location = f"{protocol}://{request.headers.get('host', '')}/static/favicon.ico"
+            await send_response(send, 303, "", {"Location": location})
+        elif path.startswith("/static/"):
+            await serve_static(request, path[len("/static/"):])
+        elif path in sparql_endpoints:
+            await Sparql(*sparql_endpoints[path]).handle(request)
+        elif path in batch_endpoints:
+            await Sparql(*sparql_endpoints[batch_endpoints[path]]).handle_batch(request)
+        elif path in stored_endpoints:
+            await Sparql(*sparql_endpoints[stored_endpoints[path]]).handle_stored(request)
+        elif path.rpartition("/")[0] in stored_endpoints:
+            prefix, _, name = path.rpartition("/")
+            await Sparql(*sparql_endpoints[stored_endpoints[prefix]]).handle_stored(request, name)
+        else:
+            raise HTTPError(404, "not found")
+    except HTTPError as e:
+        await send_response(send, e.status, e.body, e.headers)
+    except ClientDisconnected:
+        pass
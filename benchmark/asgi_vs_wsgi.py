@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Compare how many concurrent connections the WSGI (gevent) and the ASGI
+front ends sustain against a slow SPARQL backend.
+
+Both are started with gunicorn.conf.py and the same number of workers; the
+result cache and the admission control are disabled so that every query
+reaches the fake backend.
+
+Usage: python3 benchmark/asgi_vs_wsgi.py --concurrency 50,200,800 --latency 0.5
+"""
+import os
+import sys
+import argparse
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.load import run_load, start_process, start_backend, stop_process, print_log, format_row, HEADER
+
+FRONT_ENDS = {
+    "wsgi": ["sparql_oc:application"],
+    "asgi": ["-k", "uvicorn.workers.UvicornWorker", "asgi:application"]
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="50,200,800", help="comma separated connection counts")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per scenario")
+    parser.add_argument("--latency", type=float, default=0.5, help="latency of the fake backend")
+    parser.add_argument("--size", type=int, default=20000, help="result size of the fake backend")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--backend-port", type=int, default=17011)
+    args = parser.parse_args()
+
+    backend = start_backend(args.backend_port, "--latency", str(args.latency), "--size", str(args.size))
+    env = {
+        "SPARQL_ENDPOINT_INDEX": f"http://127.0.0.1:{args.backend_port}/sparql",
+        "SPARQL_ENDPOINT_META": f"http://127.0.0.1:{args.backend_port}/sparql",
+        "CACHE_ENABLED": "false",
+        "ADMISSION_ENABLED": "false",
+        "SYNC_ENABLED": "false"
+    }
+
+    def make_request(i):
+        query = urlparse.quote(f"SELECT * WHERE {{ ?s ?p ?o }} LIMIT {i + 1}")
+        return "GET", f"/index?query={query}", {"Accept": "application/sparql-results+json"}, b""
+
+    print(HEADER)
+    try:
+        for name, target in FRONT_ENDS.items():
+            server = start_process(
+                [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                 "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}"] + target,
+                args.port, env)
+            try:
+                for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                    stats = run_load(args.port, make_request, concurrency, args.duration)
+                    print(format_row(f"{name} c={concurrency}", stats.summary()), flush=True)
+                    if stats.errors:
+                        print_log(server)
+            finally:
+                stop_process(server)
+    finally:
+        stop_process(backend)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Stand-in SPARQL endpoint to benchmark the service without QLever or Virtuoso.
+
+Every request, whatever the query, is answered after a configurable latency
+with a SPARQL JSON result of a configurable size, sent at once or streamed in
+chunks; a share of the requests can be made to fail.
+
+Usage: python3 benchmark/fake_backend.py --port 7011 --latency 0.05 --size 20000
+"""
+import json
+import random
+import asyncio
+import argparse
+
+
+def make_result(size):
+    """Build a SPARQL JSON result of about size bytes"""
+    binding = {"citing": {"type": "uri", "value": "https://w3id.org/oc/meta/br/061012345678"}}
+    row = json.dumps(binding)
+    rows = max(1, size // (len(row) + 1))
+    return ('{"head": {"vars": ["citing"]}, "results": {"bindings": [%s]}}' % ",".join([row] * rows)).encode("utf-8")
+
+
+class FakeBackend:
+    def __init__(self, latency=0.0, size=1000, chunks=1, chunk_delay=0.0, error_rate=0.0):
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.body = make_result(size)
+        self.requests = 0
+        self.aborted = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+
+                await asyncio.sleep(self.latency)
+                if random.random() < self.error_rate:
+                    body = b"Internal error of the fake backend"
+                    writer.write(b"HTTP/1.1 500 Internal Server Error\r\ncontent-type: text/plain\r\n"
+                                 b"content-length: %d\r\n\r\n%s" % (len(body), body))
+                elif self.chunks <= 1:
+                    writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: application/sparql-results+json\r\n"
+                                 b"content-length: %d\r\n\r\n" % len(self.body))
+                    writer.write(self.body)
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: application/sparql-results+json\r\n"
+                                 b"transfer-encoding: chunked\r\n\r\n")
+                    step = len(self.body) // self.chunks + 1
+                    for i in range(0, len(self.body), step):
+                        chunk = self.body[i:i + step]
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                        await writer.drain()
+                        await asyncio.sleep(self.chunk_delay)
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.aborted += 1
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7011)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before answering")
+    parser.add_argument("--size", type=int, default=1000, help="size of the result in bytes")
+    parser.add_argument("--chunks", type=int, default=1, help="number of chunks the result is streamed in")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between two chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.latency, args.size, args.chunks, args.chunk_delay, args.error_rate)
+    try:
+        asyncio.run(backend.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
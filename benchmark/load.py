@@ -0,0 +1,220 @@
+"""Helpers shared by the benchmark scripts: a simple asyncio load generator
+and the management of the processes under test."""
+import os
+import sys
+import time
+import socket
+import asyncio
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.ttfb = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    def percentile(self, values, p):
+        if not values:
+            return float("nan")
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def summary(self):
+        completed = len(self.latencies)
+        return {
+            "requests": completed,
+            "errors": self.errors,
+            "rps": completed / self.elapsed if self.elapsed else 0,
+            "p50": self.percentile(self.latencies, 50) * 1000,
+            "p99": self.percentile(self.latencies, 99) * 1000,
+            "ttfb_p50": self.percentile(self.ttfb, 50) * 1000,
+            "ttfb_p99": self.percentile(self.ttfb, 99) * 1000,
+            "mb": self.bytes / 1024 / 1024,
+            "statuses": dict(sorted(self.statuses.items()))
+        }
+
+
+class Connection:
+    """Minimal keep-alive HTTP/1.1 client, much lighter than a full-featured
+    one, so that the load generator is not the bottleneck"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, headers=None, body=b""):
+        """Send a request and return (status, first byte time, body size)"""
+        if self.writer is not None:
+            try:
+                return await self.__send(method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed the keep-alive connection in the
+                # meantime, as browsers do the request is sent again
+                self.close()
+        return await self.__send(method, path, headers, body)
+
+    async def __send(self, method, path, headers, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by the server")
+        first = time.monotonic()
+        status = int(status_line.split()[1])
+        res_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            res_headers[name.strip().lower()] = value.strip().lower()
+
+        size = 0
+        if "content-length" in res_headers:
+            size = len(await self.reader.readexactly(int(res_headers["content-length"])))
+        elif res_headers.get("transfer-encoding") == "chunked":
+            while True:
+                length = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(length + 2)
+                size += length
+                if length == 0:
+                    break
+        else:
+            size = len(await self.reader.read())
+            res_headers["connection"] = "close"
+
+        if res_headers.get("connection") == "close":
+            self.close()
+        return status, first, size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def _worker(host, port, make_request, deadline, stats):
+    conn = Connection(host, port)
+    i = 0
+    while time.monotonic() < deadline:
+        method, path, headers, body = make_request(i)
+        i += 1
+        start = time.monotonic()
+        try:
+            status, first, size = await conn.request(method, path, headers, body)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            conn.close()
+            continue
+        end = time.monotonic()
+        stats.latencies.append(end - start)
+        stats.ttfb.append(first - start)
+        stats.bytes += size
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if status >= 400:
+            stats.errors += 1
+    conn.close()
+
+
+async def _run(host, port, make_request, concurrency, duration):
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*[
+        _worker(host, port, make_request, deadline, stats) for _ in range(concurrency)])
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def run_load(port, make_request, concurrency, duration, host="127.0.0.1"):
+    """Send requests to host:port from concurrency connections for duration seconds.
+
+    make_request(i) returns the (method, path, headers, body) of the i-th
+    request sent by a connection.
+    """
+    return asyncio.run(_run(host, port, make_request, concurrency, duration))
+
+
+def wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port} after {timeout} seconds")
+
+
+def start_process(args, port, env=None, log=None):
+    """Start a process from the repository root and wait until it listens on port.
+
+    Its output and errors are written to the file at log, or to a temporary
+    file, whose path is the log attribute of the process (see print_log).
+    """
+    proc_env = dict(os.environ)
+    proc_env.update(env or {})
+    if log is None:
+        fd, log = tempfile.mkstemp(prefix=f"benchmark-{port}-", suffix=".log")
+        os.close(fd)
+    with open(log, "wb") as output:
+        proc = subprocess.Popen(args, cwd=ROOT, env=proc_env, stdout=output, stderr=subprocess.STDOUT)
+    proc.log = log
+    proc.log_offset = 0
+    try:
+        wait_port(port)
+    except RuntimeError:
+        proc.kill()
+        proc.wait()
+        print_log(proc)
+        raise
+    return proc
+
+
+def print_log(proc, max_lines=50):
+    """Print what the process wrote since the last call, up to its last max_lines lines"""
+    with open(proc.log, "rb") as f:
+        f.seek(proc.log_offset)
+        output = f.read()
+    proc.log_offset += len(output)
+    lines = output.decode("utf-8", "replace").splitlines()
+    if lines:
+        print(f"--- {proc.log} ({len(lines)} new lines, last {min(len(lines), max_lines)}) ---", file=sys.stderr)
+        print("\n".join(lines[-max_lines:]), file=sys.stderr, flush=True)
+
+
+def start_backend(port, *options):
+    return start_process(
+        [sys.executable, os.path.join("benchmark", "fake_backend.py"), "--port", str(port)] + list(options), port)
+
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def format_row(name, summary):
+    row = (f"{name:<28} {summary['requests']:>8} {summary['errors']:>7} {summary['rps']:>9.1f} "
+           f"{summary['p50']:>9.1f} {summary['p99']:>9.1f} {summary['ttfb_p50']:>9.1f} {summary['ttfb_p99']:>9.1f}")
+    if summary["errors"]:
+        row += f"  statuses: {summary['statuses']}"
+    return row
+
+
+HEADER = (f"{'scenario':<28} {'requests':>8} {'errors':>7} {'req/s':>9} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'ttfb p50':>9} {'ttfb p99':>9}")
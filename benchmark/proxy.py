@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Load test of the SPARQL proxy against a local stand-in backend.
+
+The application is started with gunicorn.conf.py, as in production, in
+front of fake_backend.py, whose latency, result size, streaming and error
+rate are configurable. Each scenario drives one kind of request: queries
+sent with GET, with a POST of application/sparql-query or of a form, a mix
+of the three, batches of queries sent to /index/batch, and static files.
+For each scenario the script reports the throughput, the p50/p99 latency
+and time to first byte, and the memory of the gunicorn workers.
+
+The result cache and the admission control are disabled, and every query
+is different, so that every request reaches the backend. Results can be
+saved and compared with a previous run, the script failing if a scenario
+got slower than the tolerance allows.
+
+Usage: python3 benchmark/proxy.py --concurrency 100 --latency 0.05 --save before.json
+       python3 benchmark/proxy.py --concurrency 100 --latency 0.05 --compare before.json
+"""
+import os
+import sys
+import json
+import argparse
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.load import run_load, start_process, start_backend, stop_process, print_log, format_row, HEADER, ROOT
+
+FRONT_ENDS = {
+    "wsgi": ["sparql_oc:application"],
+    "asgi": ["-k", "uvicorn.workers.UvicornWorker", "asgi:application"]
+}
+
+
+def make_query(i):
+    # A lookup rather than a scan, so that it is not sent to the heavy lane
+    return ("PREFIX cito: <http://purl.org/spar/cito/> "
+            f"SELECT ?citing WHERE {{ ?citation cito:hasCitingEntity ?citing }} LIMIT {i + 1}")
+
+
+def get_request(i):
+    query = urlparse.quote(make_query(i))
+    return "GET", f"/index?query={query}", {"Accept": "application/sparql-results+json"}, b""
+
+
+def post_request(i):
+    headers = {"Accept": "application/sparql-results+json", "Content-Type": "application/sparql-query"}
+    return "POST", "/index", headers, make_query(i).encode("utf-8")
+
+
+def form_request(i):
+    headers = {"Accept": "application/sparql-results+json", "Content-Type": "application/x-www-form-urlencoded"}
+    return "POST", "/index", headers, urlparse.urlencode({"query": make_query(i)}).encode("utf-8")
+
+
+def mix_request(i):
+    return (get_request, post_request, form_request)[i % 3](i)
+
+
+def batch_request(size):
+    def make_request(i):
+        queries = [make_query(i * size + j) for j in range(size)]
+        headers = {"Content-Type": "application/json"}
+        return "POST", "/index/batch", headers, json.dumps({"queries": queries}).encode("utf-8")
+    return make_request
+
+
+def static_request(paths):
+    def make_request(i):
+        return "GET", paths[i % len(paths)], {"Accept-Encoding": "gzip, br"}, b""
+    return make_request
+
+
+def static_paths(directory):
+    """Return the URLs of the CSS and JavaScript files of the static folder"""
+    paths = []
+    for root, _, files in os.walk(os.path.join(ROOT, directory)):
+        for name in sorted(files):
+            if name.endswith((".css", ".js")):
+                paths.append("/" + os.path.relpath(os.path.join(root, name), ROOT))
+    return paths
+
+
+def workers_rss(master_pid):
+    """Return the resident memory, in MB, of each child of the gunicorn master"""
+    sizes = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        if int(status.get("PPid", "0")) == master_pid:
+            sizes.append(int(status["VmRSS"].split()[0]) / 1024)
+    return sorted(sizes)
+
+
+def compare(results, baseline, tolerance):
+    """Print the changes from baseline, returning False if a scenario got slower than tolerance allows"""
+    ok = True
+    print(f"\n{'scenario':<28} {'req/s':>16} {'p99 ms':>18}")
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        rps = (summary["rps"] - before["rps"]) / before["rps"] * 100 if before["rps"] else 0
+        p99 = (summary["p99"] - before["p99"]) / before["p99"] * 100 if before["p99"] else 0
+        regression = rps < -tolerance or p99 > tolerance
+        ok = ok and not regression
+        print(f"{name:<28} {before['rps']:>7.1f} {rps:>+7.1f}% {before['p99']:>8.1f} {p99:>+7.1f}%"
+              + ("  REGRESSION" if regression else ""))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--front-end", choices=FRONT_ENDS, default="wsgi")
+    parser.add_argument("--scenarios", default="get,post,form,mix,batch,static", help="comma separated scenarios")
+    parser.add_argument("--batch-size", type=int, default=20, help="queries of each request of the batch scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent connections")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per scenario")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before the first scenario")
+    parser.add_argument("--workers", type=int, default=None, help="gunicorn workers (default: gunicorn.conf.py)")
+    parser.add_argument("--latency", type=float, default=0.05, help="latency of the fake backend")
+    parser.add_argument("--size", type=int, default=20000, help="result size of the fake backend")
+    parser.add_argument("--chunks", type=int, default=1, help="chunks the fake backend streams the result in")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between two chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of queries failing with 500")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--backend-port", type=int, default=17011)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with a JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=10, help="percentage of slowdown still accepted")
+    args = parser.parse_args()
+
+    scenarios = {
+        "get": get_request,
+        "post": post_request,
+        "form": form_request,
+        "mix": mix_request,
+        "batch": batch_request(args.batch_size),
+        "static": static_request(static_paths("static"))
+    }
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            parser.error(f"unknown scenario: {name}")
+
+    backend = start_backend(
+        args.backend_port, "--latency", str(args.latency), "--size", str(args.size), "--chunks", str(args.chunks),
+        "--chunk-delay", str(args.chunk_delay), "--error-rate", str(args.error_rate))
+    env = {
+        "SPARQL_ENDPOINT_INDEX": f"http://127.0.0.1:{args.backend_port}/sparql",
+        "SPARQL_ENDPOINT_META": f"http://127.0.0.1:{args.backend_port}/sparql",
+        "CACHE_ENABLED": "false",
+        "ADMISSION_ENABLED": "false",
+        "SYNC_ENABLED": "false"
+    }
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{args.port}"]
+    if args.workers:
+        command += ["-w", str(args.workers)]
+
+    results = {}
+    print(HEADER + f" {'rss MB':>9}")
+    try:
+        server = start_process(command + FRONT_ENDS[args.front_end], args.port, env)
+        try:
+            if args.warmup:
+                run_load(args.port, mix_request, args.concurrency, args.warmup)
+            for name in selected:
+                summary = run_load(args.port, scenarios[name], args.concurrency, args.duration).summary()
+                rss = workers_rss(server.pid)
+                summary["rss_mb"] = sum(rss)
+                summary["rss_max_mb"] = max(rss, default=0)
+                results[f"{args.front_end} {name}"] = summary
+                print(format_row(f"{args.front_end} {name}", summary) + f" {summary['rss_mb']:>9.1f}", flush=True)
+                if summary["errors"]:
+                    print_log(server)
+        finally:
+            stop_process(server)
+    finally:
+        stop_process(backend)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Startup time of the service, with and without preload_app.
+
+Measures the time to import sparql_oc and to warm it up in a fresh
+interpreter, then starts gunicorn.conf.py with PRELOAD_APP=false and true
+against the fake backend and reports, for each mode: the time until the
+server listens and until all the workers are ready, the latency of the
+first request for a landing page, a static file and a query, and the time
+to replace a worker (as when max_requests recycles it).
+
+Usage: python3 benchmark/startup.py --workers 5 --repeat 5
+"""
+import os
+import re
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.load import Connection, wait_port, start_backend, stop_process, ROOT
+
+ENV = {
+    "CACHE_ENABLED": "false",
+    "ADMISSION_ENABLED": "false",
+    "SYNC_ENABLED": "false",
+    "PYTHONUNBUFFERED": "1"
+}
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import sparql_oc
+imported = time.perf_counter()
+sparql_oc.warm_up()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+READY = re.compile(r"Worker (\d+) initialized and ready")
+
+QUERY = urlparse.quote(
+    "SELECT ?citing WHERE { ?citation <http://purl.org/spar/cito/hasCitingEntity> ?citing } LIMIT 1")
+
+
+def measure_import(env, repeat):
+    imports, warm_ups = [], []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        imported, warmed = map(float, output.split()[-2:])
+        imports.append(imported)
+        warm_ups.append(warmed)
+    return statistics.median(imports), statistics.median(warm_ups)
+
+
+def ready_workers(log_path):
+    with open(log_path) as f:
+        return READY.findall(f.read())
+
+
+def wait_workers(log_path, count, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if len(ready_workers(log_path)) >= count:
+            return
+        time.sleep(0.01)
+    raise RuntimeError(f"{count} workers not ready after {timeout} seconds")
+
+
+def first_request(port, path):
+    """Return the milliseconds taken by a request on a new connection"""
+    async def run():
+        conn = Connection("127.0.0.1", port)
+        try:
+            start = time.perf_counter()
+            status, _, _ = await conn.request("GET", path, {"Accept-Encoding": "gzip, br"})
+            return status, (time.perf_counter() - start) * 1000
+        finally:
+            conn.close()
+    status, elapsed = asyncio.run(run())
+    if status != 200:
+        raise RuntimeError(f"GET {path} answered {status}")
+    return elapsed
+
+
+def measure_server(args, preload, env):
+    env = dict(env, PRELOAD_APP="true" if preload else "false")
+    with tempfile.NamedTemporaryFile("w", suffix=".log") as log:
+        log_path = log.name
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-w", str(args.workers),
+             "-b", f"127.0.0.1:{args.port}", "sparql_oc:application"],
+            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_port(args.port, 60)
+            listening = time.perf_counter() - start
+            wait_workers(log_path, args.workers)
+            ready = time.perf_counter() - start
+            result = {
+                "listen": listening,
+                "ready": ready,
+                "page": first_request(args.port, "/"),
+                "static": first_request(args.port, "/static/lode/owl.css"),
+                "query": first_request(args.port, f"/index?query={QUERY}")
+            }
+
+            # A worker stopped gracefully is replaced like a recycled one
+            workers = ready_workers(log_path)
+            start = time.perf_counter()
+            os.kill(int(workers[0]), signal.SIGTERM)
+            wait_workers(log_path, len(workers) + 1)
+            result["respawn"] = time.perf_counter() - start
+            return result
+        finally:
+            stop_process(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each measure, the median is reported")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--backend-port", type=int, default=17011)
+    args = parser.parse_args()
+
+    env = dict(os.environ, **ENV)
+    env["SPARQL_ENDPOINT_INDEX"] = env["SPARQL_ENDPOINT_META"] = f"http://127.0.0.1:{args.backend_port}/sparql"
+
+    imported, warmed = measure_import(env, args.repeat)
+    print(f"import sparql_oc: {imported * 1000:.0f} ms, warm_up: {warmed * 1000:.0f} ms\n")
+
+    backend = start_backend(args.backend_port, "--latency", "0")
+    try:
+        print(f"{'preload':<8} {'listen s':>9} {'ready s':>8} {'page ms':>8} {'static ms':>10} "
+              f"{'query ms':>9} {'respawn s':>10}")
+        for preload in (False, True):
+            runs = [measure_server(args, preload, env) for _ in range(args.repeat)]
+            median = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+            print(f"{str(preload).lower():<8} {median['listen']:>9.2f} {median['ready']:>8.2f} "
+                  f"{median['page']:>8.1f} {median['static']:>10.1f} {median['query']:>9.1f} "
+                  f"{median['respawn']:>10.2f}", flush=True)
+    finally:
+        stop_process(backend)
+
+
+if __name__ == "__main__":
+    main()
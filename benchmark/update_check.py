@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Compare the keyword-based update check with rdflib's parseUpdate.
+
+Usage: python3 benchmark/update_check.py [--repeat N] [--queries DIR]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.query_check import UpdateChecker, has_update_keyword, strict_is_update
+
+
+def load_corpus(queries_dir):
+    corpus = {}
+    for name in sorted(os.listdir(queries_dir)):
+        if name.endswith(".rq"):
+            with open(os.path.join(queries_dir, name), encoding="utf-8") as f:
+                corpus[name] = f.read()
+
+    # A large lookup, of the kind that makes pyparsing stall a worker
+    block = "  OPTIONAL { ?br%d <http://purl.org/dc/terms/title> ?title%d . FILTER(?title%d != \"x\") }\n"
+    corpus["synthetic_50kb.rq"] = "SELECT * WHERE {\n%s}" % "".join(
+        block % (i, i, i) for i in range(600))
+    return corpus
+
+
+def timeit(fn, query, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        verdict = fn(query)
+    return (time.perf_counter() - start) / repeat * 1000, verdict
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query (default: 20)")
+    parser.add_argument(
+        "--queries",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries"),
+        help="directory of .rq files to use as corpus")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.queries)
+    memo = UpdateChecker()
+
+    print(f"{'query':<30} {'size':>8} {'parseUpdate':>12} {'keywords':>10} {'memo hit':>10}  verdict")
+    totals = [0, 0, 0]
+    for name, query in corpus.items():
+        strict_ms, strict_verdict = timeit(strict_is_update, query, args.repeat)
+        fast_ms, fast_verdict = timeit(has_update_keyword, query, args.repeat)
+        memo.is_update(query)
+        memo_ms, _ = timeit(memo.is_update, query, args.repeat)
+        totals[0] += strict_ms
+        totals[1] += fast_ms
+        totals[2] += memo_ms
+
+        verdict = "update" if fast_verdict else "query"
+        if fast_verdict != strict_verdict:
+            verdict += " (parseUpdate disagrees)"
+        print(f"{name:<30} {len(query):>8} {strict_ms:>10.3f}ms {fast_ms:>8.3f}ms {memo_ms:>8.3f}ms  {verdict}")
+
+    print(f"{'total':<30} {'':>8} {totals[0]:>10.3f}ms {totals[1]:>8.3f}ms {totals[2]:>8.3f}ms")
+    print(f"Speed-up of the keyword check: {totals[0] / totals[1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
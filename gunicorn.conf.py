@@ -1,6 +1,8 @@
+import gc
 import os
 import sys
-import subprocess
+import json
+import shutil
 
 # Worker configuration
 workers = 5
@@ -13,6 +15,22 @@ bind = "0.0.0.0:8080"
 max_requests = 1000
 max_requests_jitter = 50
 
+# The master imports the application and warms it up (see warm_up in
+# sparql_oc.py) once: workers, including those replacing the ones recycled
+# by max_requests, are forked with it ready instead of each loading it
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
+
+# The application is then imported in the master, which must be patched by
+# gevent as the workers are, unless the ASGI front end is run
+# (-k uvicorn.workers.UvicornWorker)
+if preload_app and "uvicorn" not in " ".join(sys.argv + [os.getenv("GUNICORN_CMD_ARGS", "")]):
+    from gevent import monkey
+    monkey.patch_all()
+
+# Metrics of all the workers are collected through files in this directory,
+# see src/metrics.py
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/dev/shm/oc_sparql_metrics")
+
 # Logging
 accesslog = None
 errorlog = "-"
@@ -26,28 +44,69 @@ def on_starting(server):
     print("=" * 60)
     print("Gunicorn master process starting...")
     print("=" * 60)
+
+    # Metrics of a previous run must not be added to the new ones
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
     
     # Check if sync is enabled
     sync_enabled = os.getenv("SYNC_ENABLED", "false").lower() == "true"
     
     if sync_enabled:
+        from src.sync_schedule import run_sync, start_scheduler
+
         print("Static sync enabled - running sync before starting workers...")
-        try:
-            subprocess.run([sys.executable, "sync_static.py", "--auto"], check=True)
+        if run_sync():
             print("Static sync completed successfully!")
-        except subprocess.CalledProcessError as e:
-            print(f"ERROR: Static sync failed: {e}")
-        except Exception as e:
-            print(f"ERROR: Unexpected error during sync: {e}")
+
+        # Later syncs run in a separate process while the workers serve
+        # requests; the workers reload the files when a new release is
+        # activated
+        with open("conf.json") as f:
+            sync_interval = float(os.getenv("SYNC_INTERVAL", json.load(f)["sync"]["interval"]))
+        if sync_interval > 0:
+            server.sync_process = start_scheduler(sync_interval)
     else:
         print("Static sync disabled")
+
+    app = sys.modules.get("sparql_oc")
+    if server.cfg.preload_app and app is not None:
+        # The application was loaded before the sync above
+        app.release_watcher.check(force=True)
+        print("Warming up the application before forking the workers...")
+        app.warm_up()
+        # Objects created so far are never collected, so that the collector
+        # does not copy the memory pages the workers share with the master
+        gc.freeze()
     
     print("=" * 60)
     print("Master process initialized - spawning workers...")
     print("=" * 60)
 
+def on_exit(server):
+    """
+    Called just before the master process exits.
+    """
+    sync_process = getattr(server, "sync_process", None)
+    if sync_process is not None:
+        sync_process.terminate()
+
 def post_worker_init(worker):
     """
     Called just after a worker has been initialized.
     """
-    print(f"Worker {worker.pid} initialized and ready")
\ No newline at end of file
+    # Background threads are started in the worker, since those of the
+    # master would not survive the fork (or, patched by gevent, would run
+    # in every worker)
+    app = sys.modules.get("sparql_oc")
+    if app is not None:
+        app.backends.start()
+    print(f"Worker {worker.pid} initialized and ready")
+
+def child_exit(server, worker):
+    """
+    Called in the master process after a worker has exited.
+    """
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,14 +1,31 @@
 import web
 import os
 import json
-from src.wl import WebLogger
+import time
+import select
+import socket
+import queue
+import threading
 import requests
+from urllib3.exceptions import ReadTimeoutError, ProtocolError
+from src.wl import WebLogger
+from src.upstream import get_pool
+from src.balancer import Balancer, parse_endpoints
+from src.cache import create_cache, FileCache
+from src.query_check import create_update_checker, estimate_cost, PooledUpdateChecker
+from src.static_assets import AssetIndex, ReleaseWatcher
+from src.page_cache import PageCache
+from src.admission import create_admission, client_ip, AdmissionRejected, ClientTokens
+from src.single_flight import SingleFlight, Flight, FlightFailed, WorkerLocks
+from src import metrics
+from src.health import BackendMonitor, CircuitOpen
+from src.deadlines import Deadlines, DeadlineExceeded
+from src.compression import StreamCompressor, available_encodings
+from src.sync_schedule import run_sync, start_scheduler
+from src.batch import Batch, BatchError, result_line
+from src.stored_queries import load_stored_queries
+from src.pipeline import Pipeline, QueryRefused
 import urllib.parse as urlparse
-import re
-from urllib.parse import parse_qs
-from rdflib.plugins.sparql.parser import parseUpdate
-import subprocess
-import sys
 import argparse
 
 # Load the configuration file
@@ -22,7 +39,148 @@ env_config = {
     "base_url": os.getenv("BASE_URL", c["base_url"]),
     "sparql_endpoint_index": os.getenv("SPARQL_ENDPOINT_INDEX", c["sparql_endpoint_index"]),
     "sparql_endpoint_meta": os.getenv("SPARQL_ENDPOINT_META", c["sparql_endpoint_meta"]),
-    "sync_enabled": os.getenv("SYNC_ENABLED", "false").lower() == "true"
+    "sync_enabled": os.getenv("SYNC_ENABLED", "false").lower() == "true",
+    "sync_interval": float(os.getenv("SYNC_INTERVAL", c["sync"]["interval"])),
+    "stream_results": str(os.getenv("STREAM_RESULTS", c["stream_results"])).lower() == "true",
+    "stream_chunk_size": int(os.getenv("STREAM_CHUNK_SIZE", c["stream_chunk_size"])),
+    "balancing": {
+        "strategy": os.getenv("BALANCING_STRATEGY", c["balancing"]["strategy"]),
+        "affinity": str(os.getenv("BALANCING_AFFINITY", c["balancing"]["affinity"])).lower() == "true",
+        "max_failures": int(os.getenv("BALANCING_MAX_FAILURES", c["balancing"]["max_failures"])),
+        "eject_time": float(os.getenv("BALANCING_EJECT_TIME", c["balancing"]["eject_time"])),
+        "latency_decay": float(c["balancing"]["latency_decay"])
+    },
+    "upstream": {
+        "pool_size": int(os.getenv("UPSTREAM_POOL_SIZE", c["upstream"]["pool_size"])),
+        "keep_alive": str(os.getenv("UPSTREAM_KEEP_ALIVE", c["upstream"]["keep_alive"])).lower() == "true",
+        "idle_timeout": float(os.getenv("UPSTREAM_IDLE_TIMEOUT", c["upstream"]["idle_timeout"])),
+        "retries": int(os.getenv("UPSTREAM_RETRIES", c["upstream"]["retries"]))
+    },
+    "timeouts": {
+        "index": {
+            "connect": float(os.getenv("TIMEOUT_CONNECT_INDEX", c["timeouts"]["index"]["connect"])),
+            "read": float(os.getenv("TIMEOUT_READ_INDEX", c["timeouts"]["index"]["read"])),
+            "total": float(os.getenv("TIMEOUT_TOTAL_INDEX", c["timeouts"]["index"]["total"])),
+            "hint_unit": c["timeouts"]["index"]["hint_unit"]
+        },
+        "meta": {
+            "connect": float(os.getenv("TIMEOUT_CONNECT_META", c["timeouts"]["meta"]["connect"])),
+            "read": float(os.getenv("TIMEOUT_READ_META", c["timeouts"]["meta"]["read"])),
+            "total": float(os.getenv("TIMEOUT_TOTAL_META", c["timeouts"]["meta"]["total"])),
+            "hint_unit": c["timeouts"]["meta"]["hint_unit"]
+        }
+    },
+    "transcode": {
+        "enabled": str(os.getenv("TRANSCODE_ENABLED", c["transcode"]["enabled"])).lower() == "true",
+        "native": {
+            "index": [name.strip() for name in os.getenv("TRANSCODE_NATIVE_INDEX", ",".join(c["transcode"]["native"]["index"])).split(",") if name.strip()],
+            "meta": [name.strip() for name in os.getenv("TRANSCODE_NATIVE_META", ",".join(c["transcode"]["native"]["meta"])).split(",") if name.strip()]
+        }
+    },
+    "query_cost": {
+        "enabled": str(os.getenv("QUERY_COST_ENABLED", c["query_cost"]["enabled"])).lower() == "true",
+        "threshold": int(os.getenv("QUERY_COST_THRESHOLD", c["query_cost"]["threshold"])),
+        "heavy_max_in_flight": {
+            "index": int(os.getenv("QUERY_COST_HEAVY_MAX_IN_FLIGHT_INDEX", c["query_cost"]["heavy_max_in_flight"]["index"])),
+            "meta": int(os.getenv("QUERY_COST_HEAVY_MAX_IN_FLIGHT_META", c["query_cost"]["heavy_max_in_flight"]["meta"]))
+        },
+        "heavy_timeouts": {
+            "index": {
+                "read": float(os.getenv("QUERY_COST_HEAVY_TIMEOUT_READ_INDEX", c["query_cost"]["heavy_timeouts"]["index"]["read"])),
+                "total": float(os.getenv("QUERY_COST_HEAVY_TIMEOUT_TOTAL_INDEX", c["query_cost"]["heavy_timeouts"]["index"]["total"]))
+            },
+            "meta": {
+                "read": float(os.getenv("QUERY_COST_HEAVY_TIMEOUT_READ_META", c["query_cost"]["heavy_timeouts"]["meta"]["read"])),
+                "total": float(os.getenv("QUERY_COST_HEAVY_TIMEOUT_TOTAL_META", c["query_cost"]["heavy_timeouts"]["meta"]["total"]))
+            }
+        }
+    },
+    "compression": {
+        "enabled": str(os.getenv("COMPRESSION_ENABLED", c["compression"]["enabled"])).lower() == "true",
+        "encodings": [name.strip() for name in os.getenv("COMPRESSION_ENCODINGS", ",".join(c["compression"]["encodings"])).split(",") if name.strip()],
+        "min_size": int(os.getenv("COMPRESSION_MIN_SIZE", c["compression"]["min_size"])),
+        "gzip_level": int(os.getenv("COMPRESSION_GZIP_LEVEL", c["compression"]["gzip_level"])),
+        "brotli_quality": int(os.getenv("COMPRESSION_BROTLI_QUALITY", c["compression"]["brotli_quality"])),
+        "zstd_level": int(os.getenv("COMPRESSION_ZSTD_LEVEL", c["compression"]["zstd_level"]))
+    },
+    "cache": {
+        "enabled": str(os.getenv("CACHE_ENABLED", c["cache"]["enabled"])).lower() == "true",
+        "backend": os.getenv("CACHE_BACKEND", c["cache"]["backend"]),
+        "dir": os.getenv("CACHE_DIR", c["cache"]["dir"]),
+        "max_entries": int(os.getenv("CACHE_MAX_ENTRIES", c["cache"]["max_entries"])),
+        "max_bytes": int(os.getenv("CACHE_MAX_BYTES", c["cache"]["max_bytes"])),
+        "max_item_bytes": int(os.getenv("CACHE_MAX_ITEM_BYTES", c["cache"]["max_item_bytes"])),
+        "ttl": {
+            "index": int(os.getenv("CACHE_TTL_INDEX", c["cache"]["ttl"]["index"])),
+            "meta": int(os.getenv("CACHE_TTL_META", c["cache"]["ttl"]["meta"]))
+        }
+    },
+    "update_check": {
+        "strict": str(os.getenv("UPDATE_CHECK_STRICT", c["update_check"]["strict"])).lower() == "true",
+        "memo_size": int(os.getenv("UPDATE_CHECK_MEMO_SIZE", c["update_check"]["memo_size"])),
+        "mode": os.getenv("UPDATE_CHECK_MODE", c["update_check"]["mode"]),
+        "workers": int(os.getenv("UPDATE_CHECK_WORKERS", c["update_check"]["workers"])),
+        "timeout": float(os.getenv("UPDATE_CHECK_TIMEOUT", c["update_check"]["timeout"])),
+        "max_pending": int(os.getenv("UPDATE_CHECK_MAX_PENDING", c["update_check"]["max_pending"]))
+    },
+    "static": {
+        "max_age": int(os.getenv("STATIC_MAX_AGE", c["static"]["max_age"])),
+        "compress_min_size": c["static"]["compress_min_size"],
+        "gzip_level": c["static"]["gzip_level"],
+        "brotli_quality": c["static"]["brotli_quality"]
+    },
+    "pages": {
+        "max_entries": int(os.getenv("PAGES_MAX_ENTRIES", c["pages"]["max_entries"])),
+        "check_interval": float(os.getenv("PAGES_CHECK_INTERVAL", c["pages"]["check_interval"]))
+    },
+    "admission": {
+        "enabled": str(os.getenv("ADMISSION_ENABLED", c["admission"]["enabled"])).lower() == "true",
+        "path": os.getenv("ADMISSION_PATH", c["admission"]["path"]),
+        "trusted_proxies": int(os.getenv("ADMISSION_TRUSTED_PROXIES", c["admission"]["trusted_proxies"])),
+        "client_header": os.getenv("ADMISSION_CLIENT_HEADER", c["admission"]["client_header"]),
+        "rate": float(os.getenv("ADMISSION_RATE", c["admission"]["rate"])),
+        "burst": float(os.getenv("ADMISSION_BURST", c["admission"]["burst"])),
+        "max_in_flight": {
+            "index": int(os.getenv("ADMISSION_MAX_IN_FLIGHT_INDEX", c["admission"]["max_in_flight"]["index"])),
+            "meta": int(os.getenv("ADMISSION_MAX_IN_FLIGHT_META", c["admission"]["max_in_flight"]["meta"]))
+        },
+        "max_queue": int(os.getenv("ADMISSION_MAX_QUEUE", c["admission"]["max_queue"])),
+        "queue_timeout": float(os.getenv("ADMISSION_QUEUE_TIMEOUT", c["admission"]["queue_timeout"])),
+        "retry_after": int(os.getenv("ADMISSION_RETRY_AFTER", c["admission"]["retry_after"])),
+        "exempt": [ip.strip() for ip in os.getenv("ADMISSION_EXEMPT", ",".join(c["admission"]["exempt"])).split(",") if ip.strip()]
+    },
+    "health": {
+        "interval": float(os.getenv("HEALTH_INTERVAL", c["health"]["interval"])),
+        "timeout": float(os.getenv("HEALTH_TIMEOUT", c["health"]["timeout"])),
+        "degraded_ms": float(os.getenv("HEALTH_DEGRADED_MS", c["health"]["degraded_ms"])),
+        "failure_threshold": int(os.getenv("HEALTH_FAILURE_THRESHOLD", c["health"]["failure_threshold"])),
+        "reset_timeout": float(os.getenv("HEALTH_RESET_TIMEOUT", c["health"]["reset_timeout"])),
+        "required": [name.strip() for name in os.getenv("HEALTH_REQUIRED", ",".join(c["health"]["required"])).split(",") if name.strip()],
+        "probe_query": os.getenv("HEALTH_PROBE_QUERY", c["health"]["probe_query"])
+    },
+    "log": {
+        "enabled": str(os.getenv("LOG_ENABLED", c["log"]["enabled"])).lower() == "true",
+        "json_lines": str(os.getenv("LOG_JSON", c["log"]["json_lines"])).lower() == "true",
+        "batch_size": int(os.getenv("LOG_BATCH_SIZE", c["log"]["batch_size"])),
+        "flush_interval": float(os.getenv("LOG_FLUSH_INTERVAL", c["log"]["flush_interval"])),
+        "max_queue": int(os.getenv("LOG_MAX_QUEUE", c["log"]["max_queue"]))
+    },
+    "single_flight": {
+        "enabled": str(os.getenv("SINGLE_FLIGHT_ENABLED", c["single_flight"]["enabled"])).lower() == "true",
+        "max_buffer": int(os.getenv("SINGLE_FLIGHT_MAX_BUFFER", c["single_flight"]["max_buffer"])),
+        "cross_workers": str(os.getenv("SINGLE_FLIGHT_CROSS_WORKERS", c["single_flight"]["cross_workers"])).lower() == "true",
+        "lock_dir": os.getenv("SINGLE_FLIGHT_LOCK_DIR", c["single_flight"]["lock_dir"]),
+        "wait": float(os.getenv("SINGLE_FLIGHT_WAIT", c["single_flight"]["wait"]))
+    },
+    "batch": {
+        "enabled": str(os.getenv("BATCH_ENABLED", c["batch"]["enabled"])).lower() == "true",
+        "concurrency": int(os.getenv("BATCH_CONCURRENCY", c["batch"]["concurrency"])),
+        "max_queries": int(os.getenv("BATCH_MAX_QUERIES", c["batch"]["max_queries"]))
+    },
+    "stored_queries": {
+        "enabled": str(os.getenv("STORED_QUERIES_ENABLED", c["stored_queries"]["enabled"])).lower() == "true",
+        "path": os.getenv("STORED_QUERIES_PATH", c["stored_queries"]["path"])
+    }
 }
 
 
@@ -42,37 +200,306 @@ active = {
     "search": "querying"
 }
 
+# Content types of the static files
+static_content_types = {
+    '.css': 'text/css',
+    '.js': 'application/javascript',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+    '.otf': 'font/otf',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.map': 'application/json',
+    '.json': 'application/json',
+    '.html': 'text/html',
+    '.txt': 'text/plain',
+}
+
 # URL Mapping
 urls = (
     "/", "Main",
     "/static/(.*)", "Static",
     "/health", "Health",
+    "/ready", "Ready",
     "/meta", "SparqlMeta",
     '/favicon.ico', 'Favicon',
-    "/index", "SparqlIndex"
+    "/metrics", "Metrics",
+    "/index", "SparqlIndex",
+    "/index/batch", "SparqlIndexBatch",
+    "/meta/batch", "SparqlMetaBatch",
+    "/index/q", "SparqlIndexStored",
+    r"/index/q/([\w-]+)", "SparqlIndexStored",
+    "/meta/q", "SparqlMetaStored",
+    r"/meta/q/([\w-]+)", "SparqlMetaStored"
 )
 
 # Set the web logger
-# web_logger = WebLogger(env_config["base_url"], env_config["log_dir"], [
-#     "HTTP_X_FORWARDED_FOR", # The IP address of the client
-#     "REMOTE_ADDR",          # The IP address of internal balancer
-#     "HTTP_USER_AGENT",      # The browser type of the visitor
-#     "HTTP_REFERER",         # The URL of the page that called your program
-#     "HTTP_HOST",            # The hostname of the page being attempted
-#     "REQUEST_URI",          # The interpreted pathname of the requested document
-#                             # or CGI (relative to the document root)
-#     "HTTP_AUTHORIZATION",   # Access token
-#     ],
-#     # comment this line only for test purposes
-#      {"REMOTE_ADDR": ["130.136.130.1", "130.136.2.47", "127.0.0.1"]}
-# )
-
-render = web.template.render(c["html"], globals={
+web_logger = None
+if env_config["log"]["enabled"]:
+    web_logger = WebLogger(env_config["base_url"], env_config["log_dir"], [
+        "HTTP_X_FORWARDED_FOR", # The IP address of the client
+        "REMOTE_ADDR",          # The IP address of internal balancer
+        "HTTP_USER_AGENT",      # The browser type of the visitor
+        "HTTP_REFERER",         # The URL of the page that called your program
+        "HTTP_HOST",            # The hostname of the page being attempted
+        "REQUEST_URI",          # The interpreted pathname of the requested document
+                                # or CGI (relative to the document root)
+        "HTTP_AUTHORIZATION",   # Access token
+        ],
+        # comment this line only for test purposes
+        {"REMOTE_ADDR": ["130.136.130.1", "130.136.2.47", "127.0.0.1"]},
+        json_lines=env_config["log"]["json_lines"],
+        batch_size=env_config["log"]["batch_size"],
+        flush_interval=env_config["log"]["flush_interval"],
+        max_queue=env_config["log"]["max_queue"]
+    )
+
+
+def log_request(env=None, **fields):
+    """Log a request, if the web logger is enabled"""
+    if web_logger is not None:
+        web_logger.mes(env, **fields)
+
+# Detection of SPARQL Update requests, which are not permitted
+update_checker = create_update_checker(env_config["update_check"])
+
+# Cache of the results returned by the SPARQL backends
+result_cache = create_cache(env_config["cache"])
+
+# Queries whose estimated cost reaches the threshold run in the heavy lane
+# of their endpoint, which has its own concurrency limit and timeouts
+heavy_lanes = {}
+if env_config["query_cost"]["enabled"]:
+    heavy_lanes = {"index": "index_heavy", "meta": "meta_heavy"}
+
+# Limits on the queries sent to the SPARQL backends, shared by all the workers.
+# The heavy lanes keep their concurrency limit when the rest of the admission
+# control (the rate limit of the clients and the limits of the endpoints) is
+# disabled, so that expensive queries are isolated in any case
+admission_conf = dict(env_config["admission"], max_in_flight=dict(env_config["admission"]["max_in_flight"]))
+if heavy_lanes and not admission_conf["enabled"]:
+    admission_conf.update(enabled=True, rate=0, max_in_flight={})
+for name, lane in heavy_lanes.items():
+    admission_conf["max_in_flight"][lane] = env_config["query_cost"]["heavy_max_in_flight"][name]
+admission = create_admission(admission_conf, ["index", "meta"] + list(heavy_lanes.values()))
+
+# Replicas of each backend, given as comma-separated URLs
+replicas = {
+    "index": parse_endpoints(env_config["sparql_endpoint_index"]),
+    "meta": parse_endpoints(env_config["sparql_endpoint_meta"])
+}
+
+# Choice of the replica running each query, within each worker
+balancers = {name: Balancer(urls, **env_config["balancing"]) for name, urls in replicas.items()}
+
+# Status of the backends, probed in the background, and their circuit breakers.
+# The prober is started by each worker (see post_worker_init in
+# gunicorn.conf.py), not at import, since with preload_app the application
+# is imported by the Gunicorn master, whose greenlets the workers inherit
+backends = BackendMonitor(replicas, **env_config["health"])
+
+# Time limits of the queries sent to each backend, and to its heavy lane
+deadlines = {name: Deadlines(**conf) for name, conf in env_config["timeouts"].items()}
+for name, lane in heavy_lanes.items():
+    deadlines[lane] = Deadlines(**dict(
+        env_config["timeouts"][name], **env_config["query_cost"]["heavy_timeouts"][name]))
+
+
+def query_lane(endpoint, query, estimate=None):
+    """Return the lane of a query sent to endpoint, and the X-Query-Cost header describing its cost.
+
+    estimate is the (cost, features) of the query, if already known.
+    """
+    if endpoint not in heavy_lanes:
+        return endpoint, None
+    cost, features = estimate or estimate_cost(query)
+    heavy = cost >= env_config["query_cost"]["threshold"]
+    metrics.query_costs.labels(endpoint, "heavy" if heavy else "light").inc()
+    header = "%s; score=%d" % ("heavy" if heavy else "light", cost)
+    if features:
+        header += "; features=" + ",".join(features)
+    return heavy_lanes[endpoint] if heavy else endpoint, header
+
+# Named queries of each endpoint, whose templates are checked once here
+stored_queries = {"index": {}, "meta": {}}
+if env_config["stored_queries"]["enabled"]:
+    stored_queries = load_stored_queries(
+        env_config["stored_queries"]["path"], list(stored_queries), env_config["update_check"]["strict"])
+
+# Content-Encodings of the query results, in order of preference, and their levels
+result_encodings = []
+if env_config["compression"]["enabled"]:
+    result_encodings = available_encodings(env_config["compression"]["encodings"])
+compression_levels = {
+    "gzip": env_config["compression"]["gzip_level"],
+    "br": env_config["compression"]["brotli_quality"],
+    "zstd": env_config["compression"]["zstd_level"]
+}
+
+# Steps of the handling of the queries of each endpoint, shared with the ASGI front end
+pipelines = {
+    title: Pipeline(
+        title, env_config["sparql_endpoint_" + title], update_checker, query_lane, deadlines, result_cache,
+        env_config["transcode"]["native"][title] if env_config["transcode"]["enabled"] else None,
+        result_encodings, compression_levels, env_config["compression"]["min_size"])
+    for title in ("index", "meta")
+}
+
+
+def refused(error):
+    """Return the web.py error answering a request refused by its pipeline"""
+    return web.HTTPError("%d " % error.status, error.headers, str(error))
+
+def readiness():
+    """Return (ready, body) of the readiness report: the last probes of the backends,
+    and the replicas of each one as seen by the balancer of this worker"""
+    ready, report = backends.status()
+    for name, balancer in balancers.items():
+        report[name]["balancing"] = balancer.status()
+    return ready, json.dumps({"status": "ok" if ready else "unavailable", "backends": report})
+
+# Seconds between two checks of the connection of a client waiting for the
+# response of the backend
+DISCONNECT_CHECK_INTERVAL = 1
+
+
+def client_disconnected(env):
+    """Tell whether the client of a request closed its connection.
+
+    The connection is only known under gunicorn; it is readable without any
+    data once the client has closed it.
+    """
+    sock = env.get("gunicorn.socket") or env.get("gunicorn.sock")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # TLS sockets cannot be peeked
+        return False
+    except OSError:
+        return True
+
+
+def timeout_phase(error):
+    """Return the phase ("connect" or "read") of a requests timeout, or None for other errors"""
+    if isinstance(error, requests.ConnectTimeout):
+        return "connect"
+    if isinstance(error, requests.ReadTimeout):
+        return "read"
+    # Timeouts while reading the body are wrapped in a ConnectionError,
+    # unless the body is read from the raw response
+    if isinstance(error, requests.ConnectionError) and error.args and isinstance(error.args[0], ReadTimeoutError):
+        return "read"
+    if isinstance(error, ReadTimeoutError):
+        return "read"
+    return None
+
+def transport_error(error):
+    """Tell whether an error comes from the connection to a backend, rather than
+    from the processing of its response by the application"""
+    return isinstance(error, (requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                              requests.Timeout, ProtocolError, ReadTimeoutError))
+
+# Coalescing of identical concurrent queries, within each worker and, if the
+# result cache is shared, across workers
+flights = SingleFlight(Flight, env_config["single_flight"]["max_buffer"], env_config["single_flight"]["enabled"])
+worker_locks = None
+if env_config["single_flight"]["enabled"] and env_config["single_flight"]["cross_workers"]:
+    if result_cache is not None and isinstance(result_cache.backend, FileCache):
+        worker_locks = WorkerLocks(env_config["single_flight"]["lock_dir"], env_config["single_flight"]["wait"])
+    else:
+        print("Warning: coalescing queries across workers needs the file result cache, disabled")
+
+# Static files, served from memory
+static_assets = AssetIndex("static", static_content_types, **env_config["static"])
+static_assets.build()
+
+# Compiled templates are kept even with web.config.debug on, since
+# reset_templates forgets them when the files change
+render = web.template.render(c["html"], cache=True, globals={
     'str': str,
     'isinstance': isinstance,
+    'static_url': static_assets.url,
     'render': lambda *args, **kwargs: render(*args, **kwargs)
 })
 
+
+def reset_templates():
+    """Forget the compiled templates"""
+    render._cache.clear()
+
+
+# Landing pages, rendered once per template and subdomain
+rendered_pages = PageCache(
+    c["html"], on_change=reset_templates,
+    compress_min_size=env_config["static"]["compress_min_size"],
+    gzip_level=env_config["static"]["gzip_level"],
+    brotli_quality=env_config["static"]["brotli_quality"],
+    **env_config["pages"])
+
+
+def reload_static():
+    """Reload the static files after a sync, keeping those that did not change"""
+    count = static_assets.build()
+    # Pages embed the fingerprinted URLs of the static files, and templates
+    # may have been updated as well
+    rendered_pages.clear()
+    print(f"Reloaded {count} static files")
+
+
+def warm_up():
+    """Build the state that workers would otherwise build on their first requests.
+
+    Called in the Gunicorn master when the application is preloaded, so
+    that the workers are forked with it: the compressed static files, the
+    compiled templates and, for the inline strict update check, the rdflib
+    parser.
+    """
+    static_assets.warm()
+    for dirpath, _, filenames in os.walk(c["html"], followlinks=True):
+        renderer = render
+        for part in os.path.relpath(dirpath, c["html"]).split(os.sep):
+            if part != ".":
+                renderer = getattr(renderer, part)
+        for filename in filenames:
+            if filename.endswith(".html"):
+                getattr(renderer, filename[:-len(".html")])
+    if update_checker.strict and not isinstance(update_checker, PooledUpdateChecker):
+        from rdflib.plugins.sparql.parser import parseUpdate  # noqa: F401
+
+
+# Static files and templates synced in the background, see sync_static.py
+release_watcher = ReleaseWatcher(
+    os.path.join(c["sync"]["release_dir"], "current"), env_config["pages"]["check_interval"], reload_static)
+
+
+def serve_page(template, active, **kwargs):
+    """Return a landing page from rendered_pages, answering conditional requests with 304"""
+    current_subdomain = web.ctx.host.split('.')[0].lower()
+    release_watcher.check()
+    status, headers, body = rendered_pages.respond(
+        (template, active, current_subdomain),
+        lambda: getattr(render, template)(
+            active=active, current_subdomain=current_subdomain, render=render, **kwargs),
+        web.ctx.env.get('HTTP_IF_NONE_MATCH'),
+        web.ctx.env.get('HTTP_IF_MODIFIED_SINCE'),
+        web.ctx.env.get('HTTP_ACCEPT_ENCODING'))
+
+    # Rendering a template sets the Content-Type header already
+    for name, value in headers.items():
+        web.header(name, value, unique=True)
+    if status == 304:
+        raise web.notmodified()
+    return body
+
 # App Web.py
 app = web.application(urls, globals())
 
@@ -83,14 +510,9 @@ def sync_static_files():
     """
     Function to synchronize static files using sync_static.py
     """
-    try:
-        print("Starting static files synchronization...")
-        subprocess.run([sys.executable, "sync_static.py", "--auto"], check=True)
+    print("Starting static files synchronization...")
+    if run_sync():
         print("Static files synchronization completed")
-    except subprocess.CalledProcessError as e:
-        print(f"Error during static files synchronization: {e}")
-    except Exception as e:
-        print(f"Unexpected error during synchronization: {e}")
 
 
 # Process favicon.ico requests
@@ -110,6 +532,22 @@ class Health:
         web.header('Content-Type', 'application/json')
         return '{"status": "ok"}'
 
+class Ready:
+    """Readiness check for Kubernetes probes, based on the last probes of the backends"""
+    def GET(self):
+        ready, body = readiness()
+        if not ready:
+            raise web.HTTPError("503 ", {"Content-Type": "application/json"}, body)
+        web.header('Content-Type', 'application/json')
+        return body
+
+class Metrics:
+    """Prometheus metrics, aggregated across the gunicorn workers"""
+    def GET(self):
+        body, content_type = metrics.collect()
+        web.header('Content-Type', content_type)
+        return body
+
 class Header:
     def GET(self):
         current_subdomain = web.ctx.host.split('.')[0].lower()
@@ -121,9 +559,10 @@ class Sparql:
         self.sparql_endpoint_title = sparql_endpoint_title
         self.yasqe_sparql_endpoint = yasqe_sparql_endpoint
         self.collparam = ["query"]
+        self.balancer = balancers[sparql_endpoint_title]
+        self.pipeline = pipelines[sparql_endpoint_title]
 
     def GET(self):
-        #web_logger.mes()
         content_type = web.ctx.env.get('CONTENT_TYPE')
         return self.__run_query_string(self.sparql_endpoint_title, web.ctx.env.get("QUERY_STRING"), content_type)
 
@@ -134,80 +573,460 @@ class Sparql:
         if "application/x-www-form-urlencoded" in content_type:
             return self.__run_query_string(active["sparql"], cur_data, True, content_type)
         elif "application/sparql-query" in content_type:
-            isupdate = None
-            isupdate, sanitizedQuery = self.__is_update_query(cur_data)
-            if not isupdate:
-                return self.__contact_tp(cur_data, True, content_type)
-            else:
-                raise web.HTTPError(
-                    "403 ",
-                    {"Content-Type": "text/plain"},
-                    "SPARQL Update queries are not permitted."
-                )
+            try:
+                self.pipeline.check_update(cur_data)
+                # The timeout of the query can be given in the URL
+                query = self.pipeline.plan_query_body(cur_data, web.ctx.env.get("QUERY_STRING"), content_type)
+            except QueryRefused as e:
+                raise refused(e)
+            return self.__contact_tp(query, True)
         else:
             raise web.redirect("/")
 
-    def __contact_tp(self, data, is_post, content_type):
-        accept = web.ctx.env.get('HTTP_ACCEPT')
-        if accept is None or accept == "*/*" or accept == "":
-            accept = "application/sparql-results+xml"
-        if is_post:
-            req = requests.post(self.sparql_endpoint, data=data,
-                              headers={'content-type': content_type, "accept": accept})
-        else:
-            req = requests.get("%s?%s" % (self.sparql_endpoint, data),
-                             headers={'content-type': content_type, "accept": accept})
+    def run_batch(self):
+        """Run the queries of a batch, streaming their results as NDJSON lines in the order they complete"""
+        if not env_config["batch"]["enabled"]:
+            raise web.notfound()
+        try:
+            batch = Batch(web.data(), env_config["batch"]["max_queries"])
+            deadlines[self.sparql_endpoint_title].budget(batch.timeout)
+        except BatchError as e:
+            raise web.HTTPError(str(e.status) + " ", {"Content-Type": "text/plain"}, str(e))
+        except ValueError as e:
+            raise web.HTTPError("400 ", {"Content-Type": "text/plain"}, str(e))
+        try:
+            for query in batch.checked:
+                self.pipeline.check_update(query)
+        except QueryRefused as e:
+            raise refused(e)
+        # Each query not answered from the cache takes a token from the
+        # client, the first one before the response starts, so that a client
+        # out of tokens is refused at once
+        self.__check_client()
+        tokens = ClientTokens(admission, self.__client_ip(), prepaid=1)
+        metrics.batches.labels(self.sparql_endpoint_title).inc()
+
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Access-Control-Allow-Credentials', 'true')
+        web.header('Content-Type', 'application/x-ndjson')
+        web.header('Vary', 'Accept-Encoding')
+        body = self.__batch_lines(batch, tokens, web.ctx.env)
+        encoding = self.pipeline.encoding(web.ctx.env.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is not None:
+            web.header('Content-Encoding', encoding)
+            body = self.__compress_lines(body, encoding)
+        if env_config["stream_results"]:
+            return body
+        return b"".join(body)
 
-        if req.status_code == 200:
+    def run_stored(self, name=None):
+        """Run the stored query name with the parameters of the URL, or list the stored queries"""
+        queries = stored_queries[self.sparql_endpoint_title]
+        if name is None:
+            log_request()
             web.header('Access-Control-Allow-Origin', '*')
-            web.header('Access-Control-Allow-Credentials', 'true')
-            if req.headers["content-type"] == "application/json":
-                web.header('Content-Type', 'application/sparql-results+json')
-            else:
-                web.header('Content-Type', req.headers["content-type"])
-            #web_logger.mes()
-            req.encoding = "utf-8"
-            return req.text
+            web.header('Content-Type', 'application/json')
+            return json.dumps({name: stored.describe() for name, stored in queries.items()}, indent=2)
+        stored = queries.get(name)
+        if stored is None:
+            raise web.notfound()
+        try:
+            query = self.pipeline.plan_stored(stored, web.ctx.env.get("QUERY_STRING"))
+        except QueryRefused as e:
+            raise refused(e)
+        return self.__contact_tp(query, True)
+
+    def __compress_lines(self, lines, encoding):
+        # The encoding is announced before the first line, so even a short
+        # batch is compressed
+        compressor = StreamCompressor(encoding, compression_levels, 0)
+        for line in lines:
+            yield compressor.feed(line)
+        yield compressor.close()
+
+    def __batch_lines(self, batch, tokens, env):
+        """Yield the result line of each query of batch as soon as it completes.
+
+        At most env_config["batch"]["concurrency"] queries run at the same
+        time, each in a thread of its own (a greenlet under gevent) going through the result
+        cache, the coalescing and the lane of the query as a single query
+        does, and taking a token of the client from tokens. When the client goes away,
+        the queries still running are abandoned and those not started are dropped.
+        """
+        pending = queue.Queue()
+        for item in enumerate(batch.items):
+            pending.put(item)
+        lines = queue.Queue()
+        stopped = threading.Event()
+
+        def work():
+            while not stopped.is_set():
+                try:
+                    index, (item_id, query) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    line = self.__batch_query(index, item_id, query, batch, tokens, env, stopped)
+                except Exception as e:
+                    line = result_line(index, item_id, 500, body=str(e).encode("utf-8"))
+                lines.put(line)
+
+        for _ in range(min(env_config["batch"]["concurrency"], len(batch.items))):
+            threading.Thread(target=work, daemon=True).start()
+        try:
+            for _ in batch.items:
+                while True:
+                    try:
+                        line = lines.get(timeout=DISCONNECT_CHECK_INTERVAL)
+                        break
+                    except queue.Empty:
+                        if client_disconnected(env):
+                            metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+                            return
+                yield line
+        except GeneratorExit:
+            metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+            raise
+        finally:
+            stopped.set()
+
+    def __batch_query(self, index, item_id, query, batch, tokens, env, stopped):
+        """Run a query of batch and return its result line, or None if the batch was stopped first"""
+        query = self.pipeline.plan_batch_query(query, batch.timeout)
+        # Results are cached as for single queries sent without Accept-Encoding
+        key = self.pipeline.key(batch.accept, query.cache_params)
+        fields = self.pipeline.log_fields(key, batch=index)
+
+        cache_key = key if result_cache is not None else None
+        cached = self.pipeline.cached(key)
+        if cached is not None:
+            res_content_type, body, _ = cached
+            metrics.observe_request(self.sparql_endpoint_title, 200, len(body))
+            log_request(env, status=200, bytes=len(body), cache="HIT", **fields)
+            return result_line(index, item_id, 200, res_content_type, body, "HIT")
+
+        try:
+            tokens.take()
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
+            log_request(env, status=e.status, bytes=0, **fields)
+            return result_line(index, item_id, e.status, body=str(e).encode("utf-8"))
+
+        flight, subscriber, leader = flights.join(key)
+        if leader:
+            threading.Thread(
+                target=self.__pump, args=(flight, key, query, True, batch.accept, cache_key, None),
+                daemon=True).start()
+        else:
+            metrics.coalesced.labels(self.sparql_endpoint_title).inc()
+        fields["coalesced"] = not leader
+
+        body = flight.follow(subscriber)
+        try:
+            while True:
+                response = flight.wait_response(subscriber, DISCONNECT_CHECK_INTERVAL)
+                if response is not None:
+                    break
+                if stopped.is_set():
+                    return None
+            status, headers = response
+            chunks = []
+            for chunk in body:
+                if stopped.is_set():
+                    return None
+                chunks.append(chunk)
+            content = b"".join(chunks)
+        except FlightFailed as e:
+            status, message = self.pipeline.gateway_error(flight, e)
+            content = message.encode("utf-8")
+            headers = {}
+        finally:
+            body.close()
+            flight.unsubscribe(subscriber)
+
+        metrics.observe_request(self.sparql_endpoint_title, status, len(content))
+        if cache_key is not None and status == 200:
+            fields["cache"] = "MISS"
+        log_request(env, status=status, bytes=len(content), upstream_ms=flight.latency, **fields)
+        return result_line(index, item_id, status, headers.get("Content-Type"), content, fields.get("cache"))
+
+    def __contact_tp(self, query, is_post):
+        """Answer a request for query, from the result cache or from the backend"""
+        accept = self.pipeline.accept(web.ctx.env.get('HTTP_ACCEPT'))
+        encoding = self.pipeline.encoding(web.ctx.env.get('HTTP_ACCEPT_ENCODING'))
+        key = self.pipeline.key(accept, query.cache_params, encoding)
+        cache_key = key if result_cache is not None else None
+        cached = self.pipeline.cached(key)
+        if cached is not None:
+            body = cached[1]
+            for name, value in self.pipeline.response_headers(
+                    self.pipeline.cached_headers(cached), query.cost, "HIT").items():
+                web.header(name, value)
+            metrics.observe_request(self.sparql_endpoint_title, 200, len(body))
+            log_request(status=200, bytes=len(body), **self.pipeline.log_fields(key, cache="HIT"))
+            return body
+
+        self.__check_client()
+        # Identical queries running at the same time share one upstream request
+        flight, subscriber, leader = flights.join(key)
+        if leader:
+            threading.Thread(
+                target=self.__pump, args=(flight, key, query, is_post, accept, cache_key, encoding),
+                daemon=True).start()
         else:
+            metrics.coalesced.labels(self.sparql_endpoint_title).inc()
+
+        fields = self.pipeline.log_fields(key, leader)
+        try:
+            # A client going away while the backend computes its query
+            # cannot be noticed by writing to it, so its connection is polled
+            while True:
+                response = flight.wait_response(subscriber, DISCONNECT_CHECK_INTERVAL)
+                if response is not None:
+                    break
+                if client_disconnected(web.ctx.env):
+                    flight.unsubscribe(subscriber)
+                    metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+                    log_request(status=499, bytes=0, **fields)
+                    return b""
+            status, headers = response
+            if status != 200:
+                # The flight can still fail while the error is read
+                error = b"".join(flight.follow(subscriber))
+        except FlightFailed as e:
+            status, message = self.pipeline.gateway_error(flight, e)
+            metrics.observe_request(self.sparql_endpoint_title, status, 0)
+            log_request(status=status, bytes=0, **fields)
+            raise web.HTTPError("%d " % status, {"Content-Type": "text/plain"}, message)
+        if status != 200:
+            metrics.observe_request(self.sparql_endpoint_title, status, len(error))
+            log_request(status=status, bytes=len(error), upstream_ms=flight.latency, **fields)
+            raise web.HTTPError(str(status) + " ", headers, error)
+
+        if cache_key is not None:
+            fields["cache"] = "MISS"
+        for name, value in self.pipeline.response_headers(headers, query.cost, fields.get("cache")).items():
+            web.header(name, value)
+        body = self.__track(flight, flight.follow(subscriber), web.ctx.env, fields)
+        if env_config["stream_results"]:
+            # web.py iterates generators lazily, so the upstream chunks
+            # are written to the client as soon as they arrive
+            return body
+        return b"".join(body)
+
+    def __track(self, flight, chunks, env, fields):
+        """Yield chunks, then log the request and count it in the metrics"""
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        except GeneratorExit:
+            # The server closes the body when writing to the client fails
+            metrics.client_disconnects.labels(self.sparql_endpoint_title).inc()
+            raise
+        finally:
+            metrics.observe_request(self.sparql_endpoint_title, 200, size)
+            log_request(env, status=200, bytes=size, upstream_ms=flight.latency, **fields)
+
+    def __client_ip(self):
+        return client_ip(
+            web.ctx.env.get("HTTP_" + env_config["admission"]["client_header"].upper().replace("-", "_")),
+            web.ctx.env.get('REMOTE_ADDR'),
+            env_config["admission"]["trusted_proxies"])
+
+    def __check_client(self):
+        """Refuse the request if its client sent too many queries"""
+        if admission is None:
+            return
+        try:
+            admission.check_client(self.__client_ip())
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
             raise web.HTTPError(
-                str(req.status_code)+" ", {"Content-Type": req.headers["content-type"]}, req.text)
+                str(e.status) + " ",
+                {"Content-Type": "text/plain", "Retry-After": str(e.retry_after)},
+                str(e)
+            )
+
+    def __pump(self, flight, key, query, is_post, accept, cache_key, encoding):
+        """Send query to a replica of the backend and publish its response to flight.
+
+        It runs in a greenlet of its own, so that the upstream request does
+        not depend on the client that started it; it is aborted only when
+        all the requests following the flight are gone, or when it is still
+        running after the budget of the query.
+
+        The response is converted, compressed and collected for the result
+        cache as it arrives by a pipeline.ResultStream. With worker_locks,
+        the query is sent by one worker at a time: the others wait for it and
+        then look for its result in the cache.
+
+        Failures of the backend (5xx responses, connection errors and
+        timeouts, but not errors processing its response) count both for
+        the circuit breaker of the backend and for the replica that ran the
+        query, which the balancer ejects after too many of them. The concurrency limit and the timeouts are the ones of
+        the lane of the query.
+        """
+        req = ticket = lock = timer = replica = ttfb = None
+        failed = False
+        in_flight = metrics.upstream_in_flight.labels(self.sparql_endpoint_title)
+        started = None
+        expired = False
+        # A deadline shortened by the client says nothing about the backend
+        hinted = query.budget < deadlines[query.lane].total
+
+        def failure():
+            nonlocal failed
+            failed = True
+            backends.breaker(self.sparql_endpoint_title).failure()
+
+        def expire():
+            nonlocal expired
+            expired = True
+            metrics.upstream_timeouts.labels(self.sparql_endpoint_title, "total").inc()
+            if not hinted:
+                failure()
+            flight.finish(DeadlineExceeded(self.sparql_endpoint_title, "total"))
+            if req is not None:
+                req.close()
 
-    def __is_update_query(self, query):
-        query = re.sub(r'^\s*#.*$', '', query, flags=re.MULTILINE)
-        query = '\n'.join(line for line in query.splitlines() if line.strip()) 
         try:
-            parseUpdate(query)
-            return True, 'UPDATE query not allowed'
-        except Exception:
-            return False, query
+            if worker_locks is not None and cache_key is not None:
+                lock, waited = worker_locks.acquire(key, time.sleep)
+                cached = result_cache.get(cache_key) if waited else None
+                if cached is not None:
+                    flight.start(200, self.pipeline.cached_headers(cached), cached[1])
+                    return
+
+            backends.check(self.sparql_endpoint_title)
+            if admission is not None:
+                ticket = admission.acquire(query.lane)
+            if flight.abandoned:
+                return
+            replica = self.balancer.acquire(query.query)
+            metrics.replica_requests.labels(self.sparql_endpoint_title, replica.url).inc()
+            url = replica.url if query.url_query is None else "%s?%s" % (replica.url, query.url_query)
+            pool = get_pool(replica.url, **env_config["upstream"])
+            in_flight.inc()
+            started = time.monotonic()
+            timer = threading.Timer(query.budget, expire)
+            timer.daemon = True
+            timer.start()
+            headers, conversion = self.pipeline.upstream_headers(accept, query.query, query.content_type, encoding)
+            timeout = deadlines[query.lane].timeouts(query.budget)
+            if is_post:
+                req = pool.request("POST", url, data=query.data, stream=True, headers=headers, timeout=timeout)
+            else:
+                req = pool.request("GET", "%s?%s" % (url, query.data), stream=True, headers=headers, timeout=timeout)
+            ttfb = time.monotonic() - started
+            flight.latency = round(ttfb * 1000, 1)
+            metrics.upstream_ttfb.labels(self.sparql_endpoint_title).observe(ttfb)
+            flight.on_abandon = req.close
+            if flight.abandoned or expired:
+                return
+
+            breaker = backends.breaker(self.sparql_endpoint_title)
+            if req.status_code >= 500:
+                if not hinted:
+                    failure()
+            else:
+                breaker.success()
+            if req.status_code != 200:
+                flight.start(req.status_code, {"Content-Type": req.headers.get("content-type", "text/plain")}, req.content)
+                return
+            # requests decodes the body, unless it is forwarded as it is
+            stream = self.pipeline.result_stream(
+                req.headers["content-type"], req.headers.get("content-encoding"), conversion, encoding, cache_key)
+            if stream.forward:
+                body = req.raw.stream(env_config["stream_chunk_size"], decode_content=False)
+            else:
+                body = req.iter_content(chunk_size=env_config["stream_chunk_size"])
+
+            # With a compressor, the response starts once it knows whether
+            # the result is large enough to be compressed
+            responded = False
+
+            def publish(chunk):
+                nonlocal responded
+                if not responded:
+                    responded = True
+                    flight.start(200, stream.response_headers())
+                return flight.feed(chunk) if chunk else True
+
+            if stream.ready:
+                publish(b"")
+            received = metrics.upstream_bytes.labels(self.sparql_endpoint_title)
+            for chunk in body:
+                if chunk:
+                    received.inc(len(chunk))
+                    chunk = stream.feed(chunk)
+                    if chunk and not publish(chunk):
+                        return
+            if not publish(stream.close()):
+                return
+            metrics.upstream_duration.labels(self.sparql_endpoint_title).observe(time.monotonic() - started)
+            self.pipeline.store(cache_key, stream)
+        except AdmissionRejected as e:
+            metrics.admission_rejections.labels(self.sparql_endpoint_title, str(e.status)).inc()
+            flight.start(e.status, {"Content-Type": "text/plain", "Retry-After": str(e.retry_after)},
+                         str(e).encode("utf-8"))
+        except CircuitOpen as e:
+            metrics.circuit_rejections.labels(self.sparql_endpoint_title).inc()
+            flight.start(503, {"Content-Type": "text/plain", "Retry-After": str(e.retry_after)},
+                         str(e).encode("utf-8"))
+        except Exception as e:
+            # Once the flight is abandoned or expired, errors come from closing req
+            if not flight.abandoned and not expired:
+                phase = timeout_phase(e)
+                if phase is not None:
+                    metrics.upstream_timeouts.labels(self.sparql_endpoint_title, phase).inc()
+                    e = DeadlineExceeded(self.sparql_endpoint_title, phase)
+                    if not hinted:
+                        failure()
+                elif transport_error(e):
+                    failure()
+                else:
+                    # Errors converting or compressing the result say
+                    # nothing about the health of the backend
+                    print(f"ERROR: Processing the result of {self.sparql_endpoint_title} failed: {e!r}")
+                flight.finish(e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            flight.finish()
+            flights.forget(key, flight)
+            if started is not None:
+                in_flight.dec()
+                if flight.abandoned:
+                    metrics.upstream_aborts.labels(self.sparql_endpoint_title).inc()
+            if req is not None:
+                req.close()
+            if replica is not None and self.balancer.release(replica, failed, ttfb):
+                metrics.replica_ejections.labels(self.sparql_endpoint_title, replica.url).inc()
+            if ticket is not None:
+                ticket.release()
+            if lock is not None:
+                worker_locks.release(lock)
 
     def __run_query_string(self, active, query_string, is_post=False,
                           content_type="application/x-www-form-urlencoded"):
         parsed_query = urlparse.parse_qs(query_string)
-        current_subdomain = web.ctx.host.split('.')[0].lower()
         if query_string is None or query_string.strip() == "":
-            #web_logger.mes()
-            return getattr(render, self.sparql_endpoint_title)(
-                active=active, 
-                sp_title=self.sparql_endpoint_title, 
-                sparql_endpoint=self.yasqe_sparql_endpoint, 
-                render=render,
-                current_subdomain=current_subdomain)
+            log_request()
+            return serve_page(
+                self.sparql_endpoint_title,
+                active,
+                sp_title=self.sparql_endpoint_title,
+                sparql_endpoint=self.yasqe_sparql_endpoint)
         for k in self.collparam:
             if k in parsed_query:
-                query = parsed_query[k][0]
-                isupdate = None
-                isupdate, sanitizedQuery = self.__is_update_query(query)
-
-                if isupdate != None:
-                    if isupdate:
-                        raise web.HTTPError(
-                            "403 ",
-                            {"Content-Type": "text/plain"},
-                            "SPARQL Update queries are not permitted."
-                        )
-                    else:
-                        return self.__contact_tp(query_string, is_post, content_type)
+                try:
+                    self.pipeline.check_update(parsed_query[k][0])
+                    query = self.pipeline.plan_query_string(query_string, parsed_query, k, content_type)
+                except QueryRefused as e:
+                    raise refused(e)
+                return self.__contact_tp(query, is_post)
 
         raise web.HTTPError(
             "408",
@@ -215,11 +1034,11 @@ class Sparql:
             "Not a valid request"
         )
 
+
 class Main:
     def GET(self):
-        #web_logger.mes()
-        current_subdomain = web.ctx.host.split('.')[0].lower()
-        return render.sparql(active="", sp_title="", sparql_endpoint="", current_subdomain=current_subdomain, render=render)
+        log_request()
+        return serve_page("sparql", "", sp_title="", sparql_endpoint="")
 
 class SparqlIndex(Sparql):
     def __init__(self):
@@ -231,35 +1050,39 @@ class SparqlMeta(Sparql):
         Sparql.__init__(self, env_config["sparql_endpoint_meta"],
                        "meta", "/meta")
         
+class SparqlIndexBatch:
+    def POST(self):
+        return SparqlIndex().run_batch()
+
+class SparqlMetaBatch:
+    def POST(self):
+        return SparqlMeta().run_batch()
+
+class SparqlIndexStored:
+    def GET(self, name=None):
+        return SparqlIndex().run_stored(name)
+
+class SparqlMetaStored:
+    def GET(self, name=None):
+        return SparqlMeta().run_stored(name)
+
 class Static:
     def GET(self, name):
         """Serve static files"""
-        static_dir = "static"
-        file_path = os.path.join(static_dir, name)
-
-        if not os.path.exists(file_path):
+        release_watcher.check()
+        status, headers, body = static_assets.respond(
+            name,
+            web.ctx.env.get('HTTP_IF_NONE_MATCH'),
+            web.ctx.env.get('HTTP_IF_MODIFIED_SINCE'),
+            web.ctx.env.get('HTTP_ACCEPT_ENCODING'))
+        if status == 404:
             raise web.notfound()
 
-        # Content types
-        ext = os.path.splitext(name)[1]
-        content_types = {
-            '.css': 'text/css',
-            '.js': 'application/javascript',
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.svg': 'image/svg+xml',
-            '.ico': 'image/x-icon',
-            '.woff': 'font/woff',
-            '.woff2': 'font/woff2',
-            '.ttf': 'font/ttf',
-        }
-
-        web.header('Content-Type', content_types.get(ext, 'application/octet-stream'))
-
-        with open(file_path, 'rb') as f:
-            return f.read()
+        for name, value in headers.items():
+            web.header(name, value)
+        if status == 304:
+            raise web.notmodified()
+        return body
 
 
 # Run the application on localhost for testing/development
@@ -291,9 +1114,13 @@ if __name__ == "__main__":
         # or SYNC_ENABLED=true (Docker environment)
         print("Static sync is enabled")
         sync_static_files()
+        reload_static()
+        if env_config["sync_interval"] > 0:
+            start_scheduler(env_config["sync_interval"])
     else:
         print("Static sync is disabled")
     
     print("Starting web server...")
+    backends.start()
     # Set the port for web.py
     web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", args.port))
\ No newline at end of file
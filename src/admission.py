@@ -0,0 +1,349 @@
+import os
+import math
+import mmap
+import time
+import fcntl
+import struct
+import asyncio
+import hashlib
+import tempfile
+import threading
+
+# Layout of the shared file: a header, the token buckets of the clients and,
+# for each worker process, its pid followed by the queries it is running and
+# the ones it is holding in the wait queue for each endpoint
+_MAGIC = b"OCADMIT1"
+_HEADER = struct.Struct("<8sIII")
+_BUCKET = struct.Struct("<Qdd")
+_PROBES = 4
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def client_ip(forwarded_for, remote_addr, trusted_proxies=1):
+    """Return the address of the client of a request.
+
+    forwarded_for is the value of the header written by the proxies in
+    front of the application (X-Forwarded-For by default). Proxies append
+    the address they received the request from to it, so the entries that
+    can be trusted are the last trusted_proxies ones: anything before them
+    may have been written by the client itself. Behind proxies, a request
+    without the header returns None, since remote_addr is then the address
+    of the proxy, shared by all the clients.
+    """
+    if not trusted_proxies:
+        return remote_addr or ""
+    addresses = [a.strip() for a in (forwarded_for or "").split(",") if a.strip()]
+    if not addresses:
+        return None
+    return addresses[-min(trusted_proxies, len(addresses))]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Ticket:
+    """A slot to query an endpoint, to be released when the query is over"""
+
+    def __init__(self, admission, endpoint):
+        self.admission = admission
+        self.endpoint = endpoint
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission.leave(self.endpoint)
+
+
+class Admission:
+    """Admission control of the queries sent to the SPARQL backends.
+
+    Each client (see client_ip) has a token bucket refilled at rate queries
+    per second up to burst, and each endpoint accepts at most max_in_flight
+    concurrent queries, the others waiting in a queue of at most max_queue
+    queries for queue_timeout seconds. Clients out of tokens are refused with
+    429, queries that find the queue full or wait too long with 503.
+
+    The state lives in a file mapped in memory (in /dev/shm by default), so
+    that the limits hold for the whole service and not for each gunicorn
+    worker. Queries held by workers that died are forgotten.
+    """
+
+    def __init__(self, path, endpoints, rate=5, burst=20, max_in_flight=None, max_queue=64,
+                 queue_timeout=10, retry_after=5, exempt=(), bucket_slots=4096, worker_slots=64):
+        self.endpoints = {name: i for i, name in enumerate(endpoints)}
+        # Processes configured with a different layout use different files
+        self.path = "%s-%d-%d-%d" % (path, bucket_slots, len(self.endpoints), worker_slots)
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.exempt = frozenset(exempt)
+        self.bucket_slots = bucket_slots
+        self.worker_slots = worker_slots
+        self.worker = struct.Struct("<i" + "ii" * len(self.endpoints))
+        self.buckets_offset = _HEADER.size
+        self.workers_offset = self.buckets_offset + bucket_slots * _BUCKET.size
+        self.size = self.workers_offset + worker_slots * self.worker.size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.map = None
+        self.fd = None
+        self.row = None
+
+    def __open(self):
+        """Map the shared file, once in each process"""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, _HEADER.pack(_MAGIC, self.bucket_slots, len(self.endpoints), self.worker_slots), 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(fd, self.size)
+        self.fd = fd
+        self.row = None
+        self.pid = pid
+
+    def __locked(self):
+        self.__open()
+        return _FileLock(self.lock, self.fd)
+
+    def __claim_row(self):
+        """Return the offset of the row of this process, taking a free one if needed"""
+        if self.row is not None:
+            return self.row
+        empty = self.worker.pack(self.pid, *([0] * (2 * len(self.endpoints))))
+        for i in range(self.worker_slots):
+            offset = self.workers_offset + i * self.worker.size
+            pid = struct.unpack_from("<i", self.map, offset)[0]
+            if pid == self.pid or pid == 0 or not _pid_alive(pid):
+                self.map[offset:offset + self.worker.size] = empty
+                self.row = offset
+                return offset
+        raise RuntimeError("No free worker slot in %s, increase worker_slots" % self.path)
+
+    def __totals(self, index):
+        """Return the queries running and waiting on an endpoint across all processes"""
+        running = waiting = 0
+        for i in range(self.worker_slots):
+            offset = self.workers_offset + i * self.worker.size
+            values = self.worker.unpack_from(self.map, offset)
+            pid, counts = values[0], values[1 + 2 * index:3 + 2 * index]
+            if pid == 0 or not any(values[1:]):
+                continue
+            if pid != self.pid and not _pid_alive(pid):
+                self.map[offset:offset + self.worker.size] = bytes(self.worker.size)
+                continue
+            running += counts[0]
+            waiting += counts[1]
+        return running, waiting
+
+    def __add(self, index, field, delta):
+        offset = self.__claim_row() + 4 + 8 * index + 4 * field
+        value = struct.unpack_from("<i", self.map, offset)[0]
+        struct.pack_into("<i", self.map, offset, max(0, value + delta))
+
+    def check_client(self, ip):
+        """Take a token from the bucket of a client, raising AdmissionRejected if it is empty;
+        clients that cannot be told apart (ip is None) are not rate limited"""
+        if not self.rate or ip is None or ip in self.exempt:
+            return
+        key = int.from_bytes(hashlib.blake2b(ip.encode("utf-8"), digest_size=8).digest(), "little") or 1
+        now = time.monotonic()
+        with self.__locked():
+            first = key % self.bucket_slots
+            slot = None
+            oldest = None
+            for i in range(_PROBES):
+                offset = self.buckets_offset + ((first + i) % self.bucket_slots) * _BUCKET.size
+                slot_key, tokens, updated = _BUCKET.unpack_from(self.map, offset)
+                if slot_key == key:
+                    slot = offset
+                    break
+                if oldest is None or updated < oldest[1]:
+                    oldest = (offset, updated)
+            if slot is None:
+                # The least recently seen client of the probed slots is evicted
+                slot, tokens, updated = oldest[0], self.burst, now
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+            if tokens < 1:
+                _BUCKET.pack_into(self.map, slot, key, tokens, now)
+                raise AdmissionRejected(
+                    429, max(1, math.ceil((1 - tokens) / self.rate)),
+                    "Too many queries, please slow down.")
+            _BUCKET.pack_into(self.map, slot, key, tokens - 1, now)
+
+    def __try_enter(self, index, limit, queued):
+        """Take a slot of an endpoint if one is free; a query leaving the queue gives up its place there"""
+        with self.__locked():
+            running, _ = self.__totals(index)
+            if running >= limit:
+                return False
+            self.__add(index, 0, 1)
+            if queued:
+                self.__add(index, 1, -1)
+            return True
+
+    def __enqueue(self, index):
+        with self.__locked():
+            _, waiting = self.__totals(index)
+            if waiting >= self.max_queue:
+                return False
+            self.__add(index, 1, 1)
+            return True
+
+    def __dequeue(self, index):
+        with self.__locked():
+            self.__add(index, 1, -1)
+
+    def leave(self, endpoint):
+        with self.__locked():
+            self.__add(self.endpoints[endpoint], 0, -1)
+
+    def _admit(self, endpoint, ip):
+        """Admit a query, yielding the seconds to sleep while it is waiting in the queue.
+
+        The Ticket of the query is the value returned by the generator. If
+        ip is None, the client is supposed to have been checked already.
+        """
+        if ip is not None:
+            self.check_client(ip)
+        limit = self.max_in_flight.get(endpoint)
+        if not limit:
+            return Ticket(_Unlimited, endpoint)
+        index = self.endpoints[endpoint]
+        if self.__try_enter(index, limit, False):
+            return Ticket(self, endpoint)
+        if not self.__enqueue(index):
+            raise AdmissionRejected(503, self.retry_after, "The SPARQL endpoint is busy, please retry later.")
+
+        queued = True
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            delay = 0.01
+            while time.monotonic() < deadline:
+                yield delay
+                delay = min(delay * 2, 0.1)
+                if self.__try_enter(index, limit, True):
+                    queued = False
+                    return Ticket(self, endpoint)
+        finally:
+            if queued:
+                self.__dequeue(index)
+        raise AdmissionRejected(503, self.retry_after, "The SPARQL endpoint is busy, please retry later.")
+
+    def acquire(self, endpoint, ip=None):
+        """Admit a query, waiting with time.sleep (cooperative under gevent)"""
+        steps = self._admit(endpoint, ip)
+        try:
+            while True:
+                time.sleep(next(steps))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+    async def acquire_async(self, endpoint, ip=None):
+        """Admit a query, waiting with asyncio.sleep"""
+        steps = self._admit(endpoint, ip)
+        try:
+            while True:
+                await asyncio.sleep(next(steps))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+
+class ClientTokens:
+    """Tokens taken from the bucket of a client one query at a time, for a
+    request running several queries (a batch).
+
+    The first prepaid queries are not charged, since the request itself was
+    checked; once the bucket is empty, the remaining queries are refused with
+    the same error without looking at the bucket again.
+    """
+
+    def __init__(self, admission, ip, prepaid=0):
+        self.admission = admission
+        self.ip = ip
+        self.prepaid = prepaid
+        self.rejected = None
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take the token of a query, raising AdmissionRejected if the client has none left"""
+        with self.lock:
+            if self.rejected is not None:
+                raise self.rejected
+            if self.prepaid:
+                self.prepaid -= 1
+                return
+            if self.admission is None:
+                return
+            try:
+                self.admission.check_client(self.ip)
+            except AdmissionRejected as e:
+                self.rejected = e
+                raise
+
+
+class _FileLock:
+    """Exclusive lock over the threads of the process and the other processes"""
+
+    def __init__(self, lock, fd):
+        self.lock = lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class _Unlimited:
+    @staticmethod
+    def leave(endpoint):
+        pass
+
+
+def create_admission(conf, endpoints):
+    """Build the admission controller described by the admission section of
+    the configuration, or return None if it is disabled"""
+    if not conf["enabled"]:
+        return None
+    path = conf["path"]
+    if not os.path.isdir(os.path.dirname(path) or "."):
+        path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
+    return Admission(
+        path, endpoints,
+        rate=conf["rate"],
+        burst=conf["burst"],
+        max_in_flight=conf["max_in_flight"],
+        max_queue=conf["max_queue"],
+        queue_timeout=conf["queue_timeout"],
+        retry_after=conf["retry_after"],
+        exempt=conf["exempt"])
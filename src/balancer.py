@@ -0,0 +1,109 @@
+import time
+import random
+import hashlib
+import threading
+
+
+def parse_endpoints(value):
+    """Return the list of replica URLs of an endpoint, given as a list or a comma-separated string"""
+    if isinstance(value, str):
+        value = value.split(",")
+    return [url.strip() for url in value if url.strip()]
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        # Moving average of the milliseconds the replica takes to answer,
+        # None until it has answered once
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.id = url.encode("utf-8")
+
+
+class Balancer:
+    """Choose the replica of a SPARQL endpoint that runs each query.
+
+    With the "least_outstanding" strategy, a query goes to the replica that
+    is running the fewest queries of this worker; with "latency", to the one
+    with the lowest moving average of the response time, multiplied by its
+    running queries plus one, so that replicas not measured yet are tried
+    first. With affinity, a query always goes to the same replica, chosen by
+    rendezvous hashing of its text, so that the cache of the backend is warm;
+    only the queries of a replica that is ejected move to the others.
+
+    A replica failing max_failures queries in a row is ejected for
+    eject_time seconds. If all the replicas are ejected, the one whose
+    ejection ends first is still used.
+    """
+
+    def __init__(self, urls, strategy="least_outstanding", affinity=False, max_failures=3, eject_time=30,
+                 latency_decay=0.3):
+        if strategy not in ("least_outstanding", "latency"):
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.replicas = [Replica(url) for url in urls]
+        self.strategy = strategy
+        self.affinity = affinity
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.latency_decay = latency_decay
+        self.lock = threading.Lock()
+
+    def __cost(self, replica):
+        if self.strategy == "latency":
+            return (replica.latency or 0) * (replica.outstanding + 1)
+        return replica.outstanding
+
+    def acquire(self, query=None):
+        """Return the replica that must run a query, counting it as outstanding until release()"""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [replica for replica in self.replicas if replica.ejected_until <= now]
+            if not candidates:
+                replica = min(self.replicas, key=lambda r: r.ejected_until)
+            elif len(candidates) == 1:
+                replica = candidates[0]
+            elif self.affinity and query:
+                digest = hashlib.sha1(query.encode("utf-8")).digest()
+                replica = max(candidates, key=lambda r: hashlib.sha1(digest + r.id).digest())
+            else:
+                cost = min(self.__cost(r) for r in candidates)
+                replica = random.choice([r for r in candidates if self.__cost(r) == cost])
+            replica.outstanding += 1
+            return replica
+
+    def release(self, replica, failed=False, latency=None):
+        """Record the end of a query run by replica and, if known, the seconds it took to answer"""
+        with self.lock:
+            replica.outstanding -= 1
+            if latency is not None:
+                ms = latency * 1000
+                if replica.latency is None:
+                    replica.latency = ms
+                else:
+                    replica.latency += self.latency_decay * (ms - replica.latency)
+            if not failed:
+                replica.failures = 0
+                return False
+            replica.failures += 1
+            if replica.failures < self.max_failures or len(self.replicas) == 1:
+                return False
+            replica.failures = 0
+            replica.ejected_until = time.monotonic() + self.eject_time
+        print(f"Warning: replica {replica.url} ejected for {self.eject_time:g} seconds after "
+              f"{self.max_failures} failed queries")
+        return True
+
+    def status(self):
+        """Return the state of each replica, for the readiness report"""
+        now = time.monotonic()
+        return {
+            replica.url: {
+                "outstanding": replica.outstanding,
+                "latency_ms": round(replica.latency, 1) if replica.latency is not None else None,
+                "ejected": replica.ejected_until > now
+            }
+            for replica in self.replicas
+        }
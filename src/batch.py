@@ -0,0 +1,193 @@
+import re
+import json
+
+from src.transcode import media_type, JSON
+from src.query_check import where_clause_end
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+# Terms that can be bound to the variables of a template: IRIs follow the
+# IRIREF production of SPARQL, and strings cannot contain codepoint escapes,
+# which SPARQL parsers replace before tokenizing, so that no value can end
+# its term and change the query around it
+_variable = re.compile(r'^[?$]?(\w+)$')
+_iri = re.compile(r'^[^<>"{}|^`\\\x00-\x20]*$')
+_language = re.compile(r'^[a-zA-Z]+(?:-[a-zA-Z0-9]+)*$')
+_codepoint_escape = re.compile(r'\\[uU]')
+
+
+class BatchError(ValueError):
+    """Raised when a batch request is not valid; status is the HTTP status of the response"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def format_iri(value):
+    if not isinstance(value, str) or _iri.match(value) is None:
+        raise BatchError(f"Invalid IRI: {value!r}")
+    return "<%s>" % value
+
+
+def format_string(value):
+    if _codepoint_escape.search(value):
+        raise BatchError(f"Strings cannot contain codepoint escapes: {value!r}")
+    # The escapes of JSON strings are valid in SPARQL strings, and the
+    # control characters they write as codepoint escapes are allowed there
+    return json.dumps(value, ensure_ascii=False)
+
+
+def format_term(value):
+    """Return the SPARQL term standing for a value of a binding.
+
+    Strings become plain literals, numbers and booleans typed literals, None
+    is UNDEF, and other terms are given as in SPARQL JSON results, e.g.
+    {"type": "uri", "value": "https://w3id.org/oc/meta/br/062"} or
+    {"type": "literal", "value": "...", "datatype": "..."}.
+    """
+    if value is None:
+        return "UNDEF"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            raise BatchError(f"Invalid number: {value!r}")
+        return '"%r"^^<%sdouble>' % (value, XSD)
+    if isinstance(value, str):
+        return format_string(value)
+    if isinstance(value, dict) and isinstance(value.get("value"), str):
+        kind = value.get("type")
+        if kind == "uri":
+            return format_iri(value["value"])
+        if kind in ("literal", "typed-literal"):
+            literal = format_string(value["value"])
+            if "xml:lang" in value:
+                if not isinstance(value["xml:lang"], str) or _language.match(value["xml:lang"]) is None:
+                    raise BatchError(f"Invalid language tag: {value['xml:lang']!r}")
+                return "%s@%s" % (literal, value["xml:lang"])
+            if "datatype" in value:
+                return "%s^^%s" % (literal, format_iri(value["datatype"]))
+            return literal
+    raise BatchError(f"Invalid value: {value!r}")
+
+
+def values_position(template):
+    """Return the position where bind() adds the VALUES block of a template: the end of
+    its WHERE clause, so that its solution modifiers apply to each binding"""
+    position = where_clause_end(template)
+    if position is None:
+        raise BatchError("The template must be a query with a WHERE clause and without codepoint escapes")
+    return position
+
+
+def bind(template, variables, binding, position=None):
+    """Return template restricted to one binding by a VALUES block at the end of its WHERE
+    clause; position is that of the block, if already known (see values_position)"""
+    if position is None:
+        position = values_position(template)
+    terms = " ".join(format_term(binding.get(name)) for name in variables)
+    return "%s\nVALUES (%s) { (%s) }\n%s" % (
+        template[:position], " ".join("?" + name for name in variables), terms, template[position:])
+
+
+class Batch:
+    """Queries of a batch request.
+
+    The body is a JSON object with either a list of queries, each a string
+    or an object with an "id" and a "query", or a query template and a list
+    of bindings, each an object mapping the variables of the template to
+    their values (see format_term). timeout applies to every query and
+    accept is the results format of all of them.
+
+    items is the list of (id, query) to run, and checked the queries whose
+    update check covers all of them: the template alone, since the values
+    bound to it are terms that cannot change what kind of query it is.
+    """
+
+    def __init__(self, body, max_queries, default_accept=JSON):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise BatchError("The body of a batch must be a JSON object")
+        if not isinstance(data, dict):
+            raise BatchError("The body of a batch must be a JSON object")
+
+        self.items = []
+        if "template" in data:
+            template, bindings = data["template"], data.get("bindings")
+            if not isinstance(template, str) or not template.strip():
+                raise BatchError("template must be a query")
+            if not isinstance(bindings, list) or not all(isinstance(b, dict) for b in bindings):
+                raise BatchError("bindings must be a list of objects")
+            self.__check_size(len(bindings), max_queries)
+            variables = []
+            for binding in bindings:
+                for name in binding:
+                    match = _variable.match(name)
+                    if match is None:
+                        raise BatchError(f"Invalid variable name: {name!r}")
+                    if match.group(1) not in variables:
+                        variables.append(match.group(1))
+            position = values_position(template) if variables else None
+            for binding in bindings:
+                values = {_variable.match(name).group(1): value for name, value in binding.items()}
+                self.items.append((None, bind(template, variables, values, position) if variables else template))
+            self.checked = [template]
+        elif "queries" in data:
+            queries = data["queries"]
+            if not isinstance(queries, list):
+                raise BatchError("queries must be a list")
+            self.__check_size(len(queries), max_queries)
+            for item in queries:
+                if isinstance(item, dict):
+                    item_id, query = item.get("id"), item.get("query")
+                else:
+                    item_id, query = None, item
+                if not isinstance(query, str) or not query.strip():
+                    raise BatchError(f"Invalid query: {item!r}")
+                self.items.append((item_id, query))
+            # Repeated queries are checked once
+            self.checked = list(dict.fromkeys(query for _, query in self.items))
+        else:
+            raise BatchError("A batch needs either queries, or a template and bindings")
+
+        self.timeout = data.get("timeout")
+        if self.timeout is not None:
+            self.timeout = str(self.timeout)
+        self.accept = data.get("accept") or default_accept
+        if not isinstance(self.accept, str):
+            raise BatchError("accept must be a media type")
+
+    @staticmethod
+    def __check_size(size, max_queries):
+        if size == 0:
+            raise BatchError("The batch is empty")
+        if size > max_queries:
+            raise BatchError(f"A batch can hold at most {max_queries} queries", 413)
+
+
+def result_line(index, item_id, status, content_type=None, body=b"", cache=None):
+    """Return the NDJSON line reporting the result of a query of a batch.
+
+    JSON results are embedded as they are, without their line breaks; other
+    results, and the errors, as a string.
+    """
+    fields = {"index": index}
+    if item_id is not None:
+        fields["id"] = item_id
+    fields["status"] = status
+    if status != 200:
+        fields["error"] = body.decode("utf-8", "replace")
+        return json.dumps(fields).encode("utf-8") + b"\n"
+    fields["content_type"] = content_type
+    if cache is not None:
+        fields["cache"] = cache
+    if body and media_type(content_type) == JSON:
+        # Line breaks can only be whitespace in JSON
+        head = json.dumps(fields)[:-1].encode("utf-8")
+        return b'%s, "result": %s}\n' % (head, body.replace(b"\r", b" ").replace(b"\n", b" "))
+    fields["result"] = body.decode("utf-8", "replace")
+    return json.dumps(fields).encode("utf-8") + b"\n"
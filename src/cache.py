@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def make_key(endpoint, accept, params, encoding=None):
+    """Build the cache key of a query.
+
+    params is the list of (name, value) pairs sent to the backend, where the
+    query text has already been normalized; their order is not relevant.
+    encoding is the Content-Encoding negotiated with the client, if any.
+    """
+    fields = [endpoint, accept, sorted(params)]
+    if encoding is not None:
+        fields.append(encoding)
+    key = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """LRU cache of query results living in the memory of the worker"""
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, content_type, body, content_encoding = entry
+            if expires < time.time():
+                self.__remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return content_type, body, content_encoding
+
+    def set(self, key, content_type, body, ttl, content_encoding=None):
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+            self.entries[key] = (time.time() + ttl, content_type, body, content_encoding)
+            self.size += len(body)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self.__remove(next(iter(self.entries)))
+
+    def __remove(self, key):
+        _, _, body, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+
+class FileCache:
+    """Cache of query results stored as files in a directory.
+
+    All the gunicorn workers pointing to the same directory share the same
+    entries; using a tmpfs such as /dev/shm keeps everything in memory. The
+    modification time of a file is refreshed on every hit, so that eviction
+    removes the least recently used entries first.
+    """
+
+    def __init__(self, directory, max_entries=1024, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        file_path = os.path.join(self.directory, key)
+        try:
+            with open(file_path, "rb") as f:
+                header = json.loads(f.readline())
+                if header["expires"] < time.time():
+                    os.remove(file_path)
+                    return None
+                body = f.read()
+            os.utime(file_path)
+            return header["content_type"], body, header.get("content_encoding")
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key, content_type, body, ttl, content_encoding=None):
+        header = json.dumps({
+            "expires": time.time() + ttl,
+            "content_type": content_type,
+            "content_encoding": content_encoding
+        })
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header.encode("utf-8") + b"\n")
+                f.write(body)
+            # Readers in other workers see either the old entry or the new one
+            os.replace(tmp_path, os.path.join(self.directory, key))
+        except OSError as e:
+            print(f"Warning: unable to write cache entry {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.__evict()
+
+    def __evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, file_path = entries.pop(0)
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total -= size
+
+
+class ResultCache:
+    """Front-end of the configured cache backend with per-endpoint TTL"""
+
+    def __init__(self, backend, ttl, max_item_bytes):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes
+
+    def get(self, key):
+        """Return the (content type, body, content encoding) of a cached result, or None"""
+        return self.backend.get(key)
+
+    def set(self, key, endpoint_title, content_type, body, content_encoding=None):
+        ttl = self.ttl.get(endpoint_title, 0)
+        if ttl > 0 and len(body) <= self.max_item_bytes:
+            self.backend.set(key, content_type, body, ttl, content_encoding)
+
+
+def create_cache(conf):
+    """Create the result cache described by the cache section of the configuration"""
+    if not conf["enabled"]:
+        return None
+
+    if conf["backend"] == "file":
+        backend = FileCache(conf["dir"], conf["max_entries"], conf["max_bytes"])
+    elif conf["backend"] == "memory":
+        backend = MemoryCache(conf["max_entries"], conf["max_bytes"])
+    else:
+        raise ValueError(f"Unknown cache backend: {conf['backend']}")
+
+    return ResultCache(backend, conf["ttl"], conf["max_item_bytes"])
@@ -0,0 +1,150 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def available_encodings(encodings):
+    """Return the encodings, in order of preference, whose module is installed"""
+    missing = {"br": brotli is None, "zstd": zstandard is None}
+    return [encoding for encoding in encodings if encoding == "gzip" or not missing.get(encoding, True)]
+
+
+def choose_encoding(accept_encoding, encodings):
+    """Return the first of encodings accepted by the client, or None"""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        if params.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip().lower())
+    for encoding in encodings:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def compressible(content_type):
+    """Tell whether a body of this type is text worth compressing"""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return (media_type.startswith("text/") or media_type.endswith(("+xml", "+json", "/xml", "/json"))
+            or media_type in ("application/n-triples", "application/n-quads", "application/trig"))
+
+
+class _Gzip:
+    def __init__(self, level):
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.obj.compress(data) + self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self.obj = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.obj.process(data) + self.obj.flush()
+
+    def finish(self):
+        return self.obj.finish()
+
+
+class _Zstd:
+    def __init__(self, level):
+        self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data) + self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class StreamCompressor:
+    """Compress a body chunk by chunk while it is streamed.
+
+    Each chunk is flushed, so that the client can decode it as soon as it
+    arrives. Bodies smaller than min_size are not worth compressing: the
+    first bytes are held back until min_size is reached, and encoding is the
+    Content-Encoding of the output (or None if the body is sent as it is)
+    once decided is True.
+    """
+
+    def __init__(self, encoding, levels, min_size=1024):
+        self.target = encoding
+        self.level = levels[encoding]
+        self.min_size = min_size
+        self.held = []
+        self.held_size = 0
+        self.decided = False
+        self.encoding = None
+        self.compressor = None
+
+    def __decide(self, compress):
+        self.decided = True
+        if compress:
+            self.encoding = self.target
+            self.compressor = {"gzip": _Gzip, "br": _Brotli, "zstd": _Zstd}[self.target](self.level)
+
+    def feed(self, data):
+        if not self.decided:
+            self.held.append(data)
+            self.held_size += len(data)
+            if self.held_size < self.min_size:
+                return b""
+            data = b"".join(self.held)
+            self.held = []
+            self.__decide(True)
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data)
+
+    def close(self):
+        if not self.decided:
+            data = b"".join(self.held)
+            self.held = []
+            self.__decide(False)
+            return data
+        if self.compressor is None:
+            return b""
+        return self.compressor.finish()
+
+
+class _Identity:
+    def decompress(self, data):
+        return data
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self.obj.process(data)
+
+
+def decompressor(encoding):
+    """Return an object whose decompress() decodes a body sent with a Content-Encoding"""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        # Offset 32 detects the zlib or gzip header
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    if encoding == "br" and brotli is not None:
+        return _BrotliDecoder()
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == "identity":
+        return _Identity()
+    raise ValueError(f"Unsupported Content-Encoding: {encoding}")
@@ -0,0 +1,58 @@
+import re
+import urllib.parse as urlparse
+
+_DURATION = re.compile(r"^\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|s)?\s*$")
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, endpoint, phase):
+        super().__init__(f"The SPARQL endpoint {endpoint} did not answer in time ({phase} timeout).")
+        self.phase = phase
+
+
+def replace_param(query_string, name, value):
+    """Return query_string with the parameter name set to value, keeping the encoding of the others"""
+    params = [p for p in query_string.split("&") if p and urlparse.unquote_plus(p.split("=", 1)[0]) != name]
+    params.append("%s=%s" % (urlparse.quote_plus(name), urlparse.quote_plus(value)))
+    return "&".join(params)
+
+
+class Deadlines:
+    """Time limits of the queries sent to a SPARQL backend.
+
+    connect bounds the time to open a connection, read the time to wait for
+    each part of the response, and total the whole query once it has been
+    sent. Clients can ask for a shorter total with the timeout parameter,
+    which is then passed on to the backend in its own unit: seconds followed
+    by "s" for QLever (hint_unit "s"), milliseconds for Virtuoso (hint_unit
+    "ms"). A number without unit is read in the unit of the backend.
+    """
+
+    def __init__(self, connect=10, read=300, total=1200, hint_unit="s"):
+        self.connect = connect
+        self.read = read
+        self.total = total
+        self.hint_unit = hint_unit
+
+    def budget(self, hint=None):
+        """Return the seconds allowed to a query whose timeout parameter is hint,
+        raising ValueError if hint is not a valid duration"""
+        if hint is None:
+            return self.total
+        match = _DURATION.match(hint)
+        if match is None or float(match.group(1)) <= 0:
+            raise ValueError(f"Invalid timeout: {hint}")
+        seconds = float(match.group(1))
+        if (match.group(2) or self.hint_unit) == "ms":
+            seconds /= 1000
+        return min(seconds, self.total)
+
+    def hint(self, seconds):
+        """Return the timeout parameter asking the backend to stop after seconds"""
+        if self.hint_unit == "ms":
+            return str(max(1, round(seconds * 1000)))
+        return "%gs" % seconds
+
+    def timeouts(self, budget):
+        """Return the (connect, read) timeouts of a query allowed budget seconds"""
+        return self.connect, min(self.read, budget)
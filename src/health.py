@@ -0,0 +1,145 @@
+import os
+import math
+import time
+import threading
+
+import requests
+
+
+class CircuitOpen(Exception):
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"The SPARQL endpoint {endpoint} is unavailable, please retry later.")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stop sending queries to a backend after failure_threshold consecutive failures.
+
+    While the circuit is open, queries fail immediately; every reset_timeout
+    seconds a single query is let through as a trial, and the circuit closes
+    as soon as a query or a probe succeeds.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Return 0 if a query can be sent, otherwise the seconds before the next trial"""
+        if self.opened_at is None:
+            return 0
+        with self.lock:
+            wait = self.opened_at + self.reset_timeout - time.monotonic()
+            if wait <= 0:
+                # Trial query: the next one waits for another reset_timeout
+                self.opened_at = time.monotonic()
+                return 0
+            return max(1, math.ceil(wait))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+
+
+_RANKS = {"up": 0, "degraded": 1, "down": 2}
+
+
+class BackendMonitor:
+    """Status of the SPARQL backends, probed in the background.
+
+    Every interval seconds, a thread of the worker sends probe_query to each
+    backend and records whether it is "up", "degraded" (answering in more
+    than degraded_ms milliseconds) or "down"; readers only look at the last
+    result. A backend with several replicas has the status of its best
+    replica. Probes and queries also drive a CircuitBreaker per backend.
+    """
+
+    def __init__(self, endpoints, interval=10, timeout=5, degraded_ms=2000, failure_threshold=3,
+                 reset_timeout=30, required=(), probe_query="ASK {}"):
+        self.endpoints = endpoints
+        self.interval = interval
+        self.timeout = timeout
+        self.degraded_ms = degraded_ms
+        self.required = required
+        self.probe_query = probe_query
+        self.breakers = {name: CircuitBreaker(failure_threshold, reset_timeout) for name in endpoints}
+        self.results = {name: {"status": "unknown"} for name in endpoints}
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the prober in this process, if it is not running yet"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                threading.Thread(target=self.__probe_loop, name="BackendMonitor", daemon=True).start()
+                self.pid = os.getpid()
+
+    def breaker(self, name):
+        self.start()
+        return self.breakers[name]
+
+    def check(self, name):
+        """Raise CircuitOpen if queries must not be sent to a backend now"""
+        retry_after = self.breaker(name).allow()
+        if retry_after:
+            raise CircuitOpen(name, retry_after)
+
+    def __probe_loop(self):
+        session = requests.Session()
+        while True:
+            for name, urls in self.endpoints.items():
+                results = {url: self.__probe(session, url) for url in urls}
+                result = min(results.values(), key=lambda r: _RANKS[r["status"]])
+                if len(results) > 1:
+                    result = dict(result, replicas=results)
+                if result["status"] == "down":
+                    self.breakers[name].failure()
+                else:
+                    self.breakers[name].success()
+                self.results[name] = result
+            time.sleep(self.interval)
+
+    def __probe(self, session, endpoint):
+        started = time.monotonic()
+        result = {"checked": time.time()}
+        try:
+            res = session.get(
+                endpoint, params={"query": self.probe_query},
+                headers={"Accept": "application/sparql-results+json"}, timeout=self.timeout)
+            result["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+            if res.status_code == 200:
+                result["status"] = "degraded" if result["latency_ms"] > self.degraded_ms else "up"
+            else:
+                result["status"] = "down"
+                result["error"] = f"HTTP {res.status_code}"
+        except requests.RequestException as e:
+            result["status"] = "down"
+            result["error"] = e.__class__.__name__
+        return result
+
+    def status(self):
+        """Return (ready, report): ready is False if a required backend is down, or not probed yet"""
+        self.start()
+        report = {}
+        ready = True
+        for name in self.endpoints:
+            report[name] = dict(self.results[name], circuit="open" if self.breakers[name].is_open else "closed")
+            if name in self.required and report[name]["status"] in ("down", "unknown"):
+                ready = False
+        return ready, report
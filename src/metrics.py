@@ -0,0 +1,76 @@
+import os
+
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+                               CONTENT_TYPE_LATEST, REGISTRY, multiprocess)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+CHECK_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5)
+
+requests = Counter(
+    "oc_sparql_requests_total", "Queries answered, by endpoint and status", ["endpoint", "status"])
+cache_results = Counter(
+    "oc_sparql_cache_total", "Result cache lookups, by endpoint and result (hit or miss)", ["endpoint", "result"])
+coalesced = Counter(
+    "oc_sparql_coalesced_total", "Queries that shared the upstream request of an identical one", ["endpoint"])
+sent_bytes = Counter(
+    "oc_sparql_response_bytes_total", "Bytes of query results sent to the clients", ["endpoint"])
+upstream_bytes = Counter(
+    "oc_sparql_upstream_bytes_total", "Bytes of query results received from the backends", ["endpoint"])
+upstream_ttfb = Histogram(
+    "oc_sparql_upstream_ttfb_seconds", "Time until the backend sends the response headers",
+    ["endpoint"], buckets=LATENCY_BUCKETS)
+upstream_duration = Histogram(
+    "oc_sparql_upstream_duration_seconds", "Time until the backend sends the whole response",
+    ["endpoint"], buckets=LATENCY_BUCKETS)
+upstream_in_flight = Gauge(
+    "oc_sparql_upstream_in_flight", "Queries being run by the backends", ["endpoint"],
+    multiprocess_mode="livesum")
+update_check = Histogram(
+    "oc_sparql_update_check_seconds", "Time spent checking whether queries are SPARQL Update requests",
+    ["endpoint"], buckets=CHECK_BUCKETS)
+update_rejections = Counter(
+    "oc_sparql_update_rejections_total", "SPARQL Update requests refused", ["endpoint"])
+admission_rejections = Counter(
+    "oc_sparql_admission_rejections_total", "Queries refused by the admission control, by status",
+    ["endpoint", "status"])
+query_costs = Counter(
+    "oc_sparql_query_cost_total", "Queries by class of their estimated cost (light or heavy)", ["endpoint", "class"])
+circuit_rejections = Counter(
+    "oc_sparql_circuit_rejections_total", "Queries refused because the circuit breaker of the backend is open",
+    ["endpoint"])
+upstream_timeouts = Counter(
+    "oc_sparql_upstream_timeouts_total",
+    "Queries stopped by a time limit, by phase (connect, read or total)", ["endpoint", "phase"])
+upstream_aborts = Counter(
+    "oc_sparql_upstream_aborts_total", "Queries aborted because all their clients disconnected", ["endpoint"])
+replica_requests = Counter(
+    "oc_sparql_replica_requests_total", "Queries sent to each replica of the backends", ["endpoint", "replica"])
+replica_ejections = Counter(
+    "oc_sparql_replica_ejections_total", "Replicas ejected by the balancer after failing too many queries",
+    ["endpoint", "replica"])
+batches = Counter(
+    "oc_sparql_batches_total", "Batch requests, whose queries are also counted one by one", ["endpoint"])
+stored_queries = Counter(
+    "oc_sparql_stored_queries_total", "Stored queries run, by name", ["endpoint", "name"])
+client_disconnects = Counter(
+    "oc_sparql_client_disconnects_total", "Clients that disconnected before receiving the whole result",
+    ["endpoint"])
+
+
+def observe_request(endpoint, status, size):
+    requests.labels(endpoint, str(status)).inc()
+    sent_bytes.labels(endpoint).inc(size)
+
+
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set by gunicorn.conf.py before
+# the workers import this module, so that each worker writes its metrics to
+# memory-mapped files in that directory and /metrics aggregates all of them;
+# otherwise, the metrics are the ones of the current process
+def collect():
+    """Return the (body, content type) of the /metrics response"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
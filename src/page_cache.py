@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from src.static_assets import Asset, respond_asset
+
+
+def templates_signature(root):
+    """Return a value that changes whenever a file under root is added, removed or modified"""
+    signature = []
+    for dirpath, _, filenames in os.walk(root, followlinks=True):
+        for filename in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            signature.append((dirpath, filename, st.st_mtime_ns, st.st_size))
+    signature.sort()
+    return hash(tuple(signature))
+
+
+class PageCache:
+    """Rendered HTML pages, kept in memory with their ETag and precompressed
+    variants so that serving a landing page does not execute its template.
+
+    Pages are identified by a key such as (template, active, subdomain);
+    since the subdomain comes from the Host header of the request, the number
+    of pages is bounded and the least recently used ones are evicted. All
+    pages are dropped when a file under template_dir changes, which is checked
+    at most once every check_interval seconds, and on_change is called so that
+    the renderer can forget its compiled templates as well.
+    """
+
+    def __init__(self, template_dir, max_entries=64, check_interval=5, on_change=None,
+                 compress_min_size=1024, gzip_level=9, brotli_quality=5):
+        self.template_dir = template_dir
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.compress_min_size = compress_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.signature = templates_signature(template_dir)
+        self.checked = time.monotonic()
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+        if self.on_change is not None:
+            self.on_change()
+
+    def check(self):
+        """Drop the pages if the templates changed since the last check"""
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        signature = templates_signature(self.template_dir)
+        if signature != self.signature:
+            self.signature = signature
+            print(f"Templates in {self.template_dir} changed, clearing the rendered pages")
+            self.clear()
+
+    def get(self, key, render_page):
+        """Return the Asset of a page, calling render_page() to build it if needed"""
+        self.check()
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                return page
+
+        # Rendering happens outside the lock: two concurrent misses of the
+        # same page just render it twice
+        page = Asset(
+            str(render_page()).encode("utf-8"), "text/html; charset=utf-8", time.time(),
+            self.compress_min_size, self.gzip_level, self.brotli_quality)
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last=False)
+        return page
+
+    def respond(self, key, render_page, if_none_match=None, if_modified_since=None, accept_encoding=None):
+        """Return the (status, headers, body) answering a request for a page.
+
+        Browsers must revalidate pages on each use, which costs them a
+        304 Not Modified as long as the templates do not change.
+        """
+        page = self.get(key, render_page)
+        return respond_asset(page, "no-cache", if_none_match, if_modified_since, accept_encoding)
@@ -0,0 +1,304 @@
+import time
+import urllib.parse as urlparse
+
+from src import metrics
+from src.cache import make_key
+from src.query_check import normalize_query, query_form, ValidationUnavailable
+from src.deadlines import DeadlineExceeded, replace_param
+from src.transcode import Transcoder, negotiate, media_type, CONTENT_TYPES
+from src.compression import StreamCompressor, choose_encoding, compressible, decompressor
+
+FORM = "application/x-www-form-urlencoded"
+DEFAULT_ACCEPT = "application/sparql-results+xml"
+
+
+class QueryRefused(Exception):
+    """Raised when a request is answered without contacting the backend; status,
+    headers and the message are those of the response"""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = {"Content-Type": "text/plain"}
+        self.headers.update(headers or {})
+
+
+class Query:
+    """A query ready to be sent to a backend.
+
+    data is the body of the request (the query string for GET requests),
+    url_query the query string added to the URL of the backend, and
+    cache_params the parameters identifying the results in the cache.
+    """
+
+    def __init__(self, query, data, cache_params, lane, cost, budget, url_query=None, content_type=FORM):
+        self.query = query
+        self.data = data
+        self.cache_params = cache_params
+        self.lane = lane
+        self.cost = cost
+        self.budget = budget
+        self.url_query = url_query
+        self.content_type = content_type
+
+
+class ResultStream:
+    """A successful response of a backend on its way to the clients.
+
+    The response is decompressed (if decode, and unless it is forwarded as
+    it is), converted to the format of the client and compressed chunk by
+    chunk by feed() and close(). The output is also collected for the cache,
+    until it grows beyond max_cached bytes. With a compressor, the headers
+    are only known once it has decided whether the result is large enough to
+    be compressed, that is when the first output chunk is returned.
+    """
+
+    def __init__(self, content_type, content_encoding, conversion, encoding, levels, min_size,
+                 max_cached=None, decode=False):
+        self.converter = None
+        if conversion is not None and media_type(content_type) == conversion[0]:
+            self.converter = Transcoder(*conversion)
+            content_type = CONTENT_TYPES[conversion[1]]
+        elif content_type == "application/json":
+            content_type = "application/sparql-results+json"
+        self.content_type = content_type
+        self.headers = {"Content-Type": content_type}
+        self.decoder = self.compressor = None
+        # A result compressed by the backend as the client wants is forwarded as it is
+        self.forward = self.converter is None and encoding is not None and content_encoding == encoding
+        if self.forward:
+            self.headers["Content-Encoding"] = encoding
+        else:
+            if decode:
+                self.decoder = decompressor(content_encoding)
+            if encoding is not None and compressible(content_type):
+                self.compressor = StreamCompressor(encoding, levels, min_size)
+        self.max_cached = max_cached
+        self.chunks = [] if max_cached is not None else None
+        self.size = 0
+
+    @property
+    def ready(self):
+        """Tell whether the headers are known before any output"""
+        return self.compressor is None
+
+    def response_headers(self):
+        if self.compressor is not None and self.compressor.encoding is not None:
+            self.headers["Content-Encoding"] = self.compressor.encoding
+        return self.headers
+
+    def feed(self, chunk):
+        if self.decoder is not None:
+            chunk = self.decoder.decompress(chunk)
+        if chunk and self.converter is not None:
+            chunk = self.converter.feed(chunk)
+        if chunk and self.compressor is not None:
+            chunk = self.compressor.feed(chunk)
+        return self.__collect(chunk)
+
+    def close(self):
+        chunk = self.converter.close() if self.converter is not None else b""
+        if self.compressor is not None:
+            chunk = (self.compressor.feed(chunk) if chunk else b"") + self.compressor.close()
+        return self.__collect(chunk)
+
+    def __collect(self, chunk):
+        if chunk and self.chunks is not None:
+            self.size += len(chunk)
+            if self.size > self.max_cached:
+                self.chunks = None
+            else:
+                self.chunks.append(chunk)
+        return chunk
+
+    def body(self):
+        """Return the complete output, or None if it was not collected"""
+        return b"".join(self.chunks) if self.chunks is not None else None
+
+
+class Pipeline:
+    """Steps of the handling of a query shared by the WSGI (sparql_oc) and the
+    ASGI (asgi) front ends, for the endpoint title.
+
+    The front ends read the requests, run the upstream requests and write
+    the responses in their own way; everything else, from the checks of the
+    query to the processing of the results, is done here, so that both
+    behave the same.
+    """
+
+    def __init__(self, title, sparql_endpoint, update_checker, query_lane, deadlines, result_cache,
+                 native=None, encodings=(), levels=None, min_size=1024):
+        self.title = title
+        self.sparql_endpoint = sparql_endpoint
+        self.update_checker = update_checker
+        self.query_lane = query_lane
+        self.deadlines = deadlines
+        self.result_cache = result_cache
+        # Results formats the backend writes, the first one being converted
+        # to the others (see transcode.negotiate)
+        self.native = native
+        self.encodings = encodings
+        self.levels = levels or {}
+        self.min_size = min_size
+
+    def check_update(self, query):
+        """Refuse SPARQL Update requests, with 403, and queries that cannot be checked, with 503"""
+        started = time.perf_counter()
+        try:
+            isupdate = self.update_checker.is_update(query)
+        except ValidationUnavailable as e:
+            raise QueryRefused(503, str(e), {"Retry-After": "5"})
+        finally:
+            metrics.update_check.labels(self.title).observe(time.perf_counter() - started)
+        if isupdate:
+            metrics.update_rejections.labels(self.title).inc()
+            raise QueryRefused(403, "SPARQL Update queries are not permitted.")
+
+    def budget(self, hint, lane):
+        """Return the seconds allowed to a query of lane whose timeout parameter is hint"""
+        try:
+            return self.deadlines[lane].budget(hint)
+        except ValueError as e:
+            raise QueryRefused(400, str(e))
+
+    def plan_query_string(self, query_string, parsed, param="query", content_type=FORM):
+        """Return the Query of a query string whose parameters are parsed.
+
+        The timeout asked by the client is capped by ours, and replaced with
+        the one sent to the backend.
+        """
+        query = parsed[param][0]
+        cache_params = [
+            (name, normalize_query(value) if name == param else value)
+            for name, values in parsed.items() for value in values]
+        hint = parsed.get("timeout", [None])[0]
+        lane, cost = self.query_lane(self.title, query)
+        budget = self.budget(hint, lane)
+        if hint is not None:
+            query_string = replace_param(query_string, "timeout", self.deadlines[lane].hint(budget))
+        return Query(query, query_string, cache_params, lane, cost, budget, content_type=content_type)
+
+    def plan_query_body(self, query, url_query_string, content_type):
+        """Return the Query of an application/sparql-query request, whose timeout is given in the URL"""
+        hint = urlparse.parse_qs(url_query_string or "").get("timeout", [None])[0]
+        lane, cost = self.query_lane(self.title, query)
+        budget = self.budget(hint, lane)
+        cache_params = [("query", normalize_query(query))]
+        url_query = None
+        if hint is not None:
+            cache_params.append(("timeout", hint))
+            url_query = "timeout=%s" % urlparse.quote_plus(self.deadlines[lane].hint(budget))
+        return Query(query, query, cache_params, lane, cost, budget, url_query, content_type)
+
+    def plan_stored(self, stored, url_query_string):
+        """Return the Query running stored with the parameters of the URL"""
+        values = urlparse.parse_qs(url_query_string or "")
+        hint = values.pop("timeout", [None])[0]
+        try:
+            query, terms = stored.bind({param: value[0] for param, value in values.items()})
+        except ValueError as e:
+            raise QueryRefused(400, str(e))
+        metrics.stored_queries.labels(self.title, stored.name).inc()
+        lane, cost = self.query_lane(self.title, query, stored.cost)
+        budget = self.budget(hint, lane)
+        params = [("query", query)]
+        # The results are cached by the template and the terms of its parameters
+        cache_params = [("stored", stored.key)] + list(terms.items())
+        if hint is not None:
+            params.append(("timeout", self.deadlines[lane].hint(budget)))
+            cache_params.append(("timeout", hint))
+        return Query(query, urlparse.urlencode(params), cache_params, lane, cost, budget)
+
+    def plan_batch_query(self, query, timeout):
+        """Return the Query of a query of a batch, all of whose queries have the same timeout"""
+        lane, _ = self.query_lane(self.title, query)
+        budget = self.deadlines[lane].budget(timeout)
+        params = [("query", query)]
+        cache_params = [("query", normalize_query(query))]
+        if timeout is not None:
+            params.append(("timeout", self.deadlines[lane].hint(budget)))
+            cache_params.append(("timeout", timeout))
+        return Query(query, urlparse.urlencode(params), cache_params, lane, None, budget)
+
+    @staticmethod
+    def accept(header):
+        """Return the results format asked by a request, XML if any format is accepted"""
+        if header is None or header == "*/*" or header == "":
+            return DEFAULT_ACCEPT
+        return header
+
+    def encoding(self, accept_encoding):
+        """Return the Content-Encoding of the results for a request, or None"""
+        return choose_encoding(accept_encoding, self.encodings)
+
+    def key(self, accept, cache_params, encoding=None):
+        return make_key(self.sparql_endpoint, accept, cache_params, encoding)
+
+    def cached(self, key):
+        """Return the (content type, body, content encoding) of key in the result cache, or None"""
+        if self.result_cache is None:
+            return None
+        cached = self.result_cache.get(key)
+        metrics.cache_results.labels(self.title, "hit" if cached is not None else "miss").inc()
+        return cached
+
+    def store(self, key, stream):
+        """Store the result of stream in the result cache, if it was collected whole"""
+        body = stream.body()
+        if key is not None and body is not None:
+            self.result_cache.set(key, self.title, stream.content_type, body, stream.headers.get("Content-Encoding"))
+
+    @staticmethod
+    def cached_headers(cached):
+        """Return the headers of a result taken from the cache"""
+        content_type, _, content_encoding = cached
+        headers = {"Content-Type": content_type}
+        if content_encoding is not None:
+            headers["Content-Encoding"] = content_encoding
+        return headers
+
+    @staticmethod
+    def response_headers(result_headers, cost=None, cache=None):
+        """Return the headers of a response carrying results"""
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Credentials": "true",
+            "Content-Type": result_headers["Content-Type"]
+        }
+        if "Content-Encoding" in result_headers:
+            headers["Content-Encoding"] = result_headers["Content-Encoding"]
+        headers["Vary"] = "Accept, Accept-Encoding"
+        if cost is not None:
+            headers["X-Query-Cost"] = cost
+        if cache is not None:
+            headers["X-Cache"] = cache
+        return headers
+
+    @staticmethod
+    def gateway_error(flight, error):
+        """Return the status and the message answering a request whose flight failed"""
+        if isinstance(flight.error, DeadlineExceeded):
+            return 504, str(error)
+        return 502, f"SPARQL endpoint unavailable: {error}"
+
+    def upstream_headers(self, accept, query, content_type, encoding):
+        """Return the headers of the request to the backend and the conversion of its results, if any"""
+        upstream_accept, conversion = negotiate(accept, self.native, query_form(query))
+        headers = {"content-type": content_type, "accept": upstream_accept}
+        if encoding is not None and conversion is None:
+            # A result compressed by the backend is forwarded as it is
+            headers["accept-encoding"] = encoding
+        return headers, conversion
+
+    def result_stream(self, content_type, content_encoding, conversion, encoding, cache_key, decode=False):
+        max_cached = self.result_cache.max_item_bytes if cache_key is not None else None
+        return ResultStream(content_type, content_encoding, conversion, encoding, self.levels, self.min_size,
+                            max_cached, decode)
+
+    def log_fields(self, key, leader=None, **fields):
+        """Return the fields of the access log describing a query"""
+        log_fields = {"endpoint": self.title, "query_hash": key[:16] if key is not None else None}
+        if leader is not None:
+            log_fields["coalesced"] = not leader
+        log_fields.update(fields)
+        return log_fields
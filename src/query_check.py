@@ -0,0 +1,302 @@
+import os
+import re
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+# Keywords that can only appear in SPARQL Update requests (MODIFY comes from
+# the SPARUL syntax still accepted by Virtuoso)
+UPDATE_KEYWORDS = frozenset([
+    "INSERT", "DELETE", "LOAD", "CLEAR", "DROP", "CREATE",
+    "ADD", "MOVE", "COPY", "WITH", "MODIFY"
+])
+
+# Codepoint escapes are replaced before tokenizing, as SPARQL parsers do
+_codepoint_escape = re.compile(r'\\u([0-9A-Fa-f]{4})|\\U([0-9A-Fa-f]{8})')
+
+# Parts of a query whose content must not be interpreted: strings and IRIs
+# (captured, since they are kept by normalize_query) and comments
+_literal = re.compile(r'''
+    ( '{3}(?:[^'\\]|\\[tbnrf\\"']|'(?!''))*'{3}
+    | "{3}(?:[^"\\]|\\[tbnrf\\"']|"(?!""))*"{3}
+    | '(?:[^'\\\r\n]|\\[tbnrf\\"'])*'
+    | "(?:[^"\\\r\n]|\\[tbnrf\\"'])*"
+    | <[^<>"{}|^`\\\x00-\x20]*> )
+  | \#[^\r\n]*
+''', re.VERBOSE)
+
+# An update keyword used as such, i.e. not as part of a variable, a prefixed
+# name or a language tag
+_update_keyword = re.compile(
+    r'(?<![\w?$@:.\-])(?:%s)(?![\w:.\-])' % "|".join(sorted(UPDATE_KEYWORDS)),
+    re.IGNORECASE)
+_lowered_keywords = [keyword.lower() for keyword in UPDATE_KEYWORDS]
+
+# The keyword introducing the form of a query, after its prologue
+_query_form = re.compile(r'(?<![\w?$@:.\-])(SELECT|ASK|CONSTRUCT|DESCRIBE)(?![\w:.\-])', re.IGNORECASE)
+
+# Features making a query expensive to run, with their weight in its cost:
+# results without LIMIT, patterns scanning every triple (?s ?p ?o) or every
+# predicate (?s ?p <o>), OPTIONAL patterns beyond the first few, and regular
+# expressions
+COST_WEIGHTS = {"no_limit": 2, "scan": 4, "variable_predicate": 2, "optional": 1, "regex": 2}
+_FREE_OPTIONALS = 3
+
+# Parts of a query that list variables without being triple patterns: the
+# projection, the template of CONSTRUCT and the grouping and ordering keys
+_not_patterns = re.compile(r'''
+    \b(?:SELECT|DESCRIBE|GROUP\s+BY|ORDER\s+BY)\b
+    .*?(?=\bWHERE\b|[{}]|\bLIMIT\b|\bOFFSET\b|\bHAVING\b|\bORDER\b|$)
+  | \bCONSTRUCT\s*\{[^{}]*\}
+''', re.IGNORECASE | re.VERBOSE | re.DOTALL)
+# Inline data, whose list of variables is not a pattern and whose values are
+# not matched against the data
+_values = re.compile(r'\bVALUES\s*(?:\([^()]*\)|[?$]\w+)\s*\{[^{}]*\}', re.IGNORECASE)
+_scan = re.compile(r'(?<![\w?$])[?$]\w+\s+[?$]\w+\s+[?$]\w+')
+_variable_predicate = re.compile(r'(?<![\w?$])[?$]\w+\s+[?$]\w+\s+(?:<>|[\w:])')
+_limit = re.compile(r'\bLIMIT\s+\d+', re.IGNORECASE)
+_optional = re.compile(r'\bOPTIONAL\b', re.IGNORECASE)
+_regex = re.compile(r'\bREGEX\s*\(', re.IGNORECASE)
+
+
+def decode_escapes(query):
+    """Replace codepoint escapes, as SPARQL parsers do before tokenizing"""
+    if "\\u" in query or "\\U" in query:
+        query = _codepoint_escape.sub(
+            lambda m: chr(int(m.group(1) or m.group(2), 16)), query)
+    return query
+
+
+def strip_literals(query):
+    """Replace strings, IRIs and comments with spaces, leaving only the syntax of the query"""
+    return _literal.sub(" ", decode_escapes(query))
+
+
+def split_literals(query):
+    """Split a query into its syntax, at the even positions of the list returned,
+    and its strings and IRIs, at the odd ones; comments become spaces"""
+    pieces = _literal.split(decode_escapes(query))
+    parts = [pieces[0]]
+    for i in range(1, len(pieces), 2):
+        if pieces[i] is None:
+            parts[-1] += " " + pieces[i + 1]
+        else:
+            parts.extend((pieces[i], pieces[i + 1]))
+    return parts
+
+
+def normalize_query(query):
+    """Rewrite a query with its tokens separated by single spaces.
+
+    Two queries that differ only in comments, indentation or line breaks
+    have the same normalized form, while strings and IRIs are left as they
+    are.
+    """
+    parts = []
+    for i, piece in enumerate(split_literals(query)):
+        if i % 2 == 0:
+            parts.extend(piece.split())
+        else:
+            parts.append(piece)
+    return " ".join(parts)
+
+
+def query_form(query):
+    """Return the form of a query (SELECT, ASK, CONSTRUCT or DESCRIBE), or None if it has none"""
+    match = _query_form.search(strip_literals(query))
+    return match.group(1).upper() if match else None
+
+
+def _outer_group_end(text, form):
+    """Return the position after the group pattern of the WHERE clause of a query,
+    where its solution modifiers start, or None if it has none"""
+    start = text.find("{", form.end())
+    if start != -1 and form.group(1).upper() == "CONSTRUCT" and not text[form.end():start].strip():
+        # The template of CONSTRUCT comes before the WHERE clause
+        start = _group_end(text, start)
+        start = -1 if start is None else text.find("{", start)
+    return None if start == -1 else _group_end(text, start)
+
+
+def _group_end(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def where_clause_end(query):
+    """Return the position of the closing brace of the group of the WHERE clause
+    of a query, or None if it has none or contains codepoint escapes"""
+    if "\\u" in query or "\\U" in query:
+        return None
+    # Strings, IRIs and comments are blanked out, keeping the positions
+    text = _literal.sub(lambda m: " " * len(m.group(0)), query)
+    form = _query_form.search(text)
+    if form is None:
+        return None
+    end = _outer_group_end(text, form)
+    return None if end is None else end - 1
+
+
+def estimate_cost(query):
+    """Return the static cost of a query and the features that make it expensive.
+
+    The estimate only looks at the text of the query: it is meant to tell
+    apart the queries that may scan large parts of the data from the
+    lookups, not to predict how long they take.
+    """
+    # Strings and IRIs become a placeholder term, so that they still count
+    # as the terms of the patterns
+    text = _literal.sub(lambda m: " <> " if m.group(1) else " ", decode_escapes(query))
+    text = _values.sub(" ", text)
+    features = []
+    form = _query_form.search(text)
+    if form is not None and form.group(1).upper() != "ASK":
+        # Only the solution modifiers after the WHERE clause bound the
+        # results, not a LIMIT in a subquery
+        end = _outer_group_end(text, form)
+        if end is not None and _limit.search(text[end:]) is None:
+            features.append("no_limit")
+    patterns, scans = _scan.subn(" ", _not_patterns.sub(" ", text))
+    features.extend(["scan"] * scans)
+    features.extend(["variable_predicate"] * len(_variable_predicate.findall(patterns)))
+    features.extend(["optional"] * max(0, len(_optional.findall(text)) - _FREE_OPTIONALS))
+    features.extend(["regex"] * len(_regex.findall(text)))
+    return sum(COST_WEIGHTS[feature] for feature in features), sorted(set(features))
+
+
+def has_update_keyword(query):
+    """Check whether a query uses any SPARQL Update keyword as a keyword"""
+    query = decode_escapes(query)
+    # Most queries do not contain any of these words at all
+    lowered = query.lower()
+    if not any(keyword in lowered for keyword in _lowered_keywords):
+        return False
+    return _update_keyword.search(_literal.sub(" ", query)) is not None
+
+
+def strict_is_update(query):
+    """Check whether a query is a SPARQL Update request by parsing it with rdflib"""
+    # Imported here since loading the rdflib parser is expensive and it is
+    # needed only when the strict check is enabled
+    from rdflib.plugins.sparql.parser import parseUpdate
+
+    query = re.sub(r'^\s*#.*$', '', query, flags=re.MULTILINE)
+    query = '\n'.join(line for line in query.splitlines() if line.strip())
+    try:
+        parseUpdate(query)
+        return True
+    except Exception:
+        return False
+
+
+def classify_query(query, strict=False):
+    """Return True if a query is a SPARQL Update request"""
+    verdict = has_update_keyword(query)
+    if not verdict and strict:
+        verdict = strict_is_update(query)
+    return verdict
+
+
+class ValidationUnavailable(Exception):
+    """Raised when a query cannot be validated because the validation pool is saturated or too slow"""
+
+
+class UpdateChecker:
+    """Classifier of SPARQL Update requests with a memo of recent verdicts.
+
+    The keyword check does not accept anything that could be executed as an
+    update; if strict is True, queries that pass it are also parsed with
+    rdflib, as a further guard.
+    """
+
+    def __init__(self, memo_size=4096, strict=False):
+        self.memo_size = memo_size
+        self.strict = strict
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_update(self, query):
+        key = hashlib.sha1(query.encode("utf-8")).digest()
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return self.memo[key]
+
+        verdict = self.classify(query)
+
+        if self.memo_size > 0:
+            with self.lock:
+                self.memo[key] = verdict
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        return verdict
+
+    def classify(self, query):
+        return classify_query(query, self.strict)
+
+
+class PooledUpdateChecker(UpdateChecker):
+    """Update checker that classifies queries in a pool of separate processes.
+
+    Parsing a large query is CPU bound and would otherwise block every other
+    greenlet of the gevent worker. At most max_pending queries can be waiting
+    for the pool or being classified: when the limit is reached, or when a
+    verdict does not arrive within timeout seconds, ValidationUnavailable is
+    raised.
+    """
+
+    def __init__(self, memo_size=4096, strict=False, workers=2, timeout=5, max_pending=64):
+        UpdateChecker.__init__(self, memo_size, strict)
+        self.workers = workers
+        self.timeout = timeout
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.pid = None
+
+    def __get_executor(self):
+        # The pool is created lazily by each worker process; spawn is used
+        # since forking a process running the gevent hub is not safe
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+                self.pid = os.getpid()
+            return self.executor
+
+    def classify(self, query):
+        if not self.pending.acquire(blocking=False):
+            raise ValidationUnavailable("Too many queries are waiting for validation")
+        try:
+            future = self.__get_executor().submit(classify_query, query, self.strict)
+        except Exception:
+            self.pending.release()
+            raise
+        # The slot is freed only when the process is done with the query,
+        # even if the request that submitted it has already given up
+        future.add_done_callback(lambda _: self.pending.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise ValidationUnavailable("Query validation timed out")
+
+
+def create_update_checker(conf):
+    """Create the update checker described by the update_check section of the configuration"""
+    if conf["mode"] == "process":
+        return PooledUpdateChecker(
+            conf["memo_size"], conf["strict"], conf["workers"], conf["timeout"], conf["max_pending"])
+    elif conf["mode"] == "inline":
+        return UpdateChecker(conf["memo_size"], conf["strict"])
+    else:
+        raise ValueError(f"Unknown update check mode: {conf['mode']}")
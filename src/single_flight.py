@@ -0,0 +1,344 @@
+import os
+import fcntl
+import asyncio
+import threading
+
+
+class FlightFailed(Exception):
+    """The request shared by a flight failed before or while sending its body"""
+
+
+class _Flight:
+    """Response of an upstream request shared by identical concurrent requests.
+
+    The producer publishes the status and headers with start(), then the body
+    chunk by chunk with feed(), and calls finish() at the end. Each request
+    sharing the flight subscribes to it and reads the chunks from the first
+    one. Chunks read by all the subscribers are dropped, and the producer
+    waits while more than max_buffer bytes are still to be read, so that a
+    slow client slows down the upstream download instead of filling the
+    memory. New requests can join only as long as no chunk has been dropped.
+
+    When all the subscribers are gone before the end, the flight is
+    abandoned and on_abandon is called, so that the producer can abort the
+    upstream request. A flight can also be finished early with an error, for
+    example when its deadline expires: start() and feed() are then ignored.
+    """
+
+    def __init__(self, max_buffer):
+        self.max_buffer = max_buffer
+        self.response = None
+        self.error = None
+        self.done = False
+        self.chunks = []
+        self.base = 0
+        self.buffered = 0
+        self.positions = {}
+        self.next_id = 0
+        self.joinable = True
+        self.abandoned = False
+        self.on_abandon = None
+        # Milliseconds the backend took to send the response headers
+        self.latency = None
+
+    def _subscribe(self):
+        subscriber = self.next_id
+        self.next_id += 1
+        self.positions[subscriber] = self.base
+        return subscriber
+
+    def _unsubscribe(self, subscriber):
+        if self.positions.pop(subscriber, None) is None:
+            return
+        self._trim()
+        if not self.positions and not self.done:
+            self.joinable = False
+            self.abandoned = True
+            if self.on_abandon is not None:
+                self.on_abandon()
+
+    def _trim(self):
+        low = min(self.positions.values(), default=self.base + len(self.chunks))
+        if low > self.base:
+            for chunk in self.chunks[:low - self.base]:
+                self.buffered -= len(chunk)
+            del self.chunks[:low - self.base]
+            self.base = low
+            self.joinable = False
+
+    def _take(self, subscriber):
+        """Return the chunks the subscriber has not read yet"""
+        position = self.positions[subscriber]
+        chunks = self.chunks[position - self.base:]
+        if chunks:
+            self.positions[subscriber] = self.base + len(self.chunks)
+            self._trim()
+        return chunks
+
+    def _append(self, chunk):
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+
+    def _ready(self, subscriber):
+        return self.done or self.positions[subscriber] < self.base + len(self.chunks)
+
+    def _full(self):
+        return self.buffered > self.max_buffer and self.positions and not self.abandoned and not self.done
+
+
+class Flight(_Flight):
+    """Flight shared by threads, or greenlets under gevent"""
+
+    def __init__(self, max_buffer):
+        super().__init__(max_buffer)
+        self.cond = threading.Condition()
+
+    def subscribe(self):
+        with self.cond:
+            return self._subscribe()
+
+    def start(self, status, headers, body=b""):
+        with self.cond:
+            if self.done:
+                return
+            self.response = (status, headers)
+            if body:
+                self._append(body)
+            self.cond.notify_all()
+
+    def feed(self, chunk):
+        """Publish a chunk, returning False if the flight has been abandoned or finished"""
+        with self.cond:
+            while self._full():
+                self.cond.wait()
+            if self.abandoned or self.done:
+                return False
+            self._append(chunk)
+            self.cond.notify_all()
+            return True
+
+    def finish(self, error=None):
+        with self.cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+                self.joinable = False
+                self.cond.notify_all()
+
+    def wait_response(self, subscriber, timeout=None):
+        """Return the (status, headers) of the response, raising FlightFailed if there is none,
+        or None if it is still missing after timeout seconds"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.response is not None or self.done, timeout):
+                return None
+            if self.response is None:
+                self._unsubscribe(subscriber)
+                raise FlightFailed(str(self.error or "No response from the SPARQL endpoint"))
+            return self.response
+
+    def follow(self, subscriber):
+        """Yield the chunks of the body"""
+        try:
+            while True:
+                with self.cond:
+                    while not self._ready(subscriber):
+                        self.cond.wait()
+                    chunks = self._take(subscriber)
+                    if chunks:
+                        self.cond.notify_all()
+                    elif self.error is not None:
+                        raise FlightFailed(str(self.error))
+                    else:
+                        return
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            self.unsubscribe(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.cond:
+            self._unsubscribe(subscriber)
+            self.cond.notify_all()
+
+
+class AsyncFlight(_Flight):
+    """Flight shared by the tasks of an asyncio event loop"""
+
+    def __init__(self, max_buffer):
+        super().__init__(max_buffer)
+        self.cond = asyncio.Condition()
+
+    def subscribe(self):
+        return self._subscribe()
+
+    async def start(self, status, headers, body=b""):
+        async with self.cond:
+            if self.done:
+                return
+            self.response = (status, headers)
+            if body:
+                self._append(body)
+            self.cond.notify_all()
+
+    async def feed(self, chunk):
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self._full())
+            if self.abandoned or self.done:
+                return False
+            self._append(chunk)
+            self.cond.notify_all()
+            return True
+
+    async def finish(self, error=None):
+        async with self.cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+                self.joinable = False
+                self.cond.notify_all()
+
+    async def wait_response(self, subscriber):
+        try:
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.response is not None or self.done)
+        except asyncio.CancelledError:
+            self._unsubscribe(subscriber)
+            raise
+        if self.response is None:
+            self._unsubscribe(subscriber)
+            raise FlightFailed(str(self.error or "No response from the SPARQL endpoint"))
+        return self.response
+
+    async def follow(self, subscriber):
+        try:
+            while True:
+                async with self.cond:
+                    await self.cond.wait_for(lambda: self._ready(subscriber))
+                    chunks = self._take(subscriber)
+                    if chunks:
+                        self.cond.notify_all()
+                    elif self.error is not None:
+                        raise FlightFailed(str(self.error))
+                    else:
+                        return
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            self.unsubscribe(subscriber)
+
+    def unsubscribe(self, subscriber):
+        # The condition is not needed, since nothing else runs until the
+        # next await; the producer may be waiting for room though
+        self._unsubscribe(subscriber)
+        asyncio.ensure_future(self.__wake())
+
+    async def __wake(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+
+class SingleFlight:
+    """Registry of the flights in progress in a worker.
+
+    join(key) returns (flight, subscriber, leader): the first request for a
+    key is the leader and must start the producer of the flight, the others
+    subscribe to the same flight while it is joinable. If disabled, or if key
+    is None, every request gets a flight of its own.
+    """
+
+    def __init__(self, flight_class, max_buffer=4 * 1024 * 1024, enabled=True):
+        self.flight_class = flight_class
+        self.max_buffer = max_buffer
+        self.enabled = enabled
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def join(self, key):
+        with self.lock:
+            shared = self.enabled and key is not None
+            flight = self.flights.get(key) if shared else None
+            if flight is not None and flight.joinable:
+                return flight, flight.subscribe(), False
+            flight = self.flight_class(self.max_buffer)
+            if shared:
+                self.flights[key] = flight
+            return flight, flight.subscribe(), True
+
+    def forget(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+
+class WorkerLocks:
+    """Locks on query keys shared by the workers, stored as files in a directory.
+
+    The worker holding the lock of a key is the only one sending that query
+    to the backend; the others wait for it to release the lock and then look
+    for the result in the shared result cache.
+    """
+
+    def __init__(self, directory, wait=30):
+        self.directory = directory
+        self.wait = wait
+        os.makedirs(directory, exist_ok=True)
+
+    def _acquire(self, key):
+        """Lock key, yielding the seconds to sleep while another worker holds it.
+
+        The value returned by the generator is (handle, waited); handle is
+        None if the lock could not be taken within wait seconds.
+        """
+        path = os.path.join(self.directory, key)
+        waited = 0.0
+        delay = 0.01
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if waited >= self.wait:
+                    return None, True
+                yield delay
+                waited += delay
+                delay = min(delay * 2, 0.1)
+                continue
+            # The previous holder may have removed the file in the meantime,
+            # in which case the lock is on a file nobody else can see
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return (path, fd), waited > 0
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def acquire(self, key, sleep):
+        steps = self._acquire(key)
+        try:
+            while True:
+                sleep(next(steps))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+    async def acquire_async(self, key):
+        steps = self._acquire(key)
+        try:
+            while True:
+                await asyncio.sleep(next(steps))
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+
+    @staticmethod
+    def release(handle):
+        if handle is not None:
+            path, fd = handle
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.close(fd)
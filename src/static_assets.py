@@ -0,0 +1,249 @@
+import os
+import gzip
+import time
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing: images and fonts such as woff are
+# compressed already
+COMPRESSIBLE_TYPES = frozenset([
+    "text/css",
+    "text/html",
+    "text/plain",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "image/x-icon",
+    "font/ttf",
+    "font/otf",
+    "application/vnd.ms-fontobject"
+])
+
+
+# Browsers can keep fingerprinted files forever, since any change of their
+# content changes their URL too
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def fingerprint(name, digest):
+    """Add the first characters of a content digest to a file name: css/custom.css -> css/custom.1a2b3c4d5e6f.css"""
+    base, ext = os.path.splitext(name)
+    return f"{base}.{digest[:12]}{ext}"
+
+
+class Asset:
+    def __init__(self, body, content_type, mtime, compress_min_size, gzip_level, brotli_quality):
+        self.body = body
+        self.content_type = content_type
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"%s"' % self.digest
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.compress_min_size = compress_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._variants = None
+
+    @property
+    def variants(self):
+        """Compressed variants of the body, computed on first use"""
+        if self._variants is None:
+            # Compressed variants are kept only when they are actually smaller
+            variants = {}
+            body = self.body
+            if self.content_type.split(";")[0] in COMPRESSIBLE_TYPES and len(body) >= self.compress_min_size:
+                if brotli is not None:
+                    compressed = brotli.compress(body, quality=self.brotli_quality)
+                    if len(compressed) < len(body):
+                        variants["br"] = compressed
+                compressed = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+                if len(compressed) < len(body):
+                    variants["gzip"] = compressed
+            self._variants = variants
+        return self._variants
+
+    def select(self, accept_encoding):
+        """Return the best (body, encoding) for an Accept-Encoding header"""
+        if self.variants and accept_encoding:
+            accepted = set()
+            for item in accept_encoding.split(","):
+                coding, _, params = item.strip().partition(";")
+                if params.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                    accepted.add(coding.strip().lower())
+            for encoding in ("br", "gzip"):
+                if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                    return self.variants[encoding], encoding
+        return self.body, None
+
+    def etag_for(self, encoding):
+        """Return the ETag of the variant of the body in encoding (None for the body itself),
+        since each representation needs an ETag of its own"""
+        if encoding is None:
+            return self.etag
+        return '"%s-%s"' % (self.digest, encoding)
+
+
+def respond_asset(asset, cache_control, if_none_match=None, if_modified_since=None, accept_encoding=None):
+    """Return the (status, headers, body) answering a request for an asset,
+    taking into account conditional request headers and accepted encodings"""
+    body, encoding = asset.select(accept_encoding)
+    etag = asset.etag_for(encoding)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": asset.last_modified,
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding"
+    }
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags or "W/" + etag in tags:
+            return 304, headers, b""
+    elif if_modified_since is not None:
+        try:
+            if parsedate_to_datetime(if_modified_since).timestamp() >= asset.mtime:
+                return 304, headers, b""
+        except (TypeError, ValueError):
+            pass
+
+    headers["Content-Type"] = asset.content_type
+    headers["Content-Length"] = str(len(body))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return 200, headers, body
+
+
+class AssetIndex:
+    """In-memory copy of the static files, built once so that serving them
+    does not touch the disk.
+
+    Each file is stored with its ETag and, for text formats, gzip and
+    brotli (if the brotli module is installed) variants, compressed on first
+    request or all at once by warm(). Files can also be requested by their
+    fingerprinted name (see url), in which case they are served with
+    far-future caching headers.
+    """
+
+    def __init__(self, root, content_types, max_age=3600, compress_min_size=1024,
+                 gzip_level=9, brotli_quality=5, url_prefix="/static/"):
+        self.root = root
+        self.url_prefix = url_prefix
+        self.content_types = content_types
+        self.max_age = max_age
+        self.compress_min_size = compress_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.assets = {}
+        self.fingerprinted = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def build(self):
+        """Load all the files under root, replacing the current index.
+
+        Files whose size and mtime did not change since the last build keep
+        their Asset, so that rebuilding after a sync only reads and
+        compresses the files that were updated.
+        """
+        assets = {}
+        stats = {}
+        # Synced folders are symbolic links to the current release
+        for dirpath, _, filenames in os.walk(self.root, followlinks=True):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                name = os.path.relpath(file_path, self.root).replace(os.sep, "/")
+                st = os.stat(file_path)
+                stats[name] = (st.st_mtime_ns, st.st_size)
+                if self.stats.get(name) == stats[name]:
+                    assets[name] = self.assets[name]
+                    continue
+                ext = os.path.splitext(filename)[1].lower()
+                with open(file_path, "rb") as f:
+                    body = f.read()
+                assets[name] = Asset(
+                    body, self.content_types.get(ext, "application/octet-stream"),
+                    st.st_mtime, self.compress_min_size,
+                    self.gzip_level, self.brotli_quality)
+        fingerprinted = {fingerprint(name, asset.digest): name for name, asset in assets.items()}
+        with self.lock:
+            self.assets = assets
+            self.fingerprinted = fingerprinted
+            self.stats = stats
+        return len(assets)
+
+    def warm(self):
+        """Compress all the files now rather than on their first request"""
+        for asset in self.assets.values():
+            asset.variants
+
+    def get(self, name):
+        return self.assets.get(name)
+
+    def url(self, name):
+        """Return the fingerprinted URL of a static file, to be used in templates.
+
+        Files that are not in the index keep their plain URL.
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            return self.url_prefix + name
+        return self.url_prefix + fingerprint(name, asset.digest)
+
+    def respond(self, name, if_none_match=None, if_modified_since=None, accept_encoding=None):
+        """Return the (status, headers, body) answering a request for a static file.
+
+        Only the files in the index are served, so that paths such as
+        "../conf.json" are never resolved on disk.
+        """
+        immutable = name in self.fingerprinted
+        asset = self.get(self.fingerprinted[name] if immutable else name)
+        if asset is None:
+            return 404, {"Content-Type": "text/plain"}, b"not found"
+
+        cache_control = IMMUTABLE_CACHE_CONTROL if immutable else f"public, max-age={self.max_age}"
+        return respond_asset(asset, cache_control, if_none_match, if_modified_since, accept_encoding)
+
+
+class ReleaseWatcher:
+    """Notice when sync_static.py activates a new release of the static files.
+
+    A release is activated by replacing the symbolic link path; its target
+    is read at most once every check_interval seconds, and on_change is
+    called when it differs from the last one seen, so that each worker
+    reloads its copy of the files without being restarted.
+    """
+
+    def __init__(self, path, check_interval=5, on_change=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.release = self.__read()
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __read(self):
+        try:
+            return os.readlink(self.path)
+        except OSError:
+            return None
+
+    def check(self, force=False):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval and not force:
+            return
+        with self.lock:
+            if now - self.checked < self.check_interval and not force:
+                return
+            self.checked = now
+            release = self.__read()
+            if release == self.release:
+                return
+            self.release = release
+        print(f"Static files release changed to {release}, reloading")
+        if self.on_change is not None:
+            self.on_change()
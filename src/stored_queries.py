@@ -0,0 +1,167 @@
+import re
+import json
+import hashlib
+
+from src.batch import format_iri, format_string
+from src.query_check import split_literals, query_form, classify_query, estimate_cost
+
+OMID_BASE = "https://w3id.org/oc/meta/"
+
+# Parameters are written in the templates as variables with a $ sign, while
+# the variables of the query itself use ?; the template is thus a valid
+# query whose parameters are replaced by terms
+_parameter = re.compile(r'(?<![\w?$])\$(\w+)')
+_name = re.compile(r'^[\w-]+$')
+_integer = re.compile(r'^[+-]?\d+$')
+_doi = re.compile(r'^10\.\d{4,9}/\S+$')
+_omid = re.compile(r'^(?:br|ra|id|ar|re)/\d+$')
+
+
+class ParameterError(ValueError):
+    """Raised when the value of a parameter of a stored query is not valid"""
+
+
+def format_integer(value):
+    if _integer.match(value) is None:
+        raise ParameterError(f"Invalid integer: {value!r}")
+    return str(int(value))
+
+
+def format_doi(value):
+    value = value.strip()
+    for prefix in ("doi:", "https://doi.org/", "http://doi.org/", "http://dx.doi.org/"):
+        if value.lower().startswith(prefix):
+            value = value[len(prefix):]
+    # DOIs are case insensitive, and stored in lower case
+    value = value.lower()
+    if _doi.match(value) is None:
+        raise ParameterError(f"Invalid DOI: {value!r}")
+    return format_string(value)
+
+
+def format_omid(value):
+    value = value.strip()
+    for prefix in ("omid:", OMID_BASE):
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+    if _omid.match(value) is None:
+        raise ParameterError(f"Invalid OMID: {value!r}")
+    return "<%s%s>" % (OMID_BASE, value)
+
+
+# Types of the parameters, and the function writing a value as a term,
+# raising ValueError if it is not valid
+PARAMETER_TYPES = {
+    "string": format_string,
+    "integer": format_integer,
+    "iri": format_iri,
+    "doi": format_doi,
+    "omid": format_omid
+}
+
+
+# Terms standing for the parameters when the cost of a template is estimated,
+# an IRI unless the parameter is an integer
+_PLACEHOLDERS = {"integer": "1"}
+
+
+class StoredQuery:
+    """Query template with typed parameters, compiled when it is loaded.
+
+    The template is split once around its parameters, so that running it
+    only joins the pieces with the terms written for the values; since
+    these are terms that cannot change the query around them, the update
+    check and the cost estimate of the template hold for every value.
+    Each parameter is described by its type, or by an object with a "type"
+    and a "default" value for the optional ones.
+    """
+
+    def __init__(self, name, template, params=None, description=None):
+        if _name.match(name) is None:
+            raise ValueError(f"Invalid name of stored query: {name!r}")
+        self.name = name
+        self.template = template
+        self.description = description
+        self.types = {}
+        self.defaults = {}
+        for param, spec in (params or {}).items():
+            if isinstance(spec, str):
+                spec = {"type": spec}
+            if spec.get("type") not in PARAMETER_TYPES:
+                raise ValueError(f"Unknown type of parameter {param} of stored query {name}: {spec.get('type')}")
+            if param == "timeout":
+                raise ValueError(f"timeout cannot be a parameter of stored query {name}")
+            self.types[param] = spec["type"]
+            if "default" in spec:
+                self.defaults[param] = PARAMETER_TYPES[spec["type"]](str(spec["default"]))
+
+        # Pieces of the template, alternating text and parameter names
+        self.pieces = [""]
+        for i, part in enumerate(split_literals(template)):
+            if i % 2:
+                self.pieces[-1] += part
+                continue
+            position = 0
+            for match in _parameter.finditer(part):
+                self.pieces[-1] += part[position:match.start()]
+                self.pieces.extend((match.group(1), ""))
+                position = match.end()
+            self.pieces[-1] += part[position:]
+        used = set(self.pieces[1::2])
+        if used != set(self.types):
+            raise ValueError(f"The parameters of stored query {name} do not match its template: "
+                             f"{sorted(used)} used, {sorted(self.types)} declared")
+        if query_form(template) is None:
+            raise ValueError(f"Stored query {name} is not a SELECT, ASK, CONSTRUCT or DESCRIBE query")
+
+        # Cache keys change with the template
+        self.key = "%s:%s" % (name, hashlib.sha1(template.encode("utf-8")).hexdigest()[:16])
+        # The cost is estimated with a term of the type of each parameter, so
+        # that for instance LIMIT $limit still bounds the results
+        self.cost = estimate_cost(self.query(
+            {param: _PLACEHOLDERS.get(kind, "<>") for param, kind in self.types.items()}))
+
+    def query(self, terms):
+        pieces = list(self.pieces)
+        for i in range(1, len(pieces), 2):
+            pieces[i] = terms[pieces[i]]
+        return "".join(pieces)
+
+    def bind(self, values):
+        """Return the query for values, a dict of the parameters given by the client, and
+        the terms written for them, raising ValueError if one is missing, unknown or not valid"""
+        terms = dict(self.defaults)
+        for param, value in values.items():
+            if param not in self.types:
+                raise ParameterError(f"Unknown parameter of stored query {self.name}: {param}")
+            terms[param] = PARAMETER_TYPES[self.types[param]](value)
+        missing = [param for param in self.types if param not in terms]
+        if missing:
+            raise ParameterError(f"Missing parameters of stored query {self.name}: {', '.join(missing)}")
+        return self.query(terms), terms
+
+    def describe(self):
+        params = {param: {"type": kind} for param, kind in self.types.items()}
+        for param in self.defaults:
+            params[param]["optional"] = True
+        return {"description": self.description, "params": params, "query": self.template}
+
+
+def load_stored_queries(path, endpoints, strict=False):
+    """Load the stored queries of each endpoint from a JSON file.
+
+    The file maps each endpoint to its queries, by name. Every template is
+    checked here, and loading fails on the first one that is not valid or
+    that is a SPARQL Update request.
+    """
+    with open(path) as f:
+        conf = json.load(f)
+    stored = {}
+    for endpoint in endpoints:
+        stored[endpoint] = {}
+        for name, spec in conf.get(endpoint, {}).items():
+            query = StoredQuery(name, spec["query"], spec.get("params"), spec.get("description"))
+            if classify_query(query.template, strict):
+                raise ValueError(f"Stored query {name} of {endpoint} is a SPARQL Update request")
+            stored[endpoint][name] = query
+    return stored
@@ -0,0 +1,32 @@
+import sys
+import subprocess
+
+
+def run_sync(swap=True):
+    """Run sync_static.py in a separate process, returning True if it succeeded"""
+    command = [sys.executable, "sync_static.py", "--auto"]
+    if swap:
+        command.append("--swap")
+    try:
+        subprocess.run(command, check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"ERROR: Static sync failed: {e}")
+    except Exception as e:
+        print(f"ERROR: Unexpected error during sync: {e}")
+    return False
+
+
+def start_scheduler(interval):
+    """Start a process running the static sync every interval seconds, and return it.
+
+    Each run stages the updates into a new release and switches to it
+    atomically; the workers notice the switch and reload the static files
+    and templates (see ReleaseWatcher in static_assets.py). The schedule
+    runs in its own process rather than in a thread of the Gunicorn master,
+    which the workers could inherit as greenlets when the master is patched
+    by gevent; the process stops when its parent exits.
+    """
+    process = subprocess.Popen([sys.executable, "sync_static.py", "--auto", "--swap", "--interval", str(interval)])
+    print(f"Static sync scheduled every {interval:g} seconds (pid {process.pid})")
+    return process
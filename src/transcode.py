@@ -0,0 +1,554 @@
+import io
+import re
+import csv
+import json
+import codecs
+import xml.parsers.expat
+
+XML = "application/sparql-results+xml"
+JSON = "application/sparql-results+json"
+CSV = "text/csv"
+TSV = "text/tab-separated-values"
+
+# Media types of SPARQL results, and the format each of them stands for
+MEDIA_TYPES = {
+    XML: XML,
+    JSON: JSON,
+    "application/json": JSON,
+    CSV: CSV,
+    TSV: TSV
+}
+
+# Content-Type of the results written in each format
+CONTENT_TYPES = {
+    XML: "application/sparql-results+xml",
+    JSON: "application/sparql-results+json",
+    CSV: "text/csv; charset=utf-8",
+    TSV: "text/tab-separated-values; charset=utf-8"
+}
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+# Name of the xml:lang attribute given by expat
+_XML_LANG = "http://www.w3.org/XML/1998/namespace lang"
+
+
+def media_type(content_type):
+    """Return the format of a Content-Type or Accept entry, or None if it is not a SPARQL results format"""
+    return MEDIA_TYPES.get((content_type or "").split(";")[0].strip().lower())
+
+
+def negotiate(accept, native, form):
+    """Choose how to ask the backend for the results of a query.
+
+    native lists the results formats the backend writes itself, the first
+    being the one converted to the others. Return (upstream_accept,
+    conversion): the backend is asked for native[0], and conversion is
+    (native[0], target), only when the client prefers a results format that
+    is not native and the query returns results (SELECT or ASK). Otherwise
+    the Accept header of the client is sent as it is, so that the backend
+    answers in that format unchanged, and conversion is None. Accept entries
+    are considered in order of preference, and a wildcard before any results
+    format leaves the choice to the backend.
+    """
+    if not native or form not in ("SELECT", "ASK"):
+        return accept, None
+    entries = []
+    for i, entry in enumerate(accept.split(",")):
+        name, _, params = entry.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            entries.append((-q, i, name.strip().lower()))
+    for _, _, name in sorted(entries):
+        if name.endswith("/*"):
+            return accept, None
+        target = MEDIA_TYPES.get(name)
+        if target is not None:
+            source = MEDIA_TYPES.get(native[0])
+            if source not in READERS or any(MEDIA_TYPES.get(name) == target for name in native):
+                return accept, None
+            return native[0], (source, target)
+    return accept, None
+
+
+class _Reader:
+    """Incremental parser of SPARQL results.
+
+    feed() and close() return a list of events: ("head", vars) always comes
+    first, followed by a ("row", binding) for each solution or by a single
+    ("boolean", value). Bindings map variable names to terms shaped as in the
+    JSON format, e.g. {"type": "literal", "value": "1", "datatype": "..."}.
+    """
+
+    def __init__(self):
+        self.vars = None
+        self.pending = []
+
+    def _head(self, events, variables):
+        if self.vars is None:
+            self.vars = list(variables)
+            events.append(("head", self.vars))
+            events.extend(self.pending)
+            self.pending = []
+
+    def _row(self, events, binding):
+        if self.vars is None:
+            self.pending.append(("row", binding))
+        else:
+            events.append(("row", binding))
+
+    def _end(self, events):
+        if self.vars is None:
+            # Results without a head: the variables are the bound ones
+            variables = []
+            for _, binding in self.pending:
+                variables.extend(name for name in binding if name not in variables)
+            self._head(events, variables)
+        return events
+
+
+class XmlReader(_Reader):
+    """Parser of SPARQL results XML, handling each element as it is read instead of building a tree"""
+
+    def __init__(self):
+        super().__init__()
+        self.parser = xml.parsers.expat.ParserCreate(namespace_separator=" ")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.__start
+        self.parser.EndElementHandler = self.__end
+        self.parser.CharacterDataHandler = self.__text
+        self.events = []
+        self.variables = []
+        self.binding = None
+        self.name = None
+        # Terms being read and, within triples, the part each term is
+        self.terms = []
+        self.parts = []
+        self.text = None
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+        events, self.events = self.events, []
+        return events
+
+    def close(self):
+        self.parser.Parse(b"", True)
+        events, self.events = self.events, []
+        return self._end(events)
+
+    def __start(self, tag, attributes):
+        tag = tag[tag.find(" ") + 1:]
+        if tag in ("uri", "literal", "bnode"):
+            term = {"type": tag, "value": ""}
+            if attributes.get(_XML_LANG):
+                term["xml:lang"] = attributes[_XML_LANG]
+            if attributes.get("datatype"):
+                term["datatype"] = attributes["datatype"]
+            self.terms.append(term)
+            self.text = []
+        elif tag == "binding":
+            self.name = attributes.get("name")
+        elif tag == "result":
+            self.binding = {}
+        elif tag == "variable":
+            self.variables.append(attributes.get("name"))
+        elif tag == "results":
+            self._head(self.events, self.variables)
+        elif tag == "triple":
+            self.terms.append({"type": "triple", "value": {}})
+        elif tag in ("subject", "predicate", "object"):
+            self.parts.append(tag)
+        elif tag == "boolean":
+            self.text = []
+
+    def __end(self, tag):
+        tag = tag[tag.find(" ") + 1:]
+        if tag in ("uri", "literal", "bnode"):
+            term = self.terms.pop()
+            term["value"] = "".join(self.text)
+            self.text = None
+            self.__put(term)
+        elif tag == "result":
+            self._row(self.events, self.binding)
+        elif tag == "triple":
+            self.__put(self.terms.pop())
+        elif tag == "boolean":
+            self._head(self.events, self.variables)
+            self.events.append(("boolean", "".join(self.text).strip() == "true"))
+            self.text = None
+
+    def __put(self, term):
+        if self.parts:
+            self.terms[-1]["value"][self.parts.pop()] = term
+        else:
+            self.binding[self.name] = term
+
+    def __text(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_KEY = re.compile(r'("(?:[^"\\]|\\.)*")[ \t\n\r]*:')
+
+
+class JsonReader(_Reader):
+    """Parser of SPARQL results JSON, decoding one binding at a time.
+
+    Only the members of the top-level object and of "results" are scanned
+    here; the head and each binding are small values decoded as a whole
+    once all their characters have arrived.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        # Position in the document: the object being scanned and, after a
+        # key has been read, the key whose value comes next
+        self.state = "start"
+        self.key = None
+
+    def feed(self, data):
+        self.buffer += self.text.decode(data)
+        events = []
+        pos = self.__scan(events)
+        self.buffer = self.buffer[pos:]
+        return events
+
+    def close(self):
+        self.buffer += self.text.decode(b"", final=True)
+        events = []
+        pos = self.__scan(events)
+        if self.state != "end" or self.buffer[pos:].strip():
+            raise ValueError("Truncated SPARQL JSON results")
+        return self._end(events)
+
+    def __scan(self, events):
+        buffer = self.buffer
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer) or self.state == "end":
+                return pos
+            char = buffer[pos]
+            if self.state == "start":
+                if char != "{":
+                    raise ValueError("SPARQL JSON results must be an object")
+                self.state, pos = "top", pos + 1
+            elif self.key is None:
+                # Between the members of an object or the items of bindings
+                if char == ",":
+                    pos += 1
+                elif self.state == "bindings" and char == "]":
+                    self.state, pos = "results", pos + 1
+                elif self.state == "bindings":
+                    try:
+                        binding, pos = self.decoder.raw_decode(buffer, pos)
+                    except ValueError:
+                        return pos
+                    self._row(events, binding)
+                elif char == "}":
+                    self.state, pos = "top" if self.state == "results" else "end", pos + 1
+                else:
+                    if char != '"':
+                        raise ValueError("Invalid SPARQL JSON results")
+                    match = _KEY.match(buffer, pos)
+                    if match is None:
+                        return pos
+                    self.key, pos = json.loads(match.group(1)), match.end()
+            elif (self.state, self.key) in (("top", "results"), ("results", "bindings")):
+                if char != ("{" if self.key == "results" else "["):
+                    raise ValueError("Invalid SPARQL JSON results")
+                self.state, self.key, pos = self.key, None, pos + 1
+            else:
+                try:
+                    value, pos = self.decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    return pos
+                if self.state == "top" and self.key == "head":
+                    self._head(events, value.get("vars", []))
+                elif self.state == "top" and self.key == "boolean":
+                    self._head(events, [])
+                    events.append(("boolean", bool(value)))
+                self.key = None
+
+
+_NUMBER = re.compile(r"^[+-]?(?:(\d+)|(\d*\.\d+)|((?:\d+\.?\d*|\.\d+)[eE][+-]?\d+))$")
+_STRING_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+
+
+class TsvReader(_Reader):
+    """Parser of SPARQL results TSV, whose values are RDF terms in Turtle syntax"""
+
+    def __init__(self):
+        super().__init__()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+
+    def feed(self, data):
+        self.buffer += self.text.decode(data)
+        *lines, self.buffer = self.buffer.split("\n")
+        return self.__events(lines)
+
+    def close(self):
+        rest = self.buffer + self.text.decode(b"", final=True)
+        self.buffer = ""
+        return self._end(self.__events([rest] if rest else []))
+
+    def __events(self, lines):
+        events = []
+        for line in lines:
+            line = line.rstrip("\r")
+            if self.vars is None:
+                if line:
+                    self._head(events, [name.lstrip("?$") for name in line.split("\t")])
+            elif line or len(self.vars) == 1:
+                binding = {}
+                for name, value in zip(self.vars, line.split("\t")):
+                    if value:
+                        binding[name] = _tsv_term(value)
+                self._row(events, binding)
+        return events
+
+
+def _tsv_term(value):
+    if value.startswith("<") and value.endswith(">") and not value.startswith("<<"):
+        return {"type": "uri", "value": value[1:-1]}
+    if value.startswith("_:"):
+        return {"type": "bnode", "value": value[2:]}
+    if value.startswith('"'):
+        # Language tags and datatype IRIs cannot contain quotes
+        end = value.rindex('"')
+        if end == 0:
+            raise ValueError("Invalid literal in SPARQL TSV results: %s" % value)
+        text = value[1:end]
+        term = {"type": "literal", "value": _STRING_ESCAPE.sub(_unescape, text) if "\\" in text else text}
+        suffix = value[end + 1:]
+        if suffix.startswith("@"):
+            term["xml:lang"] = suffix[1:]
+        elif suffix.startswith("^^<"):
+            term["datatype"] = suffix[3:-1]
+        return term
+    match = _NUMBER.match(value)
+    if match:
+        kind = "integer" if match.group(1) else "decimal" if match.group(2) else "double"
+        return {"type": "literal", "value": value, "datatype": XSD + kind}
+    if value in ("true", "false"):
+        return {"type": "literal", "value": value, "datatype": XSD + "boolean"}
+    # Anything else, such as quoted triples, is kept as it is
+    return {"type": "literal", "value": value}
+
+
+def _unescape(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return chr(int(code, 16))
+    return _ESCAPES.get(match.group(3), match.group(0))
+
+
+class _Writer:
+    """Serializer of SPARQL results, receiving the events of a _Reader.
+
+    The beginning of the document is written with the first row, or at the
+    end, since the results of an ASK query are laid out differently.
+    """
+
+    def __init__(self):
+        self.vars = []
+        self.started = False
+        self.finished = False
+
+    def head(self, variables):
+        self.vars = variables
+        return ""
+
+    def row(self, binding):
+        prefix = "" if self.started else self._start()
+        self.started = True
+        return prefix + self._row(binding)
+
+    def boolean(self, value):
+        self.started = self.finished = True
+        return self._boolean("true" if value else "false")
+
+    def end(self):
+        if self.finished:
+            return ""
+        prefix = "" if self.started else self._start()
+        self.started = self.finished = True
+        return prefix + self._end()
+
+
+class JsonWriter(_Writer):
+    def _start(self):
+        self.separator = ""
+        return '{"head": {"vars": %s}, "results": {"bindings": [' % json.dumps(self.vars)
+
+    def _row(self, binding):
+        text = self.separator + json.dumps(binding, ensure_ascii=False)
+        self.separator = ", "
+        return text
+
+    def _end(self):
+        return "]}}"
+
+    def _boolean(self, value):
+        return '{"head": {}, "boolean": %s}' % value
+
+
+def _escape(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _attribute(value):
+    return '"%s"' % _escape(value).replace('"', "&quot;")
+
+
+class XmlWriter(_Writer):
+    def _start(self):
+        self.bindings = {name: "<binding name=%s>" % _attribute(name) for name in self.vars}
+        variables = "".join("<variable name=%s/>" % _attribute(name) for name in self.vars)
+        return ('<?xml version="1.0"?>\n<sparql xmlns="http://www.w3.org/2005/sparql-results#">\n'
+                "<head>%s</head>\n<results>\n" % variables)
+
+    def _row(self, binding):
+        parts = ["<result>"]
+        for name, term in binding.items():
+            parts.append(self.bindings.get(name) or "<binding name=%s>" % _attribute(name))
+            parts.append(_xml_value(term))
+            parts.append("</binding>")
+        parts.append("</result>\n")
+        return "".join(parts)
+
+    def _end(self):
+        return "</results>\n</sparql>\n"
+
+    def _boolean(self, value):
+        return ('<?xml version="1.0"?>\n<sparql xmlns="http://www.w3.org/2005/sparql-results#">\n'
+                "<head></head>\n<boolean>%s</boolean>\n</sparql>\n" % value)
+
+
+def _xml_value(term):
+    kind = term["type"]
+    if kind == "uri":
+        return "<uri>%s</uri>" % _escape(term["value"])
+    if kind in ("literal", "typed-literal"):
+        if "xml:lang" in term:
+            return "<literal xml:lang=%s>%s</literal>" % (_attribute(term["xml:lang"]), _escape(term["value"]))
+        if "datatype" in term:
+            return "<literal datatype=%s>%s</literal>" % (_attribute(term["datatype"]), _escape(term["value"]))
+        return "<literal>%s</literal>" % _escape(term["value"])
+    if kind == "triple":
+        return "<triple>%s</triple>" % "".join(
+            "<%s>%s</%s>" % (part, _xml_value(value), part) for part, value in term["value"].items())
+    return "<%s>%s</%s>" % (kind, _escape(term["value"]), kind)
+
+
+class CsvWriter(_Writer):
+    """SPARQL results CSV, which keeps only the values of the terms"""
+
+    def __init__(self):
+        super().__init__()
+        self.out = io.StringIO()
+        self.writer = csv.writer(self.out, lineterminator="\r\n")
+
+    def __line(self, values):
+        self.writer.writerow(values)
+        text = self.out.getvalue()
+        self.out.seek(0)
+        self.out.truncate()
+        return text
+
+    def _start(self):
+        return self.__line(self.vars)
+
+    def _row(self, binding):
+        return self.__line([_csv_value(binding[name]) if name in binding else "" for name in self.vars])
+
+    def _end(self):
+        return ""
+
+    def _boolean(self, value):
+        return self.__line(["_askResult"]) + self.__line([value])
+
+
+def _csv_value(term):
+    if term["type"] == "bnode":
+        return "_:" + term["value"]
+    if term["type"] == "triple":
+        return _tsv_value(term)
+    return term["value"]
+
+
+class TsvWriter(_Writer):
+    def _start(self):
+        return "\t".join("?" + name for name in self.vars) + "\n"
+
+    def _row(self, binding):
+        return "\t".join(_tsv_value(binding[name]) if name in binding else "" for name in self.vars) + "\n"
+
+    def _end(self):
+        return ""
+
+    def _boolean(self, value):
+        return "?_askResult\n%s\n" % value
+
+
+def _tsv_value(term):
+    kind = term["type"]
+    if kind == "uri":
+        return "<%s>" % term["value"]
+    if kind == "bnode":
+        return "_:" + term["value"]
+    if kind == "triple":
+        return "<< %s >>" % " ".join(
+            _tsv_value(term["value"][part]) for part in ("subject", "predicate", "object"))
+    value = '"%s"' % (term["value"].replace("\\", "\\\\").replace('"', '\\"')
+                      .replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t"))
+    if "xml:lang" in term:
+        return value + "@" + term["xml:lang"]
+    if "datatype" in term:
+        return value + "^^<%s>" % term["datatype"]
+    return value
+
+
+READERS = {XML: XmlReader, JSON: JsonReader, TSV: TsvReader}
+WRITERS = {XML: XmlWriter, JSON: JsonWriter, CSV: CsvWriter, TSV: TsvWriter}
+
+
+class Transcoder:
+    """Convert SPARQL results from source to target format, chunk by chunk.
+
+    Memory stays bounded by the size of a single solution, whatever the size
+    of the results.
+    """
+
+    def __init__(self, source, target):
+        self.reader = READERS[source]()
+        self.writer = WRITERS[target]()
+
+    def __write(self, events):
+        parts = []
+        for event, value in events:
+            if event == "row":
+                parts.append(self.writer.row(value))
+            elif event == "head":
+                parts.append(self.writer.head(value))
+            else:
+                parts.append(self.writer.boolean(value))
+        return "".join(parts).encode("utf-8")
+
+    def feed(self, chunk):
+        return self.__write(self.reader.feed(chunk))
+
+    def close(self):
+        return self.__write(self.reader.close()) + self.writer.end().encode("utf-8")
@@ -0,0 +1,94 @@
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ReadTimeoutError
+
+
+class _Retry(Retry):
+    """Resend requests that failed on a stale connection, but not the ones
+    that timed out: the backend is still computing those queries"""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class UpstreamPool:
+    """Keep-alive HTTP session towards a single SPARQL backend.
+
+    Each worker process owns its own pool: if the process has been forked
+    after the pool was created, the inherited connections are dropped and a
+    fresh session is built. Connections that stayed idle longer than
+    idle_timeout are discarded as well, since the backend or a load balancer
+    in between has most likely closed them already.
+    """
+
+    def __init__(self, endpoint, pool_size=50, keep_alive=True, idle_timeout=60, retries=1):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+
+        self.lock = threading.Lock()
+        self.session = None
+        self.pid = None
+        self.last_used = 0
+
+    def __new_session(self):
+        # Queries are read-only (updates are rejected before reaching this
+        # point), so a POST can be safely resent when a pooled connection
+        # turns out to be stale
+        retry = _Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=0,
+            redirect=0,
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def get_session(self):
+        """Return the session of the current process, renewing it if needed"""
+        with self.lock:
+            now = time.monotonic()
+            idle = self.idle_timeout and now - self.last_used > self.idle_timeout
+            if self.session is None or self.pid != os.getpid() or idle:
+                if self.session is not None and self.pid == os.getpid():
+                    self.session.close()
+                self.session = self.__new_session()
+                self.pid = os.getpid()
+            self.last_used = now
+            return self.session
+
+    def request(self, method, url, **kwargs):
+        return self.get_session().request(method, url, **kwargs)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(endpoint, **options):
+    """Return the pool shared by every handler that targets the same endpoint"""
+    with _pools_lock:
+        if endpoint not in _pools:
+            _pools[endpoint] = UpstreamPool(endpoint, **options)
+        return _pools[endpoint]
@@ -14,57 +14,192 @@
 # SOFTWARE.
 
 __author__ = 'essepuntato'
-import logging
-import web
+import os
+import json
+import time
+import atexit
+import importlib
+import threading
+from collections import deque
 from datetime import datetime
 from os import sep, path, makedirs
 
+import web
+
+try:
+    from gevent.monkey import get_original
+except ImportError:
+    def get_original(module, name):
+        return getattr(importlib.import_module(module), name)
+
+# The writer runs in an OS thread even when gevent has patched the standard
+# library, so that writing the file never blocks the event loop of a worker
+_start_new_thread = get_original("_thread", "start_new_thread")
+_allocate_lock = get_original("_thread", "allocate_lock")
+_sleep = get_original("time", "sleep")
+
+
 class WebLogger(object):
-    def __init__(self, name, log_dir, list_of_web_var=[], filter_request={}):
-        self.l = logging.getLogger(name)
-        self.vars = list_of_web_var
-        self.filter = filter_request
+    """Access log of a web.py application, one file per month in log_dir.
+
+    mes() only takes the values of list_of_web_var from the WSGI environment
+    of the request and appends them to a queue; a background OS thread takes
+    the records in batches of up to batch_size, formats them and writes each
+    batch with a single call, at least every flush_interval seconds. When the
+    queue holds max_queue records, new ones are dropped (and counted in
+    dropped) instead of slowing down the requests. Records that could not be
+    written are retried with the next batch, reopening the file, and counted
+    in failed when more than max_queue of them are waiting.
 
-        # Configure logger
-        self.l.setLevel(logging.INFO)
+    With json_lines, each record is written as a JSON object, otherwise in
+    the original "date # VAR: value ..." format.
+    """
 
+    def __init__(self, name, log_dir, list_of_web_var=[], filter_request={}, json_lines=False,
+                 batch_size=256, flush_interval=1.0, max_queue=10000):
+        self.name = name
+        self.vars = list_of_web_var
+        self.filter = filter_request
         self.log_dir = log_dir
+        self.json_lines = json_lines
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.failed = 0
+
+        self.records = deque()
+        self.retry = []
+        self.pid = None
+        self.lock = threading.Lock()
+        self.write_lock = _allocate_lock()
+        self.file = None
         self.month = None
+        self.next_month = 0
+
+    def mes(self, env=None, **fields):
+        """Log the current request, or the one whose WSGI environment is env.
+
+        Additional fields (e.g. status, bytes) are logged after the variables.
+        """
+        if env is None:
+            env = web.ctx.env
+        values = tuple(env.get(var) for var in self.vars)
+        for var, value in zip(self.vars, values):
+            if var in self.filter and str(value) in self.filter[var]:
+                return
+        records = self.__records()
+        # Appending to a deque is atomic, so greenlets and the writer thread
+        # need no lock that would block the event loop
+        if len(records) >= self.max_queue:
+            self.dropped += 1
+        else:
+            records.append((time.time(), values, fields))
+
+    def __records(self):
+        # The writer is started in each process using the logger, since
+        # threads do not survive a fork
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.records = deque()
+                    self.retry = []
+                    self.file = None
+                    self.month = None
+                    self.next_month = 0
+                    _start_new_thread(self.__write_loop, (self.records,))
+                    atexit.register(self.flush)
+                    self.pid = os.getpid()
+        return self.records
+
+    def __write_loop(self, records):
+        while True:
+            # Records are written once a batch is full, or after waiting flush_interval
+            if len(records) < self.batch_size or self.retry:
+                _sleep(self.flush_interval)
+            if records or self.retry:
+                self.__write([records.popleft() for _ in range(min(self.batch_size, len(records)))])
+
+    def flush(self):
+        """Write the records still in the queue"""
+        batch = []
+        while self.records:
+            batch.append(self.records.popleft())
+        if batch or self.retry:
+            self.__write(batch)
+
+    def __write(self, batch):
+        """Write the records waiting for a retry and batch, returning False if it failed"""
+        with self.write_lock:
+            batch = self.retry + batch
+            try:
+                self.__write_batch(batch)
+                self.retry = []
+                return True
+            except Exception:
+                # The file is opened again for the next attempt
+                if self.file is not None:
+                    try:
+                        self.file.close()
+                    except Exception:
+                        pass
+                self.file = None
+                self.month = None
+                self.next_month = 0
+                excess = len(batch) - self.max_queue
+                if excess > 0:
+                    self.failed += excess
+                    batch = batch[excess:]
+                self.retry = batch
+                return False
+
+    def __write_batch(self, batch):
+        lines = []
+        for timestamp, values, fields in batch:
+            if timestamp >= self.next_month:
+                # Records are in order, so rotation only happens between them
+                self.__flush_lines(lines)
+                lines = []
+                self.__open(timestamp)
+            lines.append(self.__format(timestamp, values, fields))
+        self.__flush_lines(lines)
+
+    def __flush_lines(self, lines):
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+
+    def __open(self, timestamp):
+        now = datetime.fromtimestamp(timestamp)
+        if now.month == 12:
+            next_month = datetime(now.year + 1, 1, 1)
+        else:
+            next_month = datetime(now.year, now.month + 1, 1)
+        self.next_month = next_month.timestamp()
+
+        month = now.strftime('%Y-%m')
+        if month != self.month:
+            if self.file is not None:
+                self.file.close()
+            self.month = month
+            extension = ".jsonl" if self.json_lines else ".txt"
+            file_path = self.log_dir + sep + "oc-" + self.month + extension
+            file_dir = path.dirname(file_path)
+            if not path.exists(file_dir):
+                makedirs(file_dir, exist_ok=True)
+            # Appending with one write per batch keeps the lines of the
+            # workers sharing the file whole
+            self.file = open(file_path, "a", encoding="utf-8")
 
-        # Add a file handler if it is not set yet
-        self.__set_file_handler()
-
-    def __set_file_handler(self):
-        cur_month = datetime.now().strftime('%Y-%m')
-        if self.month != cur_month:
-            for fh in self.l.handlers:
-                if isinstance(fh, logging.FileHandler):
-                    self.l.removeHandler(fh)
-
-            self.month = cur_month
-            file_path = self.log_dir + sep + "oc-" + self.month + ".txt"
-            if not path.exists(file_path):
-                file_dir = path.dirname(file_path)
-                if not path.exists(file_dir):
-                    makedirs(file_dir)
-                open(file_path, "a").close()
-
-            file_handler = logging.FileHandler(file_path)
-            log_formatter = logging.Formatter('%(asctime)s %(message)s')
-            file_handler.setFormatter(log_formatter)
-            file_handler.setLevel(logging.INFO)
-            self.l.addHandler(file_handler)
-
-    def mes(self):
-        cur_message = ""
-        must_be_filtered = False
-        for var in self.vars:
-            cur_value = str(web.ctx.env.get(var))
-            if var in self.filter and cur_value in self.filter[var]:
-                must_be_filtered = True
-            cur_message += "# %s: %s " % (var, cur_value)
-        if not must_be_filtered:
-            # Use the correct file handler
-            self.__set_file_handler()
-            self.l.info(cur_message)
+    def __format(self, timestamp, values, fields):
+        if self.json_lines:
+            record = {"time": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds")}
+            record.update(zip(self.vars, values))
+            record.update(fields)
+            return json.dumps(record, ensure_ascii=False) + "\n"
 
+        # Same format as logging.Formatter('%(asctime)s %(message)s')
+        date = datetime.fromtimestamp(timestamp)
+        message = "".join("# %s: %s " % (var, value) for var, value in zip(self.vars, values))
+        message += "".join("# %s: %s " % (key, value) for key, value in fields.items())
+        return "%s,%03d %s\n" % (date.strftime("%Y-%m-%d %H:%M:%S"), date.microsecond // 1000, message)
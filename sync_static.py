@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 import os
+import sys
+import time
 import shutil
 from git import Repo
 import tempfile
 import argparse
 import json
 import hashlib
-from typing import Dict, List, Tuple, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 
 # Load the configuration file
 with open("conf.json") as f:
@@ -15,9 +18,20 @@ with open("conf.json") as f:
 OC_SERVICES_TEMPLATES = os.getenv("OC_SERVICES_TEMPLATES", c["oc_services_templates"])
 
 class SyncConfig:
-    def __init__(self, folders: Set[str], files: Set[str]):
+    def __init__(self, folders: Set[str], files: Set[str], manifest: str = ".sync_manifest.json",
+                 workers: int = 8, release_dir: str = ".sync", keep_releases: int = 2):
         self.folders = folders
         self.files = files
+        self.manifest = manifest
+        self.workers = workers
+        self.release_dir = release_dir
+        self.keep_releases = keep_releases
+        # Normalized once, so that matching a path is a few string comparisons
+        self.file_paths = {os.path.normpath(path) for path in files}
+        self.folder_prefixes = tuple(os.path.normpath(folder) + os.sep for folder in folders)
+
+    def pathspecs(self) -> List[str]:
+        return sorted({os.path.normpath(path) for path in self.folders | self.files})
 
     def __str__(self):
         parts = []
@@ -31,16 +45,16 @@ class ChangeTracker:
     def __init__(self):
         self.to_add: List[str] = []
         self.to_update: List[str] = []
-        
+
     def add_file(self, path: str):
         self.to_add.append(path)
-        
+
     def update_file(self, path: str):
         self.to_update.append(path)
-        
+
     def has_changes(self) -> bool:
         return bool(self.to_add or self.to_update)
-        
+
     def print_plan(self):
         if not self.has_changes():
             print("\nNo changes detected.")
@@ -48,115 +62,119 @@ class ChangeTracker:
 
         print("\nChanges to apply:")
         print("================")
-        
+
         if self.to_add:
             print("\nNew files:")
             for f in sorted(self.to_add):
                 print(f"  + {f}")
-                
+
         if self.to_update:
             print("\nModified files:")
             for f in sorted(self.to_update):
                 print(f"  ~ {f}")
-                
+
         print(f"\nSummary: {len(self.to_add)} additions, {len(self.to_update)} modifications")
 
-def get_file_hash(filepath: str, chunk_size: int = 8192) -> str:
+class Manifest:
+    """Record of the files written by the last sync.
+
+    For each path it keeps the git blob of the source, and the size,
+    modification time and normalized hash of the local copy: a file whose
+    blob and local stat are unchanged is skipped without reading it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f).get("files", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable sync manifest {path}: {e}")
+
+    def local_hash(self, rel_path: str, st: os.stat_result) -> Optional[str]:
+        """Return the recorded hash of a local file, if it has not been modified since"""
+        entry = self.entries.get(rel_path)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            return entry["hash"]
+        return None
+
+    def is_unchanged(self, rel_path: str, blob: str, st: os.stat_result) -> bool:
+        entry = self.entries.get(rel_path)
+        return self.local_hash(rel_path, st) is not None and entry["blob"] == blob
+
+    def record(self, rel_path: str, blob: str, file_hash: str, file_path: Optional[str] = None):
+        st = os.stat(file_path or rel_path)
+        self.entries[rel_path] = {"blob": blob, "size": st.st_size, "mtime": st.st_mtime_ns, "hash": file_hash}
+
+    def save(self, paths: Set[str]):
+        # Files no longer synced are forgotten; the manifest is replaced
+        # atomically, so that an interrupted sync leaves the previous one
+        entries = {path: entry for path, entry in self.entries.items() if path in paths}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"source": OC_SERVICES_TEMPLATES, "files": entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+class SyncPlan(ChangeTracker):
+    def __init__(self):
+        ChangeTracker.__init__(self)
+        # Blob of every synced source file, and the normalized hashes
+        # computed while planning
+        self.blobs: Dict[str, str] = {}
+        self.hashes: Dict[str, str] = {}
+
+def get_file_hash(filepath: str) -> str:
     """Calculate normalized content hash"""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
     try:
-        # First try to read as text
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
-        # Normalize line endings
-        content = content.replace('\r\n', '\n')
-        
-        # Remove BOM if present
-        if content.startswith('\ufeff'):
-            content = content[1:]
-            
-        # Remove trailing spaces from lines
-        content = '\n'.join(line.rstrip() for line in content.splitlines())
-        
-        # Calculate hash of normalized content
-        sha1_hash = hashlib.sha1()
-        sha1_hash.update(content.encode('utf-8'))
-        return sha1_hash.hexdigest()
-            
+        content = data.decode('utf-8')
     except UnicodeDecodeError:
-        # If not text, use binary mode
-        sha1_hash = hashlib.sha1()
-        with open(filepath, 'rb') as f:
-            while chunk := f.read(chunk_size):
-                sha1_hash.update(chunk)
-        return sha1_hash.hexdigest()
-
-def check_file_update(src: str, dst: str) -> bool:
-    """Check if file content has changed by comparing normalized hashes"""
-    if not os.path.exists(dst):
-        return True
-    
-    try:
-        return get_file_hash(src) != get_file_hash(dst)
-    except Exception as e:
-        print(f"Warning: Error checking file update for {src}: {e}")
-        return False
+        # If not text, hash the bytes as they are
+        return hashlib.sha1(data).hexdigest()
+
+    # Normalize line endings
+    content = content.replace('\r\n', '\n')
+
+    # Remove BOM if present
+    if content.startswith('\ufeff'):
+        content = content[1:]
+
+    # Remove trailing spaces from lines
+    content = '\n'.join(line.rstrip() for line in content.splitlines())
+
+    # Calculate hash of normalized content
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
 def should_sync_path(path: str, config: SyncConfig) -> bool:
-    """Check if a path should be synced based on the configuration"""
+    """Check if a file should be synced based on the configuration"""
     path = os.path.normpath(path)
-    
-    # Check if the path is a specific file to sync
-    if path in config.files:
-        return True
-    
-    # For directories, check if this path is either:
-    # 1. A configured directory
-    # 2. A parent of a configured directory
-    # 3. A child of a configured directory
-    for folder in config.folders:
-        folder = os.path.normpath(folder)
-        
-        # Case 1: Exact match
-        if path == folder:
-            return True
-            
-        # Case 2: Current path is a parent directory of a configured folder
-        try:
-            relative = os.path.relpath(folder, path)
-            if not relative.startswith('..'):
-                return True
-        except ValueError:
-            pass
-            
-        # Case 3: Current path is inside a configured folder
-        try:
-            relative = os.path.relpath(path, folder)
-            if not relative.startswith('..'):
-                return True
-        except ValueError:
-            pass
-    
-    return False
+    return path in config.file_paths or path.startswith(config.folder_prefixes)
 
 def load_sync_config() -> SyncConfig:
     """Load sync configuration from config.json"""
     try:
         with open("conf.json") as f:
             config = json.load(f)
-            
+
         sync_config = config.get("sync", {
             "folders": ["static"],
             "files": []
         })
-        
+
         folders = set(sync_config.get("folders", ["static"]))
         files = set(sync_config.get("files", []))
-        
-        config = SyncConfig(folders, files)
+
+        config = SyncConfig(folders, files, sync_config.get("manifest", ".sync_manifest.json"),
+                            sync_config.get("workers", 8), sync_config.get("release_dir", ".sync"),
+                            sync_config.get("keep_releases", 2))
         print(f"Loaded sync configuration: {config}")
         return config
-            
+
     except FileNotFoundError:
         print("Warning: conf.json not found, using default sync path: 'static'")
         return SyncConfig({"static"}, set())
@@ -167,90 +185,233 @@ def load_sync_config() -> SyncConfig:
         print(f"Warning: Error loading conf.json ({str(e)}), using default sync path: 'static'")
         return SyncConfig({"static"}, set())
 
-def scan_changes(src_dir: str, dst_dir: str, tracker: ChangeTracker, config: SyncConfig) -> None:
-    """Scan for changes between source and destination directories"""
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
+def fetch_repository(url: str, temp_dir: str, config: SyncConfig) -> Dict[str, str]:
+    """Check out the configured paths of the last commit of a repository.
+
+    Only the last commit is fetched, and only the blobs of the configured
+    folders and files are downloaded. Return the git blob of each file to
+    sync, by path.
+    """
+    repo = Repo.init(temp_dir)
+    repo.create_remote("origin", url)
+    repo.git.config("core.sparseCheckout", "true")
+    with open(os.path.join(repo.git_dir, "info", "sparse-checkout"), "w") as f:
+        for path in config.pathspecs():
+            f.write(f"/{path}\n/{path}/\n")
+    repo.git.fetch("--depth", "1", "--filter=blob:none", "origin", "HEAD")
+    repo.git.checkout("FETCH_HEAD")
 
-    for item in os.listdir(src_dir):
-        if item == '.git':
+    blobs = {}
+    listing = repo.git.ls_tree("-r", "-z", "FETCH_HEAD", "--", *config.pathspecs())
+    for line in listing.split("\0"):
+        if not line:
             continue
-            
-        src_path = os.path.join(src_dir, item)
-        dst_path = os.path.join(dst_dir, item)
-        rel_path = os.path.relpath(dst_path, os.getcwd())
-        
-        # Skip if path is not in sync configuration
-        if not should_sync_path(rel_path, config):
+        info, path = line.split("\t", 1)
+        _, kind, blob = info.split()
+        if kind == "blob" and should_sync_path(path, config):
+            blobs[os.path.normpath(path)] = blob
+    return blobs
+
+def plan_changes(src_dir: str, blobs: Dict[str, str], manifest: Manifest, config: SyncConfig) -> SyncPlan:
+    """Find the files to add or update, reading only those whose source or local copy changed"""
+    plan = SyncPlan()
+    plan.blobs = blobs
+    to_compare: List[Tuple[str, Optional[str]]] = []
+    for rel_path, blob in sorted(blobs.items()):
+        try:
+            st = os.stat(rel_path)
+        except FileNotFoundError:
+            plan.add_file(rel_path)
             continue
-            
-        if os.path.isdir(src_path):
-            scan_changes(src_path, dst_path, tracker, config)
-        else:
-            if not os.path.exists(dst_path):
-                tracker.add_file(rel_path)
-            elif check_file_update(src_path, dst_path):
-                tracker.update_file(rel_path)
-
-def sync_files(src_dir: str, dst_dir: str, config: SyncConfig) -> None:
-    """Synchronize files from source to destination directory"""
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-
-    for item in os.listdir(src_dir):
-        if item == '.git':
+        if not manifest.is_unchanged(rel_path, blob, st):
+            to_compare.append((rel_path, manifest.local_hash(rel_path, st)))
+
+    def compare(item: Tuple[str, Optional[str]]) -> Tuple[str, Optional[str], bool]:
+        rel_path, local_hash = item
+        try:
+            src_hash = get_file_hash(os.path.join(src_dir, rel_path))
+            return rel_path, src_hash, src_hash != (local_hash or get_file_hash(rel_path))
+        except Exception as e:
+            print(f"Warning: Error checking file update for {rel_path}: {e}")
+            return rel_path, None, False
+
+    with ThreadPoolExecutor(config.workers) as executor:
+        for rel_path, src_hash, changed in executor.map(compare, to_compare):
+            if src_hash is not None:
+                plan.hashes[rel_path] = src_hash
+            if changed:
+                plan.update_file(rel_path)
+    return plan
+
+def apply_changes(src_dir: str, plan: SyncPlan, manifest: Manifest, config: SyncConfig, dst_dir: str = ".") -> None:
+    """Copy the files of a plan under dst_dir, recording every synced file in the manifest"""
+    def copy(rel_path: str) -> str:
+        src_path = os.path.join(src_dir, rel_path)
+        dst_path = os.path.join(dst_dir, rel_path)
+        os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+        # Copied under a temporary name and then renamed, so that a file is
+        # never read half written, and a file linked from a previous release
+        # is replaced instead of modified
+        tmp_path = f"{dst_path}.sync-tmp"
+        shutil.copy2(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        print(f"Updated: {rel_path}")
+        return plan.hashes.get(rel_path) or get_file_hash(src_path)
+
+    changed = plan.to_add + plan.to_update
+    with ThreadPoolExecutor(config.workers) as executor:
+        for rel_path, file_hash in zip(changed, executor.map(copy, changed)):
+            plan.hashes[rel_path] = file_hash
+
+    # Files whose content was found equal are recorded too, so that they
+    # are not read again until their blob changes
+    for rel_path, file_hash in plan.hashes.items():
+        manifest.record(rel_path, plan.blobs[rel_path], file_hash, os.path.join(dst_dir, rel_path))
+    manifest.save(set(plan.blobs))
+
+def link_file(src: str, dst: str) -> None:
+    # The synced files are reached through the links of the current release
+    src = os.path.realpath(src)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def replace_link(target: str, path: str) -> None:
+    """Point the symbolic link path to target, replacing atomically whatever path was"""
+    tmp_path = f"{path}.sync-link"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, path)
+
+def stage_release(src_dir: str, plan: SyncPlan, manifest: Manifest, config: SyncConfig) -> str:
+    """Build a new release directory from the current files and the changes of a plan.
+
+    The current files are hard linked into the release, so that they take
+    no space and keep the size and mtime recorded in the manifest.
+    """
+    releases = os.path.join(config.release_dir, "releases")
+    name = time.strftime("%Y%m%d-%H%M%S")
+    release = os.path.join(releases, name)
+    suffix = 1
+    while os.path.exists(release):
+        suffix += 1
+        release = os.path.join(releases, f"{name}-{suffix}")
+    os.makedirs(release)
+
+    for path in config.pathspecs():
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path, followlinks=True):
+                os.makedirs(os.path.join(release, dirpath), exist_ok=True)
+                for filename in filenames:
+                    if not filename.endswith((".sync-tmp", ".sync-link")):
+                        link_file(os.path.join(dirpath, filename), os.path.join(release, dirpath, filename))
+        elif os.path.isfile(path):
+            os.makedirs(os.path.join(release, os.path.dirname(path)), exist_ok=True)
+            link_file(path, os.path.join(release, path))
+
+    apply_changes(src_dir, plan, manifest, config, release)
+    return release
+
+def activate_release(release: str, config: SyncConfig) -> None:
+    """Make a release the one served, by replacing a single symbolic link.
+
+    Each synced folder and file is a link through <release_dir>/current, so
+    that all of them change at once. The first time, the folders and files
+    in place are moved aside and replaced by these links.
+    """
+    current = os.path.join(config.release_dir, "current")
+    replace_link(os.path.relpath(release, config.release_dir), current)
+
+    for path in config.pathspecs():
+        if not os.path.lexists(os.path.join(release, path)):
             continue
-            
-        src_path = os.path.join(src_dir, item)
-        dst_path = os.path.join(dst_dir, item)
-        rel_path = os.path.relpath(dst_path, os.getcwd())
-        
-        # Skip if path is not in sync configuration
-        if not should_sync_path(rel_path, config):
+        target = os.path.relpath(os.path.join(current, path), os.path.dirname(path) or ".")
+        if os.path.islink(path) and os.readlink(path) == target:
             continue
-            
-        if os.path.isdir(src_path):
-            sync_files(src_path, dst_path, config)
-        elif check_file_update(src_path, dst_path):
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-            shutil.copy2(src_path, dst_path)
-            print(f"Updated: {rel_path}")
-
-def sync_repository(auto_mode: bool = False) -> None:
-    """Main function to handle repository synchronization"""
+        previous = None
+        if os.path.lexists(path) and not os.path.islink(path):
+            previous = f"{path}.presync"
+            if os.path.isdir(previous):
+                shutil.rmtree(previous)
+            os.rename(path, previous)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        replace_link(target, path)
+        if previous is not None:
+            if os.path.isdir(previous):
+                shutil.rmtree(previous)
+            else:
+                os.remove(previous)
+
+    # The previous releases are kept for the requests still reading them
+    releases = os.path.join(config.release_dir, "releases")
+    names = sorted(os.listdir(releases), reverse=True)
+    for name in names[max(1, config.keep_releases):]:
+        if os.path.join(releases, name) != release:
+            shutil.rmtree(os.path.join(releases, name), ignore_errors=True)
+    print(f"Activated release {release}")
+
+def sync_repository(auto_mode: bool = False, swap: bool = False) -> bool:
+    """Main function to handle repository synchronization.
+
+    With swap, the changes are staged into a new release that replaces the
+    current files atomically, so that a running server never sees a
+    partial update.
+    """
     cwd = os.getcwd()
     print(f"Working directory: {cwd}")
-    
+
     # Load sync configuration
     config = load_sync_config()
-    
+    manifest = Manifest(config.manifest)
+
     with tempfile.TemporaryDirectory() as temp_dir:
         try:
-            print(f"Cloning {OC_SERVICES_TEMPLATES}...")
-            Repo.clone_from(OC_SERVICES_TEMPLATES, temp_dir)
-            
+            print(f"Fetching {OC_SERVICES_TEMPLATES}...")
+            blobs = fetch_repository(OC_SERVICES_TEMPLATES, temp_dir, config)
+
+            print("\nAnalyzing repository...")
+            plan = plan_changes(temp_dir, blobs, manifest, config)
+
             if not auto_mode:
-                tracker = ChangeTracker()
-                print("\nAnalyzing repository...")
-                scan_changes(temp_dir, cwd, tracker, config)
-                
-                tracker.print_plan()
-                
-                if not tracker.has_changes():
-                    return
-                    
-                if input("\nProceed with these changes? [y/N]: ").lower() != 'y':
-                    print("Operation cancelled.")
-                    return
-                
-                print("\nApplying changes...")
-            
-            sync_files(temp_dir, cwd, config)
-            print("\nSync completed successfully!")
-            
+                plan.print_plan()
+
+                if plan.has_changes():
+                    if input("\nProceed with these changes? [y/N]: ").lower() != 'y':
+                        print("Operation cancelled.")
+                        return True
+
+                    print("\nApplying changes...")
+
+            if swap and plan.has_changes():
+                activate_release(stage_release(temp_dir, plan, manifest, config), config)
+            else:
+                apply_changes(temp_dir, plan, manifest, config)
+            print(f"\nSync completed successfully! {len(plan.to_add)} added, {len(plan.to_update)} updated, "
+                  f"{len(blobs) - len(plan.to_add) - len(plan.to_update)} unchanged")
+            return True
+
         except Exception as e:
             print(f"Error: {str(e)}")
+            return False
+
+def run_scheduled(interval: float, swap: bool = False) -> None:
+    """Sync every interval seconds, until the parent process exits"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(sync_repository, "interval", args=[True, swap], seconds=interval, id="sync_static",
+                      max_instances=1, coalesce=True)
+    scheduler.start()
+    parent = os.getppid()
+    try:
+        while os.getppid() == parent:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.shutdown(wait=False)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -261,9 +422,24 @@ def main():
         action='store_true',
         help='run in automatic mode without confirmation'
     )
-    
+    parser.add_argument(
+        '--swap',
+        action='store_true',
+        help='stage the changes into a new release and switch to it atomically'
+    )
+
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=0,
+        help='keep running and sync every INTERVAL seconds (implies --auto)'
+    )
+
     args = parser.parse_args()
-    sync_repository(args.auto)
+    if args.interval > 0:
+        run_scheduled(args.interval, args.swap)
+    elif not sync_repository(args.auto, args.swap):
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
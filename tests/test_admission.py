@@ -0,0 +1,146 @@
+"""Admission control: identification of the clients, their token buckets and the limits of the endpoints.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import pytest
+
+from src import admission as admission_module
+from src.admission import Admission, AdmissionRejected, ClientTokens, client_ip
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time seen by the token buckets, moved forward by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(admission_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def limited(tmp_path, **kwargs):
+    """Admission control with one query at a time on index and a queue of one query"""
+    conf = dict(rate=0, max_in_flight={"index": 1}, max_queue=1, queue_timeout=0.05, retry_after=7)
+    conf.update(kwargs)
+    return Admission(str(tmp_path / "admission"), ["index", "meta"], **conf)
+
+
+def test_client_is_the_entry_of_the_trusted_proxy():
+    assert client_ip("6.6.6.6, 1.2.3.4", "10.0.0.1", 1) == "1.2.3.4"
+    assert client_ip("1.2.3.4, 10.0.0.2", "10.0.0.1", 2) == "1.2.3.4"
+
+
+def test_requests_without_the_header_behind_proxies_are_not_identified():
+    assert client_ip(None, "10.0.0.1", 1) is None
+    assert client_ip(" , ", "10.0.0.1", 1) is None
+
+
+def test_connection_address_without_proxies():
+    assert client_ip("6.6.6.6", "1.2.3.4", 0) == "1.2.3.4"
+
+
+def test_batch_queries_take_one_token_each(tmp_path):
+    admission = Admission(str(tmp_path / "admission"), ["index"], rate=0.001, burst=3)
+    admission.check_client("1.2.3.4")
+    tokens = ClientTokens(admission, "1.2.3.4", prepaid=1)
+    tokens.take()
+    tokens.take()
+    tokens.take()
+    with pytest.raises(AdmissionRejected) as rejected:
+        tokens.take()
+    assert rejected.value.status == 429
+    # The rest of the batch is refused without touching the bucket
+    with pytest.raises(AdmissionRejected):
+        tokens.take()
+
+
+def test_buckets_are_refilled_at_rate(tmp_path, clock):
+    admission = Admission(str(tmp_path / "admission"), ["index"], rate=2, burst=2)
+    admission.check_client("1.2.3.4")
+    admission.check_client("1.2.3.4")
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.check_client("1.2.3.4")
+    assert rejected.value.status == 429 and rejected.value.retry_after == 1
+    # Other clients have buckets of their own
+    admission.check_client("5.6.7.8")
+    clock[0] += 0.5
+    admission.check_client("1.2.3.4")
+    with pytest.raises(AdmissionRejected):
+        admission.check_client("1.2.3.4")
+    # Buckets never hold more than burst tokens
+    clock[0] += 3600
+    admission.check_client("1.2.3.4")
+    admission.check_client("1.2.3.4")
+    with pytest.raises(AdmissionRejected):
+        admission.check_client("1.2.3.4")
+
+
+def test_exempt_and_unidentified_clients_are_not_limited(tmp_path, clock):
+    admission = Admission(str(tmp_path / "admission"), ["index"], rate=1, burst=1, exempt=["10.0.0.1"])
+    for _ in range(5):
+        admission.check_client("10.0.0.1")
+        admission.check_client(None)
+
+
+def test_queries_beyond_max_in_flight_wait_in_the_queue(tmp_path):
+    admission = limited(tmp_path, queue_timeout=10)
+    running = admission.acquire("index")
+    waiting = admission._admit("index", None)
+    assert next(waiting) > 0
+    # The queue is full
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.acquire("index")
+    assert rejected.value.status == 503 and rejected.value.retry_after == 7
+    running.release()
+    with pytest.raises(StopIteration) as admitted:
+        next(waiting)
+    admitted.value.value.release()
+    admission.acquire("index").release()
+
+
+def test_queries_waiting_too_long_are_refused(tmp_path):
+    admission = limited(tmp_path)
+    running = admission.acquire("index")
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.acquire("index")
+    assert rejected.value.status == 503
+    running.release()
+    # The place in the queue was given back
+    admission.acquire("index").release()
+
+
+def test_query_leaving_the_queue_gives_its_place_back(tmp_path):
+    admission = limited(tmp_path, queue_timeout=10)
+    running = admission.acquire("index")
+    waiting = admission._admit("index", None)
+    next(waiting)
+    # The request went away while its query was waiting
+    waiting.close()
+    waiting = admission._admit("index", None)
+    assert next(waiting) > 0
+    waiting.close()
+    running.release()
+
+
+def test_slot_is_released_after_an_error(tmp_path):
+    admission = limited(tmp_path)
+    with pytest.raises(ConnectionError):
+        ticket = admission.acquire("index")
+        try:
+            raise ConnectionError("backend unreachable")
+        finally:
+            ticket.release()
+    ticket = admission.acquire("index")
+    # Releasing twice does not free a slot held by another query
+    ticket.release()
+    ticket.release()
+    other = admission.acquire("index")
+    with pytest.raises(AdmissionRejected):
+        admission.acquire("index")
+    other.release()
+
+
+def test_endpoints_without_limit_are_not_counted(tmp_path):
+    admission = limited(tmp_path)
+    tickets = [admission.acquire("meta") for _ in range(10)]
+    for ticket in tickets:
+        ticket.release()
+    admission.acquire("index").release()
@@ -0,0 +1,50 @@
+"""Startup and shutdown of the ASGI application through the lifespan protocol.
+
+Run from the root of the repository, where conf.json is: python -m pytest tests
+"""
+import asyncio
+
+import asgi
+
+
+def run_lifespan(messages):
+    """Drive the lifespan of the application with messages, returning what it sends"""
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.application({"type": "lifespan"}, receive, send))
+    return sent
+
+
+def test_lifespan_startup_and_shutdown():
+    sent = run_lifespan([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+    assert [m["type"] for m in sent] == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+def test_lifespan_shutdown_closes_upstream_clients():
+    clients = []
+    messages = [{"type": "lifespan.startup"}]
+
+    async def receive():
+        message = messages.pop(0)
+        if message["type"] == "lifespan.startup":
+            # Open the clients of both backends, as the first queries do
+            clients.append(asgi.get_client("http://127.0.0.1:1/index"))
+            clients.append(asgi.get_client("http://127.0.0.1:1/meta"))
+            messages.append({"type": "lifespan.shutdown"})
+        return message
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.application({"type": "lifespan"}, receive, send))
+    assert sent[-1] == {"type": "lifespan.shutdown.complete"}
+    assert len(clients) == 2 and all(client.closed for client in clients)
+    assert not asgi._clients
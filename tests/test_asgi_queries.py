@@ -0,0 +1,147 @@
+"""Queries answered by the ASGI application, against the stand-in backend of the benchmarks.
+
+Run from the root of the repository, where conf.json is: python -m pytest tests
+"""
+import asyncio
+import copy
+import json
+import urllib.parse as urlparse
+
+import pytest
+
+import asgi
+from benchmark.fake_backend import FakeBackend
+from src.balancer import Balancer
+from src.cache import create_cache
+
+QUERY = "SELECT ?citing WHERE { ?citing ?p ?o } LIMIT 10"
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """Send the queries of the index endpoint to a fresh result cache, and record the access log"""
+    cache = create_cache(dict(asgi.env_config["cache"], enabled=True, backend="memory"))
+    pipeline = copy.copy(asgi.pipelines["index"])
+    pipeline.result_cache = cache
+    monkeypatch.setattr(asgi, "result_cache", cache)
+    monkeypatch.setitem(asgi.pipelines, "index", pipeline)
+    logged = []
+    monkeypatch.setattr(asgi, "log_request", lambda env=None, **fields: logged.append((env, fields)))
+    return logged
+
+
+def run(monkeypatch, backend, requests):
+    """Send the (method, path, query string, body) requests one after the other to the
+    application, whose index backend is backend, and return the messages of each response"""
+
+    async def main():
+        server = await asyncio.start_server(backend.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setitem(asgi.balancers, "index", Balancer(["http://127.0.0.1:%d/sparql" % port]))
+        responses = []
+        try:
+            for method, path, query_string, body in requests:
+                messages = [{"type": "http.request", "body": body}]
+
+                async def receive():
+                    if messages:
+                        return messages.pop(0)
+                    # The client stays connected
+                    await asyncio.Event().wait()
+
+                sent = []
+
+                async def send(message):
+                    sent.append(message)
+
+                scope = {
+                    "type": "http", "method": method, "path": path, "query_string": query_string.encode("latin-1"),
+                    "headers": [(b"host", b"sparql.opencitations.net"), (b"user-agent", b"pytest")],
+                    "client": ("192.0.2.7", 40000)
+                }
+                await asgi.application(scope, receive, send)
+                responses.append(sent)
+        finally:
+            server.close()
+            clients = [client for _, client in asgi._clients.values()]
+            asgi._clients.clear()
+            await asyncio.gather(*(client.close() for client in clients))
+        return responses
+
+    return asyncio.run(main())
+
+
+def query(text=QUERY):
+    return ("GET", "/index", urlparse.urlencode({"query": text}), b"")
+
+
+def headers(messages):
+    return {k.decode("latin-1"): v.decode("latin-1") for k, v in messages[0]["headers"]}
+
+
+def body(messages):
+    return b"".join(message["body"] for message in messages[1:])
+
+
+def test_results_are_streamed_and_logged(monkeypatch, app):
+    backend = FakeBackend(size=5000, chunks=4)
+    [response] = run(monkeypatch, backend, [query()])
+    assert response[0]["status"] == 200
+    assert headers(response)["x-cache"] == "MISS"
+    assert len(response) > 2 and body(response) == backend.body
+
+    [(env, fields)] = app
+    assert env["REMOTE_ADDR"] == "192.0.2.7"
+    assert env["HTTP_USER_AGENT"] == "pytest"
+    assert env["REQUEST_URI"] == "/index?" + query()[2]
+    assert fields["status"] == 200 and fields["bytes"] == len(backend.body)
+    assert fields["endpoint"] == "index" and fields["cache"] == "MISS" and not fields["coalesced"]
+
+
+def test_results_are_sent_at_once_without_stream_results(monkeypatch, app):
+    monkeypatch.setitem(asgi.env_config, "stream_results", False)
+    backend = FakeBackend(size=5000, chunks=4)
+    [response] = run(monkeypatch, backend, [query()])
+    assert response[0]["status"] == 200
+    assert len(response) == 2 and not response[1].get("more_body")
+    assert response[1]["body"] == backend.body
+    assert app[0][1]["bytes"] == len(backend.body)
+
+
+def test_cached_results_are_logged(monkeypatch, app):
+    backend = FakeBackend()
+    first, second = run(monkeypatch, backend, [query(), query()])
+    assert backend.requests == 1
+    assert headers(second)["x-cache"] == "HIT"
+    assert body(second) == body(first)
+    assert [fields.get("cache") for _, fields in app] == ["MISS", "HIT"]
+
+
+def test_updates_are_refused(monkeypatch, app):
+    backend = FakeBackend()
+    [response] = run(monkeypatch, backend, [query("INSERT DATA { <a> <b> <c> }")])
+    assert response[0]["status"] == 403
+    assert backend.requests == 0
+
+
+def test_backend_errors_are_logged(monkeypatch, app):
+    backend = FakeBackend(error_rate=1)
+    [response] = run(monkeypatch, backend, [query()])
+    assert response[0]["status"] == 500
+    assert body(response) == b"Internal error of the fake backend"
+    assert app[0][1]["status"] == 500 and "cache" not in app[0][1]
+
+
+def test_main_page_is_logged(monkeypatch, app):
+    [response] = run(monkeypatch, FakeBackend(), [("GET", "/", "", b"")])
+    assert response[0]["status"] == 200
+    assert app[0][0]["REQUEST_URI"] == "/"
+
+
+def test_readiness_reports_the_replicas_of_the_balancer(monkeypatch, app):
+    first, ready = run(monkeypatch, FakeBackend(), [query(), ("GET", "/ready", "", b"")])
+    report = json.loads(body(ready))["backends"]
+    [(url, replica)] = report["index"]["balancing"].items()
+    assert url.startswith("http://127.0.0.1:")
+    assert replica["outstanding"] == 0 and replica["latency_ms"] is not None and not replica["ejected"]
+    assert set(report["meta"]["balancing"]) == set(asgi.balancers["meta"].status())
@@ -0,0 +1,60 @@
+"""Queries of the batch requests: terms bound to the templates.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import json
+
+import pytest
+
+from src.batch import Batch, BatchError, bind, format_term
+from src.query_check import estimate_cost
+
+TEMPLATE = "SELECT ?title WHERE { ?br <http://purl.org/dc/terms/title> ?title } LIMIT 10"
+
+
+def test_format_term():
+    assert format_term(None) == "UNDEF"
+    assert format_term(True) == "true"
+    assert format_term(3) == "3"
+    assert format_term(1.5) == '"1.5"^^<http://www.w3.org/2001/XMLSchema#double>'
+    assert format_term('a "quoted"\nline') == '"a \\"quoted\\"\\nline"'
+    assert format_term({"type": "uri", "value": "https://w3id.org/oc/meta/br/062"}) == \
+        "<https://w3id.org/oc/meta/br/062>"
+    assert format_term({"type": "literal", "value": "chat", "xml:lang": "fr"}) == '"chat"@fr'
+
+
+@pytest.mark.parametrize("value", [
+    "\\u0022 } DROP ALL #",
+    {"type": "uri", "value": "x> } DROP ALL { <y"},
+    {"type": "literal", "value": "a", "xml:lang": "en } DROP"},
+    {"type": "literal", "value": "a", "datatype": "x>"},
+    float("nan"),
+    [1]
+])
+def test_format_term_rejects_values_escaping_their_term(value):
+    with pytest.raises(BatchError):
+        format_term(value)
+
+
+def test_values_go_inside_the_where_clause():
+    query = bind(TEMPLATE, ["br"], {"br": {"type": "uri", "value": "https://w3id.org/oc/meta/br/062"}})
+    assert query.endswith("} LIMIT 10")
+    assert "VALUES (?br) { (<https://w3id.org/oc/meta/br/062>) }" in query
+    assert estimate_cost(bind(TEMPLATE, ["br", "d", "y"], {})) == (0, [])
+
+
+def test_template_ending_in_values():
+    query = bind(TEMPLATE + " VALUES ?x { 1 }", ["br"], {"br": 1})
+    assert query.endswith("} LIMIT 10 VALUES ?x { 1 }")
+    assert query.index("VALUES (?br)") < query.index("} LIMIT 10")
+
+
+def test_braces_in_strings_are_ignored():
+    query = bind('SELECT ?s WHERE { ?s <p> "}" }', ["s"], {"s": 1})
+    assert query == 'SELECT ?s WHERE { ?s <p> "}" \nVALUES (?s) { (1) }\n}'
+
+
+def test_templates_that_cannot_be_bound_are_refused():
+    for template in ("DESCRIBE <x>", "SELECT * WHERE { ?s <\\u0070> ?o }"):
+        with pytest.raises(BatchError):
+            Batch(json.dumps({"template": template, "bindings": [{"s": 1}]}), 10)
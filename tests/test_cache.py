@@ -0,0 +1,115 @@
+"""Result cache: keys, eviction, expiry and size limits of the memory and file backends.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import os
+
+import pytest
+
+from src import cache as cache_module
+from src.cache import make_key, MemoryCache, FileCache, ResultCache
+from src.query_check import normalize_query
+
+ENDPOINT = "http://qlever:7011"
+JSON = "application/sparql-results+json"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time seen by the caches, moved forward by hand"""
+    now = [1000000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=["memory", "file"])
+def backend(request, tmp_path):
+    """Build a cache backend of each kind with the given limits"""
+    def build(max_entries=1024, max_bytes=1 << 20):
+        if request.param == "memory":
+            return MemoryCache(max_entries, max_bytes)
+        return FileCache(str(tmp_path / "cache"), max_entries, max_bytes)
+    return build
+
+
+def touch(backend, key, mtime):
+    """Set the time the file of key was last used"""
+    if isinstance(backend, FileCache):
+        os.utime(os.path.join(backend.directory, key), (mtime, mtime))
+
+
+def test_keys_ignore_the_order_of_the_parameters():
+    params = [("query", "SELECT * WHERE { ?s ?p ?o }"), ("timeout", "10")]
+    assert make_key(ENDPOINT, JSON, params) == make_key(ENDPOINT, JSON, params[::-1])
+
+
+def test_keys_depend_on_the_endpoint_format_encoding_and_parameters():
+    params = [("query", "SELECT * WHERE { ?s ?p ?o }")]
+    key = make_key(ENDPOINT, JSON, params)
+    assert key != make_key("http://virtuoso:8890/sparql", JSON, params)
+    assert key != make_key(ENDPOINT, "text/csv", params)
+    assert key != make_key(ENDPOINT, JSON, params, "gzip")
+    assert key != make_key(ENDPOINT, JSON, params + [("timeout", "10")])
+
+
+def test_keys_of_normalized_queries():
+    spaced = 'SELECT *  # all the triples\nWHERE {\n  ?s ?p "a  b" }'
+    compact = 'SELECT * WHERE { ?s ?p "a  b" }'
+    assert make_key(ENDPOINT, JSON, [("query", normalize_query(spaced))]) == \
+        make_key(ENDPOINT, JSON, [("query", normalize_query(compact))])
+    # Spaces inside strings are significant
+    assert make_key(ENDPOINT, JSON, [("query", normalize_query(compact))]) != \
+        make_key(ENDPOINT, JSON, [("query", normalize_query(compact.replace("a  b", "a b")))])
+
+
+def test_entries_are_returned_until_they_expire(backend, clock):
+    cache = backend()
+    cache.set("a", JSON, b"result", 60, "gzip")
+    assert cache.get("a") == (JSON, b"result", "gzip")
+    clock[0] += 59
+    assert cache.get("a") == (JSON, b"result", "gzip")
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert cache.get("missing") is None
+
+
+def test_least_recently_used_entries_are_evicted(backend, clock):
+    cache = backend(max_entries=2)
+    cache.set("a", JSON, b"a", 60)
+    touch(cache, "a", 1000)
+    cache.set("b", JSON, b"b", 60)
+    touch(cache, "b", 2000)
+    # Reading a makes b the least recently used entry
+    assert cache.get("a") is not None
+    cache.set("c", JSON, b"c", 60)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_entries_are_evicted_beyond_max_bytes(backend, clock):
+    # The files of the file cache also hold a header line
+    size = 100 if isinstance(backend(), MemoryCache) else 200
+    cache = backend(max_bytes=2 * size + 50)
+    for i, key in enumerate("abc"):
+        cache.set(key, JSON, b"x" * 100, 60)
+        touch(cache, key, 1000 + i)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None and cache.get("c") is not None
+
+
+def test_replacing_an_entry_keeps_the_size_right(clock):
+    cache = MemoryCache(max_bytes=150)
+    cache.set("a", JSON, b"x" * 100, 60)
+    cache.set("a", JSON, b"y" * 100, 60)
+    assert cache.size == 100
+    assert cache.get("a") == (JSON, b"y" * 100, None)
+
+
+def test_result_cache_skips_large_results_and_endpoints_without_ttl(clock):
+    cache = ResultCache(MemoryCache(), {"index": 60, "meta": 0}, max_item_bytes=10)
+    cache.set("small", "index", JSON, b"x" * 10)
+    cache.set("large", "index", JSON, b"x" * 11)
+    cache.set("meta", "meta", JSON, b"x")
+    assert cache.get("small") == (JSON, b"x" * 10, None)
+    assert cache.get("large") is None
+    assert cache.get("meta") is None
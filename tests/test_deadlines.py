@@ -0,0 +1,77 @@
+"""Time limits of the queries, and the timeout hint of the clients.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import pytest
+
+from src.deadlines import Deadlines, replace_param
+from src.pipeline import Pipeline, QueryRefused
+
+QLEVER = Deadlines(connect=5, read=100, total=600, hint_unit="s")
+VIRTUOSO = Deadlines(connect=5, read=100, total=600, hint_unit="ms")
+
+
+@pytest.mark.parametrize("deadlines, hint, budget", [
+    (QLEVER, None, 600),
+    (QLEVER, "30", 30),
+    (QLEVER, "30s", 30),
+    (QLEVER, " 2.5 s ", 2.5),
+    (QLEVER, "1500ms", 1.5),
+    (QLEVER, "3600", 600),
+    (VIRTUOSO, "1500", 1.5),
+    (VIRTUOSO, "30s", 30),
+    (VIRTUOSO, "3600000", 600),
+])
+def test_budget_from_the_timeout_hint(deadlines, hint, budget):
+    assert deadlines.budget(hint) == budget
+
+
+@pytest.mark.parametrize("hint", ["", "abc", "0", "0s", "-5", "5min", "1e3", "5 s s"])
+def test_invalid_timeout_hints_are_refused(hint):
+    with pytest.raises(ValueError, match="Invalid timeout"):
+        QLEVER.budget(hint)
+
+
+def test_hint_in_the_unit_of_the_backend():
+    assert QLEVER.hint(30) == "30s"
+    assert QLEVER.hint(2.5) == "2.5s"
+    assert VIRTUOSO.hint(2.5) == "2500"
+    assert VIRTUOSO.hint(0.0001) == "1"
+
+
+def test_read_timeout_is_capped_by_the_budget():
+    assert QLEVER.timeouts(600) == (5, 100)
+    assert QLEVER.timeouts(30) == (5, 30)
+
+
+def test_replace_param_keeps_the_encoding_of_the_others():
+    query_string = "query=SELECT+%3Fs+WHERE+%7B%7D&timeout=9999&format=json"
+    assert replace_param(query_string, "timeout", "600s") == \
+        "query=SELECT+%3Fs+WHERE+%7B%7D&format=json&timeout=600s"
+    assert replace_param("query=x", "timeout", "5s") == "query=x&timeout=5s"
+
+
+def pipeline():
+    return Pipeline("index", "http://qlever:7011", None, lambda endpoint, query, estimate=None: (endpoint, None),
+                    {"index": QLEVER}, None)
+
+
+def test_query_sent_with_the_capped_timeout():
+    query_string = "query=SELECT+*+WHERE+%7B%3Fs+%3Fp+%3Fo%7D&timeout=3600"
+    query = pipeline().plan_query_string(query_string, {"query": ["SELECT * WHERE {?s ?p ?o}"], "timeout": ["3600"]})
+    assert query.budget == 600
+    assert query.data == "query=SELECT+*+WHERE+%7B%3Fs+%3Fp+%3Fo%7D&timeout=600s"
+    # Results are cached under the timeout asked by the client
+    assert ("timeout", "3600") in query.cache_params
+
+
+def test_query_body_with_the_timeout_in_the_url():
+    query = pipeline().plan_query_body("ASK {}", "timeout=1500ms", "application/sparql-query")
+    assert query.budget == 1.5 and query.url_query == "timeout=1.5s"
+    assert pipeline().plan_query_body("ASK {}", "", "application/sparql-query").url_query is None
+
+
+def test_invalid_timeout_is_answered_with_400():
+    with pytest.raises(QueryRefused) as refused:
+        pipeline().plan_query_string("query=ASK+%7B%7D&timeout=soon", {"query": ["ASK {}"], "timeout": ["soon"]})
+    assert refused.value.status == 400
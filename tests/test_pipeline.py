@@ -0,0 +1,69 @@
+"""Processing of the results of the backends shared by the WSGI and the ASGI front ends.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import gzip
+import json
+
+from src.pipeline import ResultStream, Pipeline
+from src.transcode import JSON, CSV, CONTENT_TYPES
+
+LEVELS = {"gzip": 5, "br": 4, "zstd": 3}
+RESULT = json.dumps({
+    "head": {"vars": ["s"]},
+    "results": {"bindings": [{"s": {"type": "uri", "value": "https://w3id.org/oc/meta/br/%d" % i}}
+                             for i in range(200)]}
+}).encode("utf-8")
+
+
+def run(stream, data, size=512):
+    chunks = [stream.feed(data[i:i + size]) for i in range(0, len(data), size)]
+    return b"".join(chunks) + stream.close()
+
+
+def test_results_are_compressed_above_the_threshold():
+    stream = ResultStream(JSON, None, None, "gzip", LEVELS, 1024, max_cached=1 << 20)
+    assert not stream.ready
+    output = run(stream, RESULT)
+    assert stream.response_headers() == {"Content-Type": JSON, "Content-Encoding": "gzip"}
+    assert gzip.decompress(output) == RESULT
+    assert stream.body() == output
+
+
+def test_small_results_are_not_compressed():
+    stream = ResultStream(JSON, None, None, "gzip", LEVELS, 1 << 20)
+    assert run(stream, RESULT) == RESULT
+    assert "Content-Encoding" not in stream.response_headers()
+    assert stream.body() is None
+
+
+def test_results_compressed_by_the_backend_are_forwarded():
+    data = gzip.compress(RESULT)
+    stream = ResultStream(JSON, "gzip", None, "gzip", LEVELS, 0, decode=True)
+    assert stream.forward and stream.ready
+    assert run(stream, data) == data
+    assert stream.response_headers()["Content-Encoding"] == "gzip"
+
+
+def test_results_are_decoded_before_being_converted():
+    stream = ResultStream(JSON, "gzip", (JSON, CSV), None, LEVELS, 0, decode=True)
+    output = run(stream, gzip.compress(RESULT))
+    assert stream.response_headers() == {"Content-Type": CONTENT_TYPES[CSV]}
+    lines = output.decode("utf-8").splitlines()
+    assert lines[0] == "s" and lines[1] == "https://w3id.org/oc/meta/br/0" and len(lines) == 201
+
+
+def test_results_too_large_are_not_cached():
+    stream = ResultStream("application/json", None, None, None, LEVELS, 0, max_cached=1000)
+    assert run(stream, RESULT) == RESULT
+    assert stream.content_type == JSON
+    assert stream.body() is None
+
+
+def test_response_headers():
+    headers = Pipeline.response_headers({"Content-Type": JSON, "Content-Encoding": "br"}, "light; score=1", "MISS")
+    assert headers["Content-Encoding"] == "br"
+    assert headers["Vary"] == "Accept, Accept-Encoding"
+    assert headers["X-Query-Cost"] == "light; score=1" and headers["X-Cache"] == "MISS"
+    assert "X-Cache" not in Pipeline.response_headers({"Content-Type": JSON})
+    assert Pipeline.cached_headers((JSON, b"", "zstd")) == {"Content-Type": JSON, "Content-Encoding": "zstd"}
@@ -0,0 +1,109 @@
+"""Static checks of the queries: cost estimate and detection of SPARQL Update requests.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import pytest
+
+from src import query_check
+from src.query_check import (estimate_cost, has_update_keyword, strict_is_update, classify_query, UpdateChecker,
+                             PooledUpdateChecker, ValidationUnavailable)
+
+
+def test_values_variables_are_not_a_scan():
+    inline = "SELECT ?t WHERE { VALUES (?a ?b ?c) { (1 2 3) } ?a <p> ?t } LIMIT 10"
+    trailing = "SELECT ?t WHERE { ?a <p> ?t } LIMIT 10 VALUES (?a ?b ?c) { (<x> 'y' UNDEF) }"
+    assert estimate_cost(inline) == (0, [])
+    assert estimate_cost(trailing) == (0, [])
+
+
+def test_real_scan_is_counted():
+    assert estimate_cost("SELECT * WHERE { ?s ?p ?o } LIMIT 10") == (4, ["scan"])
+
+
+def test_limit_before_trailing_values_bounds_the_results():
+    query = "SELECT ?t WHERE { ?br <p> ?t } LIMIT 10 VALUES ?br { <x> <y> }"
+    assert estimate_cost(query) == (0, [])
+
+
+def test_limit_of_a_subquery_does_not_bound_the_results():
+    query = "SELECT ?t WHERE { { SELECT ?s WHERE { ?s <p> ?o } LIMIT 5 } ?s <q> ?t }"
+    assert estimate_cost(query) == (2, ["no_limit"])
+
+
+def test_limit_after_construct_template():
+    assert estimate_cost("CONSTRUCT { ?s <p> ?o } WHERE { ?s <p> ?o } LIMIT 3") == (0, [])
+    assert estimate_cost("CONSTRUCT { ?s <p> ?o } WHERE { ?s <p> ?o }") == (2, ["no_limit"])
+
+
+@pytest.mark.parametrize("query", [
+    'SELECT ?t WHERE { ?s <http://purl.org/dc/terms/title> "INSERT DATA { <a> <b> <c> }" }',
+    "SELECT ?t WHERE { ?s <http://example.org/delete/insert> ?t }",
+    "SELECT ?t WHERE { ?s ?p ?t } # DELETE WHERE { ?s ?p ?o }",
+    "SELECT ?t WHERE { ?s ?p '''multi\nline DROP ALL''' }",
+    "SELECT ?insert ?delete WHERE { ?insert ex:load ?delete . ?s ?p 'x'@clear }",
+])
+def test_update_keywords_in_literals_iris_and_comments_are_allowed(query):
+    assert not has_update_keyword(query)
+    assert not UpdateChecker(strict=True).is_update(query)
+
+
+@pytest.mark.parametrize("query", [
+    "INSERT DATA { <a> <b> <c> }",
+    "insert data { <a> <b> <c> }",
+    "DELETE WHERE { ?s ?p ?o }",
+    "DeLeTe { ?s ?p ?o } WHERE { ?s ?p ?o }",
+    "LOAD <http://example.org/data.ttl>",
+    "clear all",
+    "PREFIX dcterms: <http://purl.org/dc/terms/>\nINSERT DATA { <a> dcterms:title 'x' }",
+    "PREFIX ex: <http://example.org/> # a comment\nCLEAR GRAPH ex:g",
+    "SELECT * WHERE { ?s ?p ?o } ; DELETE WHERE { ?s ?p ?o }",
+    "\\u0049NSERT DATA { <a> <b> <c> }",
+])
+def test_update_requests_are_refused(query):
+    assert has_update_keyword(query)
+    assert UpdateChecker().is_update(query)
+
+
+def test_strict_check_parses_the_queries_passing_the_keyword_check(monkeypatch):
+    parsed = []
+
+    def strict(query):
+        parsed.append(query)
+        return True
+
+    monkeypatch.setattr(query_check, "strict_is_update", strict)
+    assert classify_query("SELECT * WHERE { ?s ?p ?o }", strict=True)
+    assert classify_query("INSERT DATA { <a> <b> <c> }", strict=True)
+    assert not classify_query("SELECT * WHERE { ?s ?p ?o }")
+    assert parsed == ["SELECT * WHERE { ?s ?p ?o }"]
+
+
+def test_strict_check_with_rdflib():
+    assert strict_is_update("# comment\n\nINSERT DATA { <http://a> <http://b> <http://c> }")
+    assert not strict_is_update("SELECT * WHERE { ?s ?p ?o }")
+    assert not strict_is_update("not SPARQL at all")
+
+
+def test_verdicts_are_memoized(monkeypatch):
+    checker = UpdateChecker(memo_size=1)
+    calls = []
+    monkeypatch.setattr(checker, "classify", lambda query: calls.append(query) or False)
+    checker.is_update("SELECT 1")
+    checker.is_update("SELECT 1")
+    checker.is_update("SELECT 2")
+    checker.is_update("SELECT 1")
+    assert calls == ["SELECT 1", "SELECT 2", "SELECT 1"]
+
+
+def test_pooled_checker_refuses_queries_beyond_max_pending():
+    with pytest.raises(ValidationUnavailable):
+        PooledUpdateChecker(max_pending=0).is_update("SELECT * WHERE { ?s ?p ?o }")
+
+
+def test_pooled_checker_classifies_in_another_process():
+    checker = PooledUpdateChecker(strict=True, workers=1, timeout=30)
+    try:
+        assert checker.is_update("INSERT DATA { <a> <b> <c> }")
+        assert not checker.is_update("SELECT ?t WHERE { ?s ?p 'INSERT' }")
+    finally:
+        checker.executor.shutdown()
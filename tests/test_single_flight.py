@@ -0,0 +1,167 @@
+"""Coalescing of identical concurrent queries, in threads and in asyncio tasks.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import asyncio
+import threading
+
+import pytest
+
+from src.deadlines import DeadlineExceeded
+from src.single_flight import SingleFlight, Flight, AsyncFlight, FlightFailed, WorkerLocks
+
+FOLLOWERS = 5
+
+
+def read(flight, subscriber):
+    """Return the (status, body) of a flight as a request following it sees them"""
+    status, _ = flight.wait_response(subscriber)
+    return status, b"".join(flight.follow(subscriber))
+
+
+def test_identical_queries_share_one_upstream_request():
+    flights = SingleFlight(Flight)
+    calls = []
+    results = [None] * FOLLOWERS
+    joined = [flights.join("key") for _ in range(FOLLOWERS)]
+    assert [leader for _, _, leader in joined] == [True] + [False] * (FOLLOWERS - 1)
+    assert len({id(flight) for flight, _, _ in joined}) == 1
+
+    def follow(i, flight, subscriber):
+        results[i] = read(flight, subscriber)
+
+    threads = [threading.Thread(target=follow, args=(i, flight, subscriber))
+               for i, (flight, subscriber, _) in enumerate(joined)]
+    for thread in threads:
+        thread.start()
+
+    # Only the leader sends the query upstream
+    for flight, _, leader in joined:
+        if leader:
+            calls.append("upstream")
+            flight.start(200, {"Content-Type": "text/csv"}, b"s\n")
+            for chunk in (b"a\n", b"b\n"):
+                assert flight.feed(chunk)
+            flight.finish()
+            flights.forget("key", flight)
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ["upstream"]
+    assert results == [(200, b"s\na\nb\n")] * FOLLOWERS
+    # The next query starts a flight of its own
+    assert flights.join("key")[2]
+
+
+def test_flights_are_not_shared_when_disabled_or_without_key():
+    assert all(SingleFlight(Flight, enabled=False).join("key")[2] for _ in range(3))
+    flights = SingleFlight(Flight)
+    assert flights.join(None)[2] and flights.join(None)[2]
+
+
+def test_failure_before_the_response_reaches_every_follower():
+    flights = SingleFlight(Flight)
+    joined = [flights.join("key") for _ in range(FOLLOWERS)]
+    flight = joined[0][0]
+    flight.finish(DeadlineExceeded("index", "total"))
+    for _, subscriber, _ in joined:
+        with pytest.raises(FlightFailed, match="total timeout"):
+            flight.wait_response(subscriber)
+    assert isinstance(flight.error, DeadlineExceeded)
+    # Once the flight is finished, the producer cannot publish anything
+    flight.start(200, {})
+    assert flight.response is None and not flight.feed(b"late")
+
+
+def test_failure_while_sending_the_body_reaches_every_follower():
+    flights = SingleFlight(Flight)
+    joined = [flights.join("key") for _ in range(FOLLOWERS)]
+    flight = joined[0][0]
+    flight.start(200, {"Content-Type": "text/csv"}, b"s\n")
+    flight.feed(b"a\n")
+    flight.finish(ConnectionError("reset"))
+    for _, subscriber, _ in joined:
+        assert flight.wait_response(subscriber)[0] == 200
+        chunks = []
+        with pytest.raises(FlightFailed, match="reset"):
+            for chunk in flight.follow(subscriber):
+                chunks.append(chunk)
+        assert chunks == [b"s\n", b"a\n"]
+
+
+def test_flight_is_abandoned_when_all_its_followers_are_gone():
+    flights = SingleFlight(Flight)
+    joined = [flights.join("key") for _ in range(2)]
+    flight = joined[0][0]
+    aborted = []
+    flight.on_abandon = lambda: aborted.append(True)
+    flight.unsubscribe(joined[0][1])
+    assert not flight.abandoned
+    flight.unsubscribe(joined[1][1])
+    assert flight.abandoned and aborted == [True]
+    assert not flight.feed(b"chunk")
+    assert flights.join("key")[2]
+
+
+def test_followers_cannot_join_once_chunks_are_dropped():
+    flights = SingleFlight(Flight)
+    flight, subscriber, _ = flights.join("key")
+    flight.start(200, {}, b"first")
+    assert flight.wait_response(subscriber) == (200, {})
+    assert next(flight.follow(subscriber)) == b"first"
+    assert not flight.joinable
+    assert flights.join("key")[0] is not flight
+
+
+def test_async_followers_share_one_upstream_request():
+    async def main():
+        flights = SingleFlight(AsyncFlight)
+        joined = [flights.join("key") for _ in range(FOLLOWERS)]
+        flight = joined[0][0]
+
+        async def follow(subscriber):
+            status, _ = await flight.wait_response(subscriber)
+            return status, b"".join([chunk async for chunk in flight.follow(subscriber)])
+
+        async def produce():
+            await flight.start(200, {}, b"s\n")
+            await flight.feed(b"a\n")
+            await flight.finish()
+
+        results = await asyncio.gather(produce(), *(follow(subscriber) for _, subscriber, _ in joined))
+        assert [leader for _, _, leader in joined].count(True) == 1
+        assert results[1:] == [(200, b"s\na\n")] * FOLLOWERS
+
+    asyncio.run(main())
+
+
+def test_async_failure_reaches_every_follower():
+    async def main():
+        flights = SingleFlight(AsyncFlight)
+        joined = [flights.join("key") for _ in range(FOLLOWERS)]
+        flight = joined[0][0]
+
+        async def follow(subscriber):
+            with pytest.raises(FlightFailed, match="refused"):
+                await flight.wait_response(subscriber)
+
+        async def produce():
+            await asyncio.sleep(0)
+            await flight.finish(ConnectionError("refused"))
+
+        await asyncio.gather(produce(), *(follow(subscriber) for _, subscriber, _ in joined))
+
+    asyncio.run(main())
+
+
+def test_worker_locks_let_one_worker_at_a_time(tmp_path):
+    locks = WorkerLocks(str(tmp_path), wait=0.05)
+    handle, waited = locks.acquire("key", lambda seconds: None)
+    assert handle is not None and not waited
+    # Another worker gives up after wait seconds, and then looks in the cache
+    other, waited = locks.acquire("key", lambda seconds: None)
+    assert other is None and waited
+    locks.release(handle)
+    handle, waited = locks.acquire("key", lambda seconds: None)
+    assert handle is not None and not waited
+    locks.release(handle)
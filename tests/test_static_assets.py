@@ -0,0 +1,31 @@
+"""ETags and conditional requests of the static files.
+
+Run from the root of the repository: python -m pytest tests
+"""
+from src.static_assets import Asset, respond_asset
+
+CACHE_CONTROL = "public, max-age=3600"
+
+
+def make_asset():
+    return Asset(b"body { color: red; }\n" * 200, "text/css", 0, 1024, 9, 5)
+
+
+def test_each_encoding_has_its_own_etag():
+    asset = make_asset()
+    _, identity, _ = respond_asset(asset, CACHE_CONTROL)
+    _, gzipped, _ = respond_asset(asset, CACHE_CONTROL, accept_encoding="gzip")
+    assert gzipped["Content-Encoding"] == "gzip"
+    assert identity["ETag"] == asset.etag
+    assert gzipped["ETag"] == '"%s-gzip"' % asset.digest
+    assert identity["Vary"] == gzipped["Vary"] == "Accept-Encoding"
+
+
+def test_etag_of_another_encoding_does_not_match():
+    asset = make_asset()
+    status, _, _ = respond_asset(asset, CACHE_CONTROL, if_none_match=asset.etag, accept_encoding="gzip")
+    assert status == 200
+    status, headers, body = respond_asset(
+        asset, CACHE_CONTROL, if_none_match='"%s-gzip"' % asset.digest, accept_encoding="gzip")
+    assert (status, body) == (304, b"")
+    assert headers["ETag"] == '"%s-gzip"' % asset.digest
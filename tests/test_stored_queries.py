@@ -0,0 +1,123 @@
+"""Stored queries: validation of their parameters and the terms written for them.
+
+Run from the root of the repository: python -m pytest tests
+"""
+import json
+
+import pytest
+
+from src.query_check import has_update_keyword, estimate_cost
+from src.stored_queries import StoredQuery, ParameterError, load_stored_queries
+
+TEMPLATE = 'SELECT ?br WHERE { ?br <http://purl.org/dc/terms/title> $title ; <p> "$not_a_param" . } LIMIT $limit'
+
+
+def stored(template=TEMPLATE, params=None):
+    return StoredQuery("titles", template, params or {"title": "string", "limit": {"type": "integer", "default": 10}})
+
+
+def test_parameters_are_replaced_by_terms():
+    query, terms = stored().bind({"title": "Open citations"})
+    assert query == ('SELECT ?br WHERE { ?br <http://purl.org/dc/terms/title> "Open citations" ; '
+                     '<p> "$not_a_param" . } LIMIT 10')
+    assert terms == {"title": '"Open citations"', "limit": "10"}
+
+
+@pytest.mark.parametrize("title", [
+    '" } ; DELETE WHERE { ?s ?p ?o } #',
+    "x\" . } INSERT DATA { <a> <b> <c> } #",
+    "line\nbreak",
+    "back\\slash",
+])
+def test_strings_cannot_escape_their_literal(title):
+    query, terms = stored().bind({"title": title})
+    assert json.loads(terms["title"]) == title
+    # Whatever the value, the query stays the template with a literal in it
+    assert not has_update_keyword(query)
+    assert estimate_cost(query) == stored().cost
+
+
+@pytest.mark.parametrize("kind, value, term", [
+    ("integer", " 42", None),
+    ("integer", "+7", "7"),
+    ("integer", "-0", "0"),
+    ("iri", "https://w3id.org/oc/meta/br/062", "<https://w3id.org/oc/meta/br/062>"),
+    ("doi", "https://doi.org/10.1162/QSS_A_00023", '"10.1162/qss_a_00023"'),
+    ("doi", "doi:10.1007/s11192-019-03217-6", '"10.1007/s11192-019-03217-6"'),
+    ("omid", "omid:br/062", "<https://w3id.org/oc/meta/br/062>"),
+    ("omid", "https://w3id.org/oc/meta/ra/0614", "<https://w3id.org/oc/meta/ra/0614>"),
+])
+def test_values_of_each_type(kind, value, term):
+    query = StoredQuery("one", "SELECT * WHERE { ?s ?p $value }", {"value": kind})
+    if term is None:
+        with pytest.raises(ParameterError):
+            query.bind({"value": value})
+    else:
+        assert query.bind({"value": value})[1]["value"] == term
+
+
+@pytest.mark.parametrize("kind, value", [
+    ("integer", "1; DROP ALL"),
+    ("integer", "1.5"),
+    ("iri", "http://example.org/> } DELETE WHERE { ?s ?p ?o } <x"),
+    ("iri", "http://example.org/a b"),
+    ("doi", "10.1/short"),
+    ("doi", "not a doi"),
+    ("omid", "br/062> . ?s ?p ?o"),
+    ("omid", "xx/062"),
+    ("string", "\\u0022 } DELETE WHERE { ?s ?p ?o } #"),
+])
+def test_invalid_values_are_refused(kind, value):
+    query = StoredQuery("one", "SELECT * WHERE { ?s ?p $value }", {"value": kind})
+    with pytest.raises(ValueError):
+        query.bind({"value": value})
+
+
+def test_missing_and_unknown_parameters_are_refused():
+    with pytest.raises(ParameterError, match="Missing parameters of stored query titles: title"):
+        stored().bind({})
+    with pytest.raises(ParameterError, match="Unknown parameter of stored query titles: author"):
+        stored().bind({"title": "x", "author": "y"})
+
+
+def test_defaults_can_be_overridden():
+    assert stored().bind({"title": "x", "limit": "5"})[1]["limit"] == "5"
+    assert stored().describe()["params"] == {
+        "title": {"type": "string"}, "limit": {"type": "integer", "optional": True}}
+
+
+@pytest.mark.parametrize("name, template, params, message", [
+    ("bad name", "SELECT * WHERE { ?s ?p $o }", {"o": "iri"}, "Invalid name"),
+    ("q", "SELECT * WHERE { ?s ?p $o }", {"o": "date"}, "Unknown type"),
+    ("q", "SELECT * WHERE { ?s ?p $o }", {}, "do not match"),
+    ("q", "SELECT * WHERE { ?s ?p ?o }", {"o": "iri"}, "do not match"),
+    ("q", "SELECT * WHERE { ?s ?p $timeout }", {"timeout": "integer"}, "timeout cannot be"),
+    ("q", "INSERT DATA { <a> <b> $o }", {"o": "iri"}, "is not a SELECT"),
+])
+def test_invalid_templates_are_refused(name, template, params, message):
+    with pytest.raises(ValueError, match=message):
+        StoredQuery(name, template, params)
+
+
+def test_cost_of_the_template():
+    assert stored().cost == (0, [])
+    assert StoredQuery("q", "SELECT * WHERE { ?s ?p ?o } LIMIT $n", {"n": "integer"}).cost == (4, ["scan"])
+    assert StoredQuery("q", "SELECT * WHERE { ?s ?p $o }", {"o": "omid"}).cost == (4, ["no_limit", "variable_predicate"])
+
+
+def test_cache_key_changes_with_the_template():
+    assert stored().key == stored().key
+    assert stored().key != stored(TEMPLATE.replace("LIMIT", "OFFSET 1 LIMIT")).key
+
+
+def test_load_stored_queries_refuses_updates(tmp_path):
+    path = tmp_path / "stored.json"
+    path.write_text(json.dumps({"index": {"wipe": {
+        "query": "SELECT * WHERE { ?s ?p $o } ; DELETE WHERE { ?s ?p ?o }", "params": {"o": "iri"}}}}))
+    with pytest.raises(ValueError, match="SPARQL Update request"):
+        load_stored_queries(str(path), ["index", "meta"])
+
+
+def test_shipped_stored_queries_load():
+    stored_queries = load_stored_queries("stored_queries.json", ["index", "meta"])
+    assert stored_queries["index"] and stored_queries["meta"]
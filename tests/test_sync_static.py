@@ -0,0 +1,198 @@
+"""Sync of the static files: the manifest of the synced files and the switch to a new release.
+
+Run from the root of the repository, where conf.json is: python -m pytest tests
+"""
+import json
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import sync_static
+from src import sync_schedule
+from sync_static import (SyncConfig, Manifest, get_file_hash, plan_changes, apply_changes, replace_link,
+                         stage_release, activate_release)
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """A working directory with a static folder and an index.html, and the source of the next sync"""
+    monkeypatch.chdir(tmp_path)
+    write(tmp_path / "static" / "css" / "style.css", "body {}\n")
+    write(tmp_path / "static" / "logo.svg", "<svg/>\n")
+    write(tmp_path / "index.html", "<html>old</html>\n")
+    src = tmp_path / "src"
+    write(src / "static" / "css" / "style.css", "body {}\n")
+    write(src / "static" / "logo.svg", "<svg>new</svg>\n")
+    write(src / "static" / "js" / "app.js", "run();\n")
+    write(src / "index.html", "<html>new</html>\n")
+    write(src / "README.md", "not synced\n")
+    return str(src)
+
+
+@pytest.fixture
+def config():
+    return SyncConfig({"static"}, {"index.html"}, manifest=".sync_manifest.json", workers=2, keep_releases=2)
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def blobs(**changed):
+    """The blobs of the synced source files, as git would list them"""
+    blobs = {"index.html": "b1", "static/css/style.css": "b2", "static/logo.svg": "b3", "static/js/app.js": "b4"}
+    blobs.update(changed)
+    return {os.path.normpath(path): blob for path, blob in blobs.items()}
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_hash_ignores_line_endings_bom_and_trailing_spaces(tmp_path):
+    write(tmp_path / "a.txt", "one\ntwo\n")
+    (tmp_path / "b.txt").write_bytes(b"\xef\xbb\xbfone  \r\ntwo\t\r\n")
+    write(tmp_path / "c.txt", "one\ntwo!\n")
+    assert get_file_hash(str(tmp_path / "a.txt")) == get_file_hash(str(tmp_path / "b.txt"))
+    assert get_file_hash(str(tmp_path / "a.txt")) != get_file_hash(str(tmp_path / "c.txt"))
+    # Binary files are hashed as they are
+    (tmp_path / "d.bin").write_bytes(b"\xff\xfe\r\n")
+    (tmp_path / "e.bin").write_bytes(b"\xff\xfe\n")
+    assert get_file_hash(str(tmp_path / "d.bin")) != get_file_hash(str(tmp_path / "e.bin"))
+
+
+def test_plan_finds_new_and_modified_files(site, config):
+    plan = plan_changes(site, blobs(), Manifest(config.manifest), config)
+    assert plan.to_add == [os.path.normpath("static/js/app.js")]
+    assert sorted(plan.to_update) == ["index.html", os.path.normpath("static/logo.svg")]
+    # Equal files are hashed once, so that applying the plan records them
+    assert os.path.normpath("static/css/style.css") in plan.hashes
+
+
+def test_applied_changes_are_recorded_in_the_manifest(site, config):
+    manifest = Manifest(config.manifest)
+    apply_changes(site, plan_changes(site, blobs(), manifest, config), manifest, config)
+    assert read("index.html") == "<html>new</html>\n" and read("static/js/app.js") == "run();\n"
+    assert not os.path.exists("README.md")
+
+    with open(config.manifest) as f:
+        saved = json.load(f)
+    assert saved["source"] == sync_static.OC_SERVICES_TEMPLATES
+    assert set(saved["files"]) == set(blobs())
+    assert not os.path.exists(config.manifest + ".tmp")
+    entry = saved["files"]["index.html"]
+    assert entry["blob"] == "b1" and entry["hash"] == get_file_hash("index.html")
+    assert entry["size"] == os.stat("index.html").st_size
+
+
+def test_unchanged_files_are_not_read_again(site, config, monkeypatch):
+    manifest = Manifest(config.manifest)
+    apply_changes(site, plan_changes(site, blobs(), manifest, config), manifest, config)
+
+    hashed = []
+    hash_file = sync_static.get_file_hash
+    monkeypatch.setattr(sync_static, "get_file_hash", lambda path: hashed.append(path) or hash_file(path))
+    plan = plan_changes(site, blobs(), Manifest(config.manifest), config)
+    assert not plan.has_changes() and hashed == []
+
+    # A new blob is compared, but the recorded hash spares reading the local copy
+    write(Path(site) / "static" / "logo.svg", "<svg>newer</svg>\n")
+    plan = plan_changes(site, blobs(**{"static/logo.svg": "b5"}), Manifest(config.manifest), config)
+    assert plan.to_update == [os.path.normpath("static/logo.svg")]
+    assert hashed == [os.path.join(site, "static", "logo.svg")]
+
+
+def test_files_edited_since_the_sync_are_compared_again(site, config):
+    manifest = Manifest(config.manifest)
+    apply_changes(site, plan_changes(site, blobs(), manifest, config), manifest, config)
+    with open("index.html", "a") as f:
+        f.write("<!-- edited by hand -->\n")
+    plan = plan_changes(site, blobs(), Manifest(config.manifest), config)
+    assert plan.to_update == ["index.html"] and not plan.to_add
+
+
+def test_paths_no_longer_synced_are_forgotten(site, config):
+    manifest = Manifest(config.manifest)
+    apply_changes(site, plan_changes(site, blobs(), manifest, config), manifest, config)
+    manifest = Manifest(config.manifest)
+    manifest.save({"index.html"})
+    assert list(Manifest(config.manifest).entries) == ["index.html"]
+
+
+def test_unreadable_manifest_is_ignored(site, config):
+    write(Path(config.manifest), "{not json")
+    manifest = Manifest(config.manifest)
+    assert manifest.entries == {}
+    plan = plan_changes(site, blobs(), manifest, config)
+    assert len(plan.to_add) + len(plan.to_update) == 3
+
+
+def test_replace_link_swaps_the_target(tmp_path):
+    os.mkdir(tmp_path / "a")
+    os.mkdir(tmp_path / "b")
+    link = str(tmp_path / "current")
+    replace_link("a", link)
+    assert os.readlink(link) == "a"
+    # A link left behind by an interrupted swap does not get in the way
+    os.symlink("c", link + ".sync-link")
+    replace_link("b", link)
+    assert os.readlink(link) == "b" and not os.path.lexists(link + ".sync-link")
+
+
+def test_release_replaces_the_files_at_once(site, config):
+    manifest = Manifest(config.manifest)
+    release = stage_release(site, plan_changes(site, blobs(), manifest, config), manifest, config)
+    # Nothing served changes until the release is activated
+    assert read("index.html") == "<html>old</html>\n" and not os.path.exists("static/js/app.js")
+    assert read(os.path.join(release, "static", "js", "app.js")) == "run();\n"
+
+    activate_release(release, config)
+    assert os.path.realpath(os.path.join(config.release_dir, "current")) == os.path.realpath(release)
+    for path in ("static", "index.html"):
+        assert os.path.islink(path)
+        assert os.path.realpath(path) == os.path.realpath(os.path.join(release, path))
+        assert not os.path.lexists(path + ".presync")
+    assert read("index.html") == "<html>new</html>\n"
+    assert read("static/logo.svg") == "<svg>new</svg>\n" and read("static/css/style.css") == "body {}\n"
+
+
+def test_next_releases_switch_the_current_link_and_prune_the_old_ones(site, config):
+    releases = []
+    for i in range(3):
+        write(Path(site) / "index.html", "<html>%d</html>\n" % i)
+        manifest = Manifest(config.manifest)
+        plan = plan_changes(site, blobs(**{"index.html": "v%d" % i}), manifest, config)
+        assert "index.html" in plan.to_update
+        releases.append(stage_release(site, plan, manifest, config))
+        activate_release(releases[-1], config)
+        assert read("index.html") == "<html>%d</html>\n" % i
+        # The links of the folders and files stay the same, only current changes
+        assert os.readlink("index.html") == os.path.join(config.release_dir, "current", "index.html")
+
+    # Files that did not change are hard links to those of the previous release
+    assert os.stat(os.path.join(releases[2], "static", "logo.svg")).st_ino == \
+        os.stat(os.path.join(releases[1], "static", "logo.svg")).st_ino
+    assert sorted(os.listdir(os.path.join(config.release_dir, "releases"))) == \
+        [os.path.basename(release) for release in releases[1:]]
+
+
+@pytest.mark.parametrize("swap, error, result", [
+    (True, None, True),
+    (False, None, True),
+    (True, subprocess.CalledProcessError(1, "sync_static.py"), False),
+])
+def test_run_sync_starts_the_script(monkeypatch, swap, error, result):
+    commands = []
+
+    def run(command, check):
+        commands.append(command)
+        if error:
+            raise error
+
+    monkeypatch.setattr(sync_schedule.subprocess, "run", run)
+    assert sync_schedule.run_sync(swap) is result
+    assert commands[0][1:] == ["sync_static.py", "--auto"] + (["--swap"] if swap else [])
@@ -0,0 +1,21 @@
+"""Choice of the results format asked to the backend.
+
+Run from the root of the repository: python -m pytest tests
+"""
+from src.transcode import negotiate, XML, JSON, CSV, TSV
+
+QLEVER = [TSV, JSON, CSV]
+
+
+def test_native_formats_are_passed_through():
+    for accept in (JSON, "application/json", CSV, TSV):
+        assert negotiate(accept, QLEVER, "SELECT") == (accept, None)
+
+
+def test_other_formats_are_converted_from_the_first_native_format():
+    assert negotiate(XML, QLEVER, "SELECT") == (TSV, (TSV, XML))
+
+
+def test_wildcards_and_graphs_are_passed_through():
+    assert negotiate("*/*, %s" % XML, QLEVER, "SELECT") == ("*/*, %s" % XML, None)
+    assert negotiate(XML, QLEVER, "CONSTRUCT") == (XML, None)